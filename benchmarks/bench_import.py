@@ -0,0 +1,58 @@
+"""Time importing the flaskphiid package in fresh interpreters
+
+    python benchmarks/bench_import.py [--repeat 5] [--module flaskphiid ...]
+
+Each module is imported in a new interpreter per run so that nothing is already
+cached in sys.modules. Prints JSON with the wall time of each run, the median, and
+the slowest imports reported by -X importtime for the last run.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+DEFAULT_MODULES = ['flaskphiid', 'flaskphiid.annotation']
+
+
+def time_import(module):
+    """(seconds, [(cumulative microseconds, imported module), ...]) for one fresh import"""
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+                            stderr=subprocess.PIPE, check=True, universal_newlines=True)
+    elapsed = time.perf_counter() - started
+    imports = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        imports.append((int(cumulative_us), name.strip()))
+    return elapsed, imports
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--module', action='append', dest='modules')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    report = {}
+    for module in args.modules or DEFAULT_MODULES:
+        runs = []
+        for _ in range(args.repeat):
+            elapsed, imports = time_import(module)
+            runs.append(elapsed)
+        imports.sort(reverse=True)
+        report[module] = {'runs': [round(run, 4) for run in runs],
+                          'median': round(statistics.median(runs), 4),
+                          'slowest_imports': [{'module': name, 'cumulative_ms': round(us / 1000.0, 2)}
+                                              for us, name in imports[:args.top]]}
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
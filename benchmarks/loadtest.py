@@ -0,0 +1,249 @@
+"""Load generator reporting throughput and tail latency
+
+    python -m benchmarks.loadtest --url http://127.0.0.1:5000 --rate 50 --duration 60
+    python -m benchmarks.loadtest --in-process --stub-backends --concurrency 8 --requests 2000
+    python -m benchmarks.loadtest --url ... --corpus notes.ndjson --endpoint /identifyphi/ --endpoint /compmed/phi
+
+Notes come from --corpus (NDJSON lines with an "extract_text" field) or are generated
+(see benchmarks.notes) and are posted round-robin to each --endpoint. --rate sends at a
+fixed request rate (open loop: latency is counted from when a request was due, so a
+stalled server is not hidden by sending less), --concurrency keeps that many requests
+in flight (closed loop). --in-process drives the app through Flask test clients instead
+of a server; --stub-backends then answers Comprehend Medical with the regular
+expressions of flaskphiid.compmed_stub and HutchNER with the generated labels.
+Prints a JSON summary with p50/p95/p99 latency, throughput and errors per endpoint.
+"""
+import argparse
+import http.client
+import json
+import math
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from benchmarks.notes import generate_corpus, StubHutchNER
+
+DEFAULT_ENDPOINTS = ['/identifyphi/']
+
+
+def load_corpus(path):
+    with open(path) as f:
+        return [json.loads(line)['extract_text'] for line in f if line.strip()]
+
+
+class HttpTarget(object):
+    """posts to a server, with one persistent connection per thread"""
+
+    def __init__(self, url, timeout=60):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80)
+        self.prefix = parts.path.rstrip('/')
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def post(self, endpoint, body):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = self.connection_class(self.host, self.port, timeout=self.timeout)
+        try:
+            connection.request('POST', self.prefix + endpoint, body=body, headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        except Exception:
+            connection.close()
+            self._local.connection = None
+            raise
+
+
+class AppTarget(object):
+    """posts to an app created in this process, with one test client per thread"""
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def post(self, endpoint, body):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        return client.post(endpoint, data=body, content_type='application/json').status_code
+
+
+class _RegexCompMed(object):
+
+    def get_phi(self, note_text):
+        from flaskphiid.compmed_stub import find_phi
+        return find_phi(note_text)
+
+    def get_entities(self, note_text, entityTypes=None, **kwargs):
+        from flaskphiid.compmed_stub import find_entities
+        return [entity for entity in find_entities(note_text)
+                if not entityTypes or entity['Category'] in entityTypes]
+
+
+def in_process_target(corpus, stub_backends):
+    from flaskphiid import create_app
+    from flaskphiid.backends import get_backends
+    if not stub_backends:
+        return AppTarget(create_app())
+    app = create_app({'SECRET_KEY': 'loadtest', 'RESULT_CACHE_ENABLED': False, 'LOG_LEVEL': 'WARNING'},
+                     warm_up=False)
+    get_backends(app).use(compmed=_RegexCompMed(), hutchner=StubHutchNER(corpus))
+    return AppTarget(app)
+
+
+class Recorder(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(Counter)
+        self.statuses = defaultdict(Counter)
+
+    def record(self, endpoint, latency, status=None, error=None):
+        with self._lock:
+            self.latencies[endpoint].append(latency)
+            if error is not None:
+                self.errors[endpoint][error] += 1
+            else:
+                self.statuses[endpoint][status] += 1
+                if status >= 400:
+                    self.errors[endpoint]['status {}'.format(status)] += 1
+
+
+def _send(target, recorder, endpoint, body, due):
+    try:
+        status = target.post(endpoint, body)
+    except Exception as e:
+        recorder.record(endpoint, time.perf_counter() - due, error=type(e).__name__)
+    else:
+        recorder.record(endpoint, time.perf_counter() - due, status=status)
+
+
+def _requests(bodies, endpoints, count):
+    for i in range(count) if count else iter(int, 1):
+        yield endpoints[i % len(endpoints)], bodies[i % len(bodies)]
+
+
+def run_closed_loop(target, recorder, requests, concurrency, deadline):
+    lock = threading.Lock()
+
+    def worker():
+        while time.perf_counter() < deadline:
+            with lock:
+                request = next(requests, None)
+            if request is None:
+                return
+            _send(target, recorder, request[0], request[1], time.perf_counter())
+
+    threads = [threading.Thread(target=worker, name='load-{}'.format(i)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def run_open_loop(target, recorder, requests, rate, max_in_flight, deadline):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='load') as executor:
+        for i, (endpoint, body) in enumerate(requests):
+            due = started + i / rate
+            if due >= deadline:
+                break
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(_send, target, recorder, endpoint, body, due)
+
+
+def percentile(ordered, fraction):
+    """nearest-rank percentile of a sorted list"""
+    if not ordered:
+        return None
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def summarize(recorder, elapsed):
+    endpoints = {}
+    for endpoint, latencies in sorted(recorder.latencies.items()):
+        ordered = sorted(latencies)
+        endpoints[endpoint] = {
+            'requests': len(ordered),
+            'throughput_rps': len(ordered) / elapsed,
+            'latency_s': {'p50': percentile(ordered, 0.50), 'p95': percentile(ordered, 0.95),
+                          'p99': percentile(ordered, 0.99), 'max': ordered[-1],
+                          'mean': sum(ordered) / len(ordered)},
+            'statuses': {str(status): n for status, n in sorted(recorder.statuses[endpoint].items())},
+            'errors': dict(recorder.errors[endpoint]),
+        }
+    total = sum(summary['requests'] for summary in endpoints.values())
+    errors = sum(sum(summary['errors'].values()) for summary in endpoints.values())
+    return {'elapsed_s': elapsed, 'requests': total, 'throughput_rps': total / elapsed if elapsed else 0.0,
+            'error_rate': errors / total if total else 0.0, 'endpoints': endpoints}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    target_group = parser.add_mutually_exclusive_group(required=True)
+    target_group.add_argument('--url', help="server to load, e.g. http://127.0.0.1:5000")
+    target_group.add_argument('--in-process', action='store_true', help="drive an app created in this process")
+    parser.add_argument('--stub-backends', action='store_true', help="with --in-process, use stand-in backends")
+    parser.add_argument('--endpoint', action='append', dest='endpoints')
+    parser.add_argument('--corpus', help="NDJSON notes; generated notes are used otherwise")
+    parser.add_argument('--notes', type=int, default=100, help="notes to generate")
+    parser.add_argument('--length', type=int, default=2000, help="characters per generated note")
+    parser.add_argument('--seed', type=int, default=0)
+    load_group = parser.add_mutually_exclusive_group()
+    load_group.add_argument('--rate', type=float, help="requests per second (open loop)")
+    load_group.add_argument('--concurrency', type=int, default=4, help="requests in flight (closed loop)")
+    parser.add_argument('--max-in-flight', type=int, default=256, help="with --rate, the most outstanding requests")
+    parser.add_argument('--duration', type=float, default=30.0, help="seconds to run for")
+    parser.add_argument('--requests', type=int, default=0, help="stop after this many requests")
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--output', help="also write the summary here")
+    args = parser.parse_args(argv)
+
+    if args.corpus:
+        texts = load_corpus(args.corpus)
+        corpus = []
+    else:
+        corpus = generate_corpus(args.notes, seed=args.seed, length=args.length)
+        texts = [note.text for note in corpus]
+    if args.in_process:
+        target = in_process_target(corpus, args.stub_backends)
+    else:
+        target = HttpTarget(args.url, timeout=args.timeout)
+    bodies = [json.dumps({'extract_text': text}) for text in texts]
+    requests = _requests(bodies, args.endpoints or DEFAULT_ENDPOINTS, args.requests)
+
+    recorder = Recorder()
+    started = time.perf_counter()
+    deadline = started + args.duration
+    if args.rate:
+        run_open_loop(target, recorder, requests, args.rate, args.max_in_flight, deadline)
+    else:
+        run_closed_loop(target, recorder, requests, args.concurrency, deadline)
+    summary = summarize(recorder, time.perf_counter() - started)
+    summary['load'] = {'rate': args.rate, 'concurrency': None if args.rate else args.concurrency,
+                       'target': args.url or 'in-process', 'notes': len(bodies)}
+
+    for endpoint, result in summary['endpoints'].items():
+        latency = result['latency_s']
+        print("{:16} {:7d} req {:8.1f} req/s  p50 {:7.1f} ms  p95 {:7.1f} ms  p99 {:7.1f} ms  errors {}".format(
+            endpoint, result['requests'], result['throughput_rps'], latency['p50'] * 1e3, latency['p95'] * 1e3,
+            latency['p99'] * 1e3, sum(result['errors'].values())), file=sys.stderr)
+    output = json.dumps(summary, indent=2, sort_keys=True)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,111 @@
+"""Report resident memory per gunicorn worker, with and without preloading HutchNER
+
+    APP_CONFIG_FILE=/path/to/config.py python benchmarks/memory_report.py --workers 4
+
+Starts flaskphiid.serve once with --no-preload (every worker loads its own model) and
+once with preloading (workers share the master's model), waits for /readyz, and reads
+RSS, PSS and private memory of the master and each worker (and any HutchNER pool
+processes) from /proc/<pid>/smaps_rollup. PSS divides shared pages among the processes
+sharing them, so the sum of PSS is the real memory cost of the server. Prints JSON.
+Use --pid to report on a server that is already running instead. Linux only.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+
+FIELDS = {'Rss': 'rss_kb', 'Pss': 'pss_kb', 'Private_Clean': 'private_clean_kb',
+          'Private_Dirty': 'private_dirty_kb', 'Shared_Clean': 'shared_clean_kb',
+          'Shared_Dirty': 'shared_dirty_kb'}
+
+
+def memory(pid):
+    usage = {}
+    with open('/proc/{}/smaps_rollup'.format(pid)) as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            if name in FIELDS:
+                usage[FIELDS[name]] = int(value.split()[0])
+    usage['private_kb'] = usage.pop('private_clean_kb') + usage.pop('private_dirty_kb')
+    return usage
+
+
+def children(pid):
+    found = []
+    for task in os.listdir('/proc/{}/task'.format(pid)):
+        with open('/proc/{}/task/{}/children'.format(pid, task)) as f:
+            found.extend(int(child) for child in f.read().split())
+    return found
+
+
+def process_tree_report(master_pid):
+    processes = []
+    pending = [(master_pid, 'master')]
+    while pending:
+        pid, role = pending.pop(0)
+        try:
+            processes.append(dict(memory(pid), pid=pid, role=role))
+            pending.extend((child, 'worker' if role == 'master' else 'pool') for child in children(pid))
+        except (IOError, OSError):
+            # the process exited while we looked at it
+            continue
+    totals = {key: sum(p[key] for p in processes) for key in ('rss_kb', 'pss_kb', 'private_kb')}
+    workers = [p for p in processes if p['role'] == 'worker']
+    return {'processes': processes, 'totals': totals,
+            'mean_worker_rss_kb': sum(p['rss_kb'] for p in workers) // max(1, len(workers)),
+            'mean_worker_pss_kb': sum(p['pss_kb'] for p in workers) // max(1, len(workers))}
+
+
+def wait_until_ready(url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url + '/readyz', timeout=5) as response:
+                if response.status == 200:
+                    return
+        except (IOError, OSError):
+            pass
+        time.sleep(0.5)
+    raise RuntimeError("server at {} was not ready after {}s".format(url, timeout))
+
+
+def measure(workers, port, preload, settle, timeout):
+    command = [sys.executable, '-m', 'flaskphiid.serve', '--bind', '127.0.0.1:{}'.format(port),
+               '--workers', str(workers)]
+    if not preload:
+        command.append('--no-preload')
+    server = subprocess.Popen(command)
+    try:
+        wait_until_ready('http://127.0.0.1:{}'.format(port), timeout)
+        # /readyz is answered by whichever worker accepts it; give the others time to load
+        time.sleep(settle)
+        return process_tree_report(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--settle', type=float, default=5.0, help="seconds to wait after the first ready response")
+    parser.add_argument('--timeout', type=float, default=300.0)
+    parser.add_argument('--pid', type=int, help="report on this running master instead of starting servers")
+    args = parser.parse_args(argv)
+
+    if args.pid:
+        report = process_tree_report(args.pid)
+    else:
+        report = {'no_preload': measure(args.workers, args.port, False, args.settle, args.timeout),
+                  'preload': measure(args.workers, args.port, True, args.settle, args.timeout)}
+        report['pss_saved_kb'] = report['no_preload']['totals']['pss_kb'] - report['preload']['totals']['pss_kb']
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""Synthetic clinical notes with the backend output for their PHI
+
+generate_corpus() builds reproducible notes of filler text with PHI spans dropped in at
+a given density. Each note comes with the Comprehend Medical entities and the HutchNER
+token labels a backend would return for it, overlapping in one of these patterns:
+
+    exact     both backends find the same span
+    partial   HutchNER's span starts or ends a word away from Comprehend Medical's
+    chain     runs of spans that each overlap the next, forming long merge groups
+    subtypes  HutchNER labels the words of an address with different child types
+              (HOSPITAL_NAME, SPECIALTY, WARD), which merging splits into runs of
+              one or more words
+    mixed     a random choice of the above for every span
+
+StubCompMed and StubHutchNER answer with the stored output for notes of the corpus.
+"""
+import random
+from collections import namedtuple
+
+FILLER = ("patient seen today for follow up of chronic pain and fatigue reports improved sleep "
+          "denies fever chills or weight loss continue current medications and return in weeks "
+          "blood pressure stable labs reviewed with patient plan discussed questions answered").split()
+FIRST_NAMES = ["John", "Mary", "Edward", "Ana", "Wei", "Fatima", "Carlos", "Grace"]
+LAST_NAMES = ["Smith", "Jones", "Nguyen", "Garcia", "Okafor", "Larsen", "Kim", "Patel"]
+HOSPITALS = ["Harborview Medical Center", "Swedish", "Northwest Hospital", "Overlake"]
+SPECIALTIES = ["Radiation Oncology", "Cardiology", "Interventional Radiology", "Pediatrics"]
+WARDS = ["4East", "ICU", "PACU", "3West"]
+MONTHS = ["January", "March", "May", "July", "October", "December"]
+OVERLAP_PATTERNS = ('exact', 'partial', 'chain', 'subtypes')
+
+SyntheticNote = namedtuple('SyntheticNote', ['text', 'compmed', 'hutchner_tokens'])
+
+
+class _NoteBuilder(object):
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.parts = []
+        self.length = 0
+        self.compmed = []
+        self.tokens = []
+
+    def word(self, word, label='O', confidence=None):
+        """append a word, returning its (start, end)"""
+        if self.parts:
+            self.parts.append(' ')
+            self.length += 1
+        start = self.length
+        self.parts.append(word)
+        self.length += len(word)
+        self.tokens.append({'start': start, 'stop': self.length, 'text': word, 'label': label,
+                            'confidence': round(confidence or self.rng.uniform(0.6, 0.99), 3)})
+        return start, self.length
+
+    def words(self, words, label):
+        spans = [self.word(word, label) for word in words]
+        return spans[0][0], spans[-1][1]
+
+    def entity(self, start, end, entity_type):
+        self.compmed.append({'Id': len(self.compmed), 'BeginOffset': start, 'EndOffset': end,
+                             'Score': round(self.rng.uniform(0.5, 0.999), 3), 'Text': None,
+                             'Category': 'PROTECTED_HEALTH_INFORMATION', 'Type': entity_type, 'Traits': []})
+
+    def phi(self, pattern):
+        rng = self.rng
+        if pattern == 'subtypes':
+            start, _ = self.words(rng.choice(HOSPITALS).split(), 'HOSPITAL_NAME')
+            self.words(rng.choice(SPECIALTIES).split(), 'SPECIALTY')
+            _, end = self.word(rng.choice(WARDS), 'WARD')
+            self.entity(start, end, 'ADDRESS')
+        elif pattern == 'chain':
+            # a name, a date and a name, with Comprehend Medical entities overlapping by a word
+            spans = [self.word(rng.choice(FIRST_NAMES), 'PATIENT_OR_FAMILY_NAME'),
+                     self.word(rng.choice(LAST_NAMES), 'PATIENT_OR_FAMILY_NAME'),
+                     self.word(rng.choice(MONTHS), 'DATE'),
+                     self.word(str(rng.randint(1, 28)), 'DATE'),
+                     self.word(rng.choice(LAST_NAMES), 'PROVIDER_NAME')]
+            self.entity(spans[0][0], spans[2][1], 'NAME')
+            self.entity(spans[2][0], spans[3][1], 'DATE')
+            self.entity(spans[3][0], spans[4][1], 'NAME')
+        else:
+            kind = rng.randrange(3)
+            if kind == 0:
+                start, end = self.words([rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)],
+                                        rng.choice(['PATIENT_OR_FAMILY_NAME', 'PROVIDER_NAME']))
+                entity_type = 'NAME'
+            elif kind == 1:
+                self.word('MRN')
+                start, end = self.words([str(rng.randint(1000000, 9999999))], 'MEDICAL_RECORD_NUMBER')
+                entity_type = 'ID'
+            else:
+                start, end = self.words([rng.choice(MONTHS), str(rng.randint(1, 28)), str(rng.randint(1990, 2030))],
+                                        'DATE')
+                entity_type = 'DATE'
+            if pattern == 'partial':
+                # Comprehend Medical takes in the word after the span as well
+                _, extended = self.word(self.rng.choice(FILLER))
+                self.entity(start, extended, entity_type)
+            else:
+                self.entity(start, end, entity_type)
+
+
+def generate_note(rng, length=2000, phi_density=0.05, overlap='mixed'):
+    """one SyntheticNote of about `length` characters, where about phi_density of the words start a PHI span"""
+    if overlap != 'mixed' and overlap not in OVERLAP_PATTERNS:
+        raise ValueError("unknown overlap pattern {}".format(overlap))
+    builder = _NoteBuilder(rng)
+    while builder.length < length:
+        if rng.random() < phi_density:
+            builder.phi(rng.choice(OVERLAP_PATTERNS) if overlap == 'mixed' else overlap)
+        else:
+            builder.word(rng.choice(FILLER))
+    text = ''.join(builder.parts)
+    for entity in builder.compmed:
+        entity['Text'] = text[entity['BeginOffset']:entity['EndOffset']]
+    return SyntheticNote(text, builder.compmed, builder.tokens)
+
+
+def generate_corpus(count, seed=0, length=2000, phi_density=0.05, overlap='mixed'):
+    rng = random.Random(seed)
+    return [generate_note(rng, length, phi_density, overlap) for _ in range(count)]
+
+
+class StubPrediction(object):
+
+    def __init__(self, tokens):
+        self.NER_token_labels = tokens
+
+    def to_json(self):
+        return [token for token in self.NER_token_labels if token['label'] != 'O']
+
+
+class StubCompMed(object):
+    """answers get_phi/get_entities with the stored entities of a corpus note"""
+
+    def __init__(self, corpus):
+        self.entities = {note.text: note.compmed for note in corpus}
+
+    def get_phi(self, note_text):
+        return self.entities.get(note_text, [])
+
+    def get_entities(self, note_text, entityTypes=None, **kwargs):
+        return [entity for entity in self.get_phi(note_text)
+                if not entityTypes or entity['Category'] in entityTypes]
+
+
+class StubHutchNER(object):
+    """answers predict with the stored token labels of a corpus note"""
+
+    def __init__(self, corpus):
+        self.tokens = {note.text: note.hutchner_tokens for note in corpus}
+
+    def predict(self, note_text, **kwargs):
+        return StubPrediction(self.tokens.get(note_text, []))
@@ -0,0 +1,261 @@
+"""Benchmarks of annotation merging and /identifyphi/ on synthetic notes
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --save-baseline baseline.json
+    python -m benchmarks.run --compare baseline.json --threshold 0.15
+
+Every benchmark runs over the same generated corpus (see benchmarks.notes) and reports
+seconds per note. A benchmark is timed in `--repeat` rounds of enough iterations to take
+at least `--min-time` seconds, with the garbage collector off as in timeit; the median
+round is the headline number. --compare exits with status 1 when a benchmark's median
+is more than --threshold slower than in the baseline.
+
+Timings only compare on the same machine, so no baseline is kept in the repository:
+save one from the base revision (e.g. main) and compare the change against it there.
+"""
+import argparse
+import gc
+import json
+import platform
+import random
+import statistics
+import sys
+from time import perf_counter
+
+from benchmarks.notes import FILLER, generate_corpus, StubCompMed, StubHutchNER
+from flaskphiid.annotation import AnnotationFactory, MergedAnnotation, unionize_annotations
+from flaskphiid.hutchner import aggregate_spans
+
+
+def _annotations(note):
+    annotations = [AnnotationFactory.from_compmed(entity) for entity in note.compmed]
+    annotations += [AnnotationFactory.from_hutchner(token) for token in note.hutchner_tokens if token['label'] != 'O']
+    return annotations
+
+
+def _overlap_groups(annotations):
+    """the groups of overlapping annotations unionize_annotations merges"""
+    group, end = [], None
+    for ann in sorted(annotations, key=lambda ann: ann.start):
+        if group and ann.start >= end:
+            yield group
+            group = []
+        end = ann.end if not group else max(end, ann.end)
+        group.append(ann)
+    if group:
+        yield group
+
+
+def _groups_with_subtypes(corpus):
+    """merged annotations that split_annotations_by_subtypes has work to do on"""
+    groups = []
+    for note in corpus:
+        for group in _overlap_groups(_annotations(note)):
+            merged = MergedAnnotation()
+            for ann in group:
+                merged.add_annotation(ann)
+            if len(merged.source_child_types) > 1 and len(merged.source_parent_types) == 1:
+                groups.append(merged)
+    return groups
+
+
+def bench_unionize_annotations(corpus):
+    notes = [(_annotations(note), note.text) for note in corpus]
+    return lambda: [unionize_annotations(annotations, text) for annotations, text in notes]
+
+
+def _span_annotations(note):
+    annotations = [AnnotationFactory.from_compmed(entity) for entity in note.compmed]
+    annotations += [AnnotationFactory.from_hutchner(span)
+                    for span in aggregate_spans(note.hutchner_tokens, 'max', note.text)]
+    return annotations
+
+
+def bench_unionize_spans(corpus):
+    """unionize_annotations with runs of HutchNER tokens combined into spans, as /identifyphi/ does"""
+    notes = [(_span_annotations(note), note.text) for note in corpus]
+    return lambda: [unionize_annotations(annotations, text) for annotations, text in notes]
+
+
+def bench_aggregate_spans(corpus):
+    notes = [(note.hutchner_tokens, note.text) for note in corpus]
+    return lambda: [aggregate_spans(tokens, 'max', text) for tokens, text in notes]
+
+
+def bench_split_annotations_by_subtypes(corpus):
+    groups = _groups_with_subtypes(corpus)
+    return lambda: [group.split_annotations_by_subtypes() for group in groups]
+
+
+def _long_clusters(count=10, tokens=300, seed=0):
+    """merged ADDRESS annotations over `tokens` HutchNER words in runs of address subtypes"""
+    rng = random.Random(seed)
+    clusters = []
+    for _ in range(count):
+        words, start, label = [], 0, None
+        while len(words) < tokens:
+            label = rng.choice([other for other in ('HOSPITAL_NAME', 'SPECIALTY', 'WARD') if other != label])
+            for _ in range(rng.randint(1, 5)):
+                word = rng.choice(FILLER)
+                words.append({'start': start, 'stop': start + len(word), 'text': word, 'label': label,
+                              'confidence': 0.9})
+                start += len(word) + 1
+        text = ' '.join(word['text'] for word in words)
+        merged = MergedAnnotation(text)
+        merged.add_annotation(AnnotationFactory.from_compmed({'BeginOffset': 0, 'EndOffset': len(text), 'Score': 0.9,
+                                                              'Text': text, 'Type': 'ADDRESS'}))
+        for word in words:
+            merged.add_annotation(AnnotationFactory.from_hutchner(word))
+        clusters.append(merged)
+    return clusters
+
+
+def bench_split_long_clusters(corpus):
+    """splitting clusters of hundreds of tokens, as long address and name lists produce"""
+    clusters = _long_clusters()
+    return lambda: [cluster.split_annotations_by_subtypes() for cluster in clusters]
+
+
+def bench_to_dict(corpus):
+    merged = [unionize_annotations(_annotations(note), note.text) for note in corpus]
+    return lambda: [[ann.to_dict() for ann in anns] for anns in merged]
+
+
+def bench_to_dict_detailed(corpus):
+    merged = [unionize_annotations(_annotations(note), note.text) for note in corpus]
+    return lambda: [[ann.to_dict(detailed=True) for ann in anns] for anns in merged]
+
+
+def bench_identifyphi(corpus):
+    """the whole /identifyphi/ request, with backends that answer from the corpus"""
+    from flaskphiid import create_app
+    from flaskphiid.backends import get_backends
+    app = create_app({'SECRET_KEY': 'bench', 'RESULT_CACHE_ENABLED': False, 'METRICS_ENABLED': True,
+                      'LOG_LEVEL': 'WARNING'}, warm_up=False)
+    get_backends(app).use(compmed=StubCompMed(corpus), hutchner=StubHutchNER(corpus))
+    client = app.test_client()
+    bodies = [json.dumps({'extract_text': note.text}) for note in corpus]
+
+    def run():
+        for body in bodies:
+            response = client.post('/identifyphi/', data=body, content_type='application/json')
+            if response.status_code != 200:
+                raise RuntimeError("/identifyphi/ returned {}".format(response.status_code))
+    return run
+
+
+BENCHMARKS = {
+    'unionize_annotations': bench_unionize_annotations,
+    'unionize_spans': bench_unionize_spans,
+    'aggregate_spans': bench_aggregate_spans,
+    'split_annotations_by_subtypes': bench_split_annotations_by_subtypes,
+    'split_long_clusters': bench_split_long_clusters,
+    'to_dict': bench_to_dict,
+    'to_dict_detailed': bench_to_dict_detailed,
+    'identifyphi': bench_identifyphi,
+}
+
+
+def measure(run, per_call, repeat=5, min_time=0.2):
+    """seconds per item for `run`, which processes per_call items each call"""
+    run()  # warm up
+    number = 1
+    while True:
+        started = perf_counter()
+        for _ in range(number):
+            run()
+        elapsed = perf_counter() - started
+        if elapsed >= min_time:
+            break
+        number *= 2
+    rounds = []
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            started = perf_counter()
+            for _ in range(number):
+                run()
+            rounds.append((perf_counter() - started) / (number * per_call))
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return {'median_s': statistics.median(rounds), 'min_s': min(rounds), 'mean_s': statistics.mean(rounds),
+            'stdev_s': statistics.stdev(rounds) if len(rounds) > 1 else 0.0,
+            'iterations': number, 'rounds': repeat, 'items_per_call': per_call}
+
+
+def compare(results, baseline, threshold):
+    """[(name, baseline median, median, ratio, regressed)] for benchmarks in both runs"""
+    rows = []
+    for name, result in sorted(results['results'].items()):
+        base = baseline.get('results', {}).get(name)
+        if base is None:
+            continue
+        ratio = result['median_s'] / base['median_s']
+        rows.append((name, base['median_s'], result['median_s'], ratio, ratio > 1 + threshold))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--notes', type=int, default=50)
+    parser.add_argument('--length', type=int, default=2000, help="characters per note")
+    parser.add_argument('--phi-density', type=float, default=0.05, help="chance that a word starts a PHI span")
+    parser.add_argument('--overlap', default='mixed', help="exact, partial, chain, subtypes or mixed")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', help="comma-separated benchmarks to run: " + ', '.join(BENCHMARKS))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2)
+    parser.add_argument('--output', help="write the results here as well as to stdout")
+    parser.add_argument('--save-baseline', help="write the results here, to compare later runs with")
+    parser.add_argument('--compare', help="baseline results to compare with")
+    parser.add_argument('--threshold', type=float, default=0.10, help="allowed slowdown, as a fraction")
+    args = parser.parse_args(argv)
+
+    names = args.only.split(',') if args.only else list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error("unknown benchmarks: {}".format(', '.join(unknown)))
+    corpus = generate_corpus(args.notes, seed=args.seed, length=args.length, phi_density=args.phi_density,
+                             overlap=args.overlap)
+    params = {'notes': args.notes, 'length': args.length, 'phi_density': args.phi_density,
+              'overlap': args.overlap, 'seed': args.seed}
+    results = {'params': params,
+               'environment': {'python': platform.python_version(), 'machine': platform.machine(),
+                               'platform': platform.platform()},
+               'results': {}}
+    for name in names:
+        per_call = len(corpus)
+        if name == 'split_annotations_by_subtypes':
+            per_call = max(1, len(_groups_with_subtypes(corpus)))
+        elif name == 'split_long_clusters':
+            per_call = len(_long_clusters())
+        results['results'][name] = measure(BENCHMARKS[name](corpus), per_call, args.repeat, args.min_time)
+        print("{:32} {:10.1f} us per item".format(name, results['results'][name]['median_s'] * 1e6),
+              file=sys.stderr)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    print(output)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                f.write(output + '\n')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('params') != params:
+            print("warning: baseline was run with {}".format(baseline.get('params')), file=sys.stderr)
+        rows = compare(results, baseline, args.threshold)
+        for name, base, median, ratio, regressed in rows:
+            print("{:32} {:10.1f} -> {:10.1f} us  x{:.2f}{}".format(name, base * 1e6, median * 1e6, ratio,
+                                                                  "  REGRESSION" if regressed else ""),
+                  file=sys.stderr)
+        if any(regressed for *_, regressed in rows):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
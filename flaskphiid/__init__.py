@@ -1,38 +1,72 @@
 # flaskphiid.py or flaskphiid/__init__.py
-import logging
 import os
 from flask import Flask, render_template
 
-formatter = logging.Formatter(
-    "%(asctime)s %(threadName)-11s %(levelname)-10s %(message)s")
-
-logger = logging.getLogger()
-streamhandler = logging.StreamHandler()
-streamhandler.setLevel(logging.INFO)
-streamhandler.setFormatter(formatter)
-logger.addHandler(streamhandler)
-logger.setLevel(logging.INFO)
-
-
-# load medlp interface
-from compmed.CompMedServiceInterface import CompMedServiceInterface
-from compmed_utils import json_parser_util as JSONParser
-compmedInterface = CompMedServiceInterface(JSONParser.xform_dict_to_json)
-#load HutchNER interface
-from HutchNERPredict import hutchner as hutchnerpredict
-hutchNERInterface = hutchnerpredict.HutchNER()
 
 def index():
     return render_template(
         'index.html', name="User")
 
 
-def create_app(test_config=None):
+def create_app(test_config=None, warm_up=None):
+    """
+    create and configure the flaskphiid; warm_up=False leaves warming up the backends to the
+    caller (see flaskphiid.serve), otherwise it starts in the background if BACKENDS_WARM_UP
+    """
     # create and configure the flaskphiid
     app = Flask(__name__, instance_relative_config=True)
     app.config.from_mapping(
         SECRET_KEY=os.urandom(24),
         DATABASE=os.path.join(app.instance_path, 'flaskphiid.sqlite'),
+        BACKEND_MAX_WORKERS=8,
+        COMPMED_TIMEOUT=30,
+        HUTCHNER_TIMEOUT=30,
+        BATCH_MAX_CONCURRENCY=4,
+        BATCH_MAX_NOTES=1000,
+        STREAM_MAX_IN_FLIGHT=16,
+        STREAM_MAX_LINE_BYTES=10 * 1024 * 1024,
+        COMPMED_MAX_CHARS=20000,
+        COMPMED_CHUNK_OVERLAP=200,
+        RESULT_CACHE_ENABLED=True,
+        RESULT_CACHE_MAX_BYTES=64 * 1024 * 1024,
+        RESULT_CACHE_TTL=24 * 60 * 60,
+        RESULT_CACHE_PERSIST=False,
+        RESULT_CACHE_VERSION=3,
+        RESULT_CACHE_ALLOW_INVALIDATE=False,
+        COMPMED_REGION=None,
+        COMPMED_ENDPOINT_URL=None,
+        COMPMED_POOL_SIZE=None,
+        COMPMED_MAX_RETRIES=4,
+        COMPMED_BACKOFF_BASE=0.1,
+        COMPMED_BACKOFF_CAP=5.0,
+        COMPMED_CONNECT_TIMEOUT=5,
+        COMPMED_READ_TIMEOUT=60,
+        COMPMED_ASYNC=True,
+        HUTCHNER_PROCESSES=0,
+        HUTCHNER_PROCESS_QUEUE=None,
+        HUTCHNER_AGGREGATE_SPANS=True,
+        HUTCHNER_SPAN_REDUCER='max',
+        HUTCHNER_COALESCE=False,
+        HUTCHNER_BATCH_MAX_SIZE=16,
+        HUTCHNER_BATCH_MAX_WAIT_MS=5,
+        BACKENDS_WARM_UP=True,
+        ADMISSION_ENABLED=False,
+        ADMISSION_MAX_CONCURRENCY=8,
+        ADMISSION_MAX_QUEUE=32,
+        ADMISSION_MAX_BULK_QUEUE=8,
+        ADMISSION_MAX_PER_CLIENT=None,
+        ADMISSION_QUEUE_TIMEOUT=10,
+        ADMISSION_MAX_RETRY_AFTER=60,
+        ADMISSION_CLIENT_HEADER='X-Client-Id',
+        METRICS_ENABLED=True,
+        PROFILING_ENABLED=False,
+        PROFILE_DIR=None,
+        PROFILE_TOP_N=10,
+        PROFILE_KEEP=20,
+        LOG_LEVEL='INFO',
+        LOG_FORMAT='text',
+        LOG_QUEUE=True,
+        LOG_PAYLOAD_SAMPLE_RATE=0.0,
     )
     app.url_map.strict_slashes = False
 
@@ -56,6 +90,9 @@ def create_app(test_config=None):
         # load the test config if passed in
         app.config.from_mapping(test_config)
 
+    from flaskphiid import logconfig
+    logconfig.init_app(app)
+
     # ensure the instance folder exists
     try:
         os.makedirs(app.instance_path)
@@ -65,11 +102,25 @@ def create_app(test_config=None):
     #set up database
     #from . import db
     #db.init_app(app)
-
-    hutchNERInterface.load_model(input_path=app.config['HUTCHNER_MODEL'])
-    hutchNERInterface.load_clusters(input_path=app.config['CLINIC_NOTE_CLUSTERS'])
-
-    from flaskphiid import compmedner, hutchner, identifyphi
+    from flaskphiid import cache
+    cache.init_app(app)
+
+    # backends are created on first use; warming up in the background lets /readyz
+    # report when this instance can take traffic without blocking start-up
+    from flaskphiid import backends
+    backends.init_app(app)
+    if warm_up is None:
+        warm_up = app.config['BACKENDS_WARM_UP'] and not app.testing
+    if warm_up:
+        backends.start_warm_up(app)
+
+    from flaskphiid import admission, metrics, profiling
+    metrics.init_app(app)
+    profiling.init_app(app)
+    admission.init_app(app)
+
+    from flaskphiid import compmedner, health, hutchner, identifyphi
+    app.register_blueprint(health.bp)
     app.register_blueprint(compmedner.bp)
     app.register_blueprint(hutchner.bp)
     app.register_blueprint(identifyphi.bp)
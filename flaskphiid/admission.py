@@ -0,0 +1,274 @@
+"""Admission control for the PHI endpoints: a bounded queue, per-client limits and priority lanes
+
+With ADMISSION_ENABLED set, POSTs to the compmed, hutchner and identifyphi blueprints must
+be admitted before they run. At most ADMISSION_MAX_CONCURRENCY run at once; the rest wait
+in one of two lanes, 'interactive' and 'bulk', and a freed slot always goes to the oldest
+interactive request first. Each lane's queue is bounded (ADMISSION_MAX_QUEUE and
+ADMISSION_MAX_BULK_QUEUE), and a client (the ADMISSION_CLIENT_HEADER header, else the
+remote address) may have at most ADMISSION_MAX_PER_CLIENT requests running or queued.
+A request that does not fit, or that is still queued after ADMISSION_QUEUE_TIMEOUT, gets
+an immediate 429 with a Retry-After estimated from how fast the queue is draining
+(an exponentially weighted moving average of the time between completed requests), so
+callers back off instead of timing out at the load balancer with work half done.
+
+The lane is the X-Priority header (interactive or bulk); /identifyphi/batch and
+/identifyphi/stream default to bulk, everything else to interactive. Size the server's
+threads (flaskphiid.serve --threads) to at least ADMISSION_MAX_CONCURRENCY +
+ADMISSION_MAX_QUEUE + ADMISSION_MAX_BULK_QUEUE, or requests wait for a thread before they
+ever reach the queue.
+"""
+import asyncio
+import logging
+import math
+import threading
+from collections import deque
+from time import monotonic
+
+from flask import Response, current_app, g, request
+
+from flaskphiid.logconfig import Event
+from flaskphiid.metrics import ADMISSION_QUEUED, ADMISSION_REJECTED, ADMISSION_WAIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+EXTENSION_KEY = 'admission'
+LANES = ('interactive', 'bulk')
+BLUEPRINTS = ('compmed', 'hutchner', 'identifyphi')
+BULK_ENDPOINTS = ('identifyphi.annotate_batch', 'identifyphi.annotate_stream')
+
+
+class Rejected(Exception):
+    """the request was not admitted; retry_after is the suggested wait in whole seconds"""
+
+    def __init__(self, reason, retry_after):
+        super(Rejected, self).__init__("{} (retry after {}s)".format(reason, retry_after))
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter(object):
+    __slots__ = ('client', 'lane', 'granted', 'wake')
+
+    def __init__(self, client, lane, wake):
+        self.client = client
+        self.lane = lane
+        self.granted = False
+        self.wake = wake
+
+
+class Admission(object):
+
+    def __init__(self, max_concurrency, max_queue, max_bulk_queue=None, max_per_client=None,
+                 queue_timeout=None, smoothing=0.2, max_retry_after=60):
+        self.max_concurrency = max_concurrency
+        self.max_queue = {'interactive': max_queue,
+                          'bulk': max_queue if max_bulk_queue is None else max_bulk_queue}
+        self.max_per_client = max_per_client
+        self.queue_timeout = queue_timeout
+        self.smoothing = smoothing
+        self.max_retry_after = max_retry_after
+        self._lock = threading.Lock()
+        self._queues = {lane: deque() for lane in LANES}
+        self._running = 0
+        self._per_client = {}
+        self._interval = None
+        self._last_release = None
+        self._busy_since = None
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(max_concurrency=config['ADMISSION_MAX_CONCURRENCY'],
+                   max_queue=config['ADMISSION_MAX_QUEUE'],
+                   max_bulk_queue=config.get('ADMISSION_MAX_BULK_QUEUE'),
+                   max_per_client=config.get('ADMISSION_MAX_PER_CLIENT'),
+                   queue_timeout=config.get('ADMISSION_QUEUE_TIMEOUT'),
+                   max_retry_after=config['ADMISSION_MAX_RETRY_AFTER'])
+
+    def admit(self, client, lane='interactive'):
+        """wait in the calling thread until admitted, or raise Rejected; call release(client) when done"""
+        event = threading.Event()
+        waiter = self._enter(client, lane, event.set)
+        if waiter is not None:
+            started = monotonic()
+            event.wait(self.queue_timeout)
+            self._waited(waiter, started)
+
+    async def admit_async(self, client, lane='interactive'):
+        """admit for a coroutine, waiting without holding a thread"""
+        loop = asyncio.get_running_loop()
+        woken = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: woken.done() or woken.set_result(None))
+
+        waiter = self._enter(client, lane, wake)
+        if waiter is not None:
+            started = monotonic()
+            try:
+                await asyncio.wait_for(woken, self.queue_timeout)
+            except asyncio.TimeoutError:
+                pass
+            except asyncio.CancelledError:
+                self._abandon(waiter)
+                raise
+            self._waited(waiter, started)
+
+    def release(self, client):
+        """a request admitted for client has finished; hand its slot to the next waiter"""
+        now = monotonic()
+        with self._lock:
+            # time spent idle is not time spent draining, so measure from the busy period's start
+            since = max(self._last_release or 0, self._busy_since or 0)
+            if since:
+                interval = now - since
+                self._interval = interval if self._interval is None else \
+                    self.smoothing * interval + (1 - self.smoothing) * self._interval
+            self._last_release = now
+            self._running -= 1
+            self._leave(client)
+            waiter = self._next_waiter()
+        if waiter is not None:
+            waiter.wake()
+
+    @property
+    def drain_rate(self):
+        """requests completed per second while busy, smoothed; None until one has completed"""
+        interval = self._interval
+        if interval is None:
+            return None
+        return 1.0 / max(interval, 1e-6)
+
+    def stats(self):
+        with self._lock:
+            return {'running': self._running,
+                    'queued': {lane: len(queue) for lane, queue in self._queues.items()},
+                    'drain_rate': self.drain_rate}
+
+    def _enter(self, client, lane, wake):
+        """admit now (None), queue (a _Waiter) or raise Rejected"""
+        if lane not in self._queues:
+            raise ValueError("unknown lane {}".format(lane))
+        with self._lock:
+            if self.max_per_client is not None and self._per_client.get(client, 0) >= self.max_per_client:
+                raise self._rejected('client_limit', lane, self._per_client[client])
+            if self._running < self.max_concurrency and not self._queued_ahead(lane):
+                if not self._running:
+                    self._busy_since = monotonic()
+                self._running += 1
+                self._per_client[client] = self._per_client.get(client, 0) + 1
+                return None
+            queue = self._queues[lane]
+            if len(queue) >= self.max_queue[lane]:
+                raise self._rejected('queue_full', lane, self._queued_ahead(lane) + 1)
+            waiter = _Waiter(client, lane, wake)
+            queue.append(waiter)
+            self._per_client[client] = self._per_client.get(client, 0) + 1
+            ADMISSION_QUEUED.inc(lane=lane)
+            return waiter
+
+    def _waited(self, waiter, started):
+        ADMISSION_WAIT_SECONDS.observe(monotonic() - started, lane=waiter.lane)
+        with self._lock:
+            if waiter.granted:
+                return
+            self._queues[waiter.lane].remove(waiter)
+            ADMISSION_QUEUED.dec(lane=waiter.lane)
+            self._leave(waiter.client)
+            raise self._rejected('queue_timeout', waiter.lane, self._queued_ahead(waiter.lane) + 1)
+
+    def _abandon(self, waiter):
+        with self._lock:
+            if not waiter.granted:
+                self._queues[waiter.lane].remove(waiter)
+                ADMISSION_QUEUED.dec(lane=waiter.lane)
+                self._leave(waiter.client)
+                return
+        self.release(waiter.client)
+
+    def _next_waiter(self):
+        if self._running >= self.max_concurrency:
+            return None
+        for lane in LANES:
+            if self._queues[lane]:
+                waiter = self._queues[lane].popleft()
+                ADMISSION_QUEUED.dec(lane=lane)
+                waiter.granted = True
+                self._running += 1
+                return waiter
+        return None
+
+    def _leave(self, client):
+        count = self._per_client.get(client, 0) - 1
+        if count > 0:
+            self._per_client[client] = count
+        else:
+            self._per_client.pop(client, None)
+
+    def _queued_ahead(self, lane):
+        """requests that would be admitted before a new one in lane"""
+        queued = 0
+        for other in LANES:
+            queued += len(self._queues[other])
+            if other == lane:
+                return queued
+
+    def _rejected(self, reason, lane, completions_needed):
+        ADMISSION_REJECTED.inc(lane=lane, reason=reason)
+        return Rejected(reason, self.retry_after(completions_needed))
+
+    def retry_after(self, completions_needed):
+        """whole seconds until about completions_needed requests will have finished, at the current drain rate"""
+        rate = self.drain_rate
+        if rate is None:
+            return 1
+        return int(min(self.max_retry_after, max(1, math.ceil(completions_needed / rate))))
+
+
+def get_admission(app=None):
+    """the app's Admission, or None when admission control is disabled"""
+    return (app or current_app).extensions.get(EXTENSION_KEY)
+
+
+def client_id(headers, remote_addr, config):
+    return headers.get(config['ADMISSION_CLIENT_HEADER']) or remote_addr or 'unknown'
+
+
+def lane_for(headers, endpoint):
+    lane = (headers.get('X-Priority') or '').lower()
+    if lane in LANES:
+        return lane
+    return 'bulk' if endpoint in BULK_ENDPOINTS else 'interactive'
+
+
+def too_many_requests(e):
+    return Response("Too many requests: {}".format(e.reason), status=429,
+                    headers={'Retry-After': str(e.retry_after)})
+
+
+def _admit_request():
+    if request.method != 'POST' or request.blueprint not in BLUEPRINTS:
+        return None
+    admission = get_admission()
+    client = client_id(request.headers, request.remote_addr, current_app.config)
+    try:
+        admission.admit(client, lane_for(request.headers, request.endpoint))
+    except Rejected as e:
+        logger.info(Event('admission.rejected', endpoint=request.endpoint, reason=e.reason,
+                          retry_after=e.retry_after))
+        return too_many_requests(e)
+    g.admitted_client = client
+    return None
+
+
+def _release_request(error=None):
+    if 'admitted_client' in g:
+        get_admission().release(g.pop('admitted_client'))
+
+
+def init_app(app):
+    if not app.config.get('ADMISSION_ENABLED'):
+        return
+    app.extensions[EXTENSION_KEY] = Admission.from_config(app.config)
+    app.before_request(_admit_request)
+    # a streamed response keeps its slot until the stream is finished
+    app.teardown_request(_release_request)
@@ -1,5 +1,6 @@
 """Module for standardizing and combining annotations"""
 from operator import attrgetter
+from types import MappingProxyType
 
 # map hutchner labels to appriate comp med labels
 HUTCHNER_TYPE_MAP = {
@@ -12,6 +13,8 @@ HUTCHNER_TYPE_MAP = {
     "EMPLOYER": "PROFESSION"
 }
 TYPE_THRESHOLD = 0.5
+# shared by every annotation without a type map, instead of one empty dict each
+NO_TYPE_MAP = MappingProxyType({})
 
 class IncompatibleTypeException(Exception):
     def __init__(self, message, type_set):
@@ -48,10 +51,10 @@ class AnnotationFactory:
         return ann
 
     @staticmethod
-    def from_annotations(anns):
+    def from_annotations(anns, note_text=None):
         if not anns:
             raise ValueError("annotation list cannot be empty")
-        merged = MergedAnnotation()
+        merged = MergedAnnotation(note_text)
         for ann in anns:
             merged.add_annotation(ann)
         if merged.is_unknown_type:
@@ -62,10 +65,10 @@ class AnnotationFactory:
         return [merged]
 
     @staticmethod
-    def from_unsplittable_annotations(anns):
+    def from_unsplittable_annotations(anns, note_text=None):
         if not anns:
             raise ValueError("annotation list cannot be empty")
-        merged = MergedAnnotation()
+        merged = MergedAnnotation(note_text)
         for ann in anns:
             merged.add_annotation(ann)
 
@@ -73,6 +76,7 @@ class AnnotationFactory:
 
 
 class Annotation(object):
+    __slots__ = ('origin', 'start', 'end', 'score', 'text', '_type', 'type_map')
 
     def __init__(self, origin):
         self.origin = origin
@@ -81,7 +85,7 @@ class Annotation(object):
         self.score = None
         self.text = None
         self._type = None
-        self.type_map = {}
+        self.type_map = NO_TYPE_MAP
 
     @property
     def type(self):
@@ -110,22 +114,40 @@ class Annotation(object):
 
 
 class MergedAnnotation(Annotation):
-
-    def __init__(self):
+    """
+    The union of overlapping annotations. Merging only tracks offsets: with the note the
+    annotations came from, text is note_text[start:end]; without it, text is stitched
+    together from the source annotations' text when it is first read.
+    """
+    __slots__ = ('source_annotations', 'note_text', '_stitched_text', '_type_counts', '_parent_types',
+                 '_child_scores', '_child_annotations', '_top_child', '_max_score', '_child_start', '_child_end')
+
+    def __init__(self, note_text=None):
+        self.note_text = note_text
+        self._stitched_text = None
         super().__init__('merged')
         self.source_annotations = []
+        # aggregate state, maintained by add_annotation so that type/score resolution is O(1)
+        self._type_counts = {}
+        self._parent_types = set()
+        self._child_scores = {}
+        self._child_annotations = []
+        self._top_child = None
+        self._max_score = None
+        self._child_start = None
+        self._child_end = None
 
     @property
     def source_types(self):
-        return set([ann.type for ann in self.source_annotations])
+        return set(self._type_counts)
 
     @property
     def source_parent_types(self):
-        return set([ann.parent_type for ann in self.source_annotations])
+        return set(self._parent_types)
 
     @property
     def source_child_types(self):
-        return set([ann.type for ann in self.source_annotations if ann.type != ann.parent_type])
+        return set(self._child_scores)
 
     @property
     def source_scores(self):
@@ -137,18 +159,49 @@ class MergedAnnotation(Annotation):
 
     @property
     def source_child_annotations(self):
-        return [x for x in self.source_annotations if (x.type != x.parent_type)]
+        return list(self._child_annotations)
+
+    @property
+    def text(self):
+        if self.start is None:
+            return None
+        if self.note_text is not None:
+            return self.note_text[self.start:self.end]
+        if self._stitched_text is None:
+            self._stitched_text = self._stitch_text()
+        return self._stitched_text
+
+    @text.setter
+    def text(self, t):
+        pass
+
+    def _stitch_text(self):
+        # the text of the first annotation, extended by the part of each later one that
+        # lies outside the span so far; a gap between the runs of a subtype split is
+        # filled with spaces. Annotations come in start order from unionize_annotations,
+        # so this only appends.
+        anns = self.source_annotations
+        parts, start, end = [anns[0].text], anns[0].start, anns[0].end
+        for ann in anns[1:]:
+            if start <= ann.start:
+                if ann.start > end:
+                    parts.append(' ' * (ann.start - end))
+                parts.append(ann.text[max(0, end - ann.start):])
+            else:
+                parts = [ann.text, ''.join(parts)[(ann.end - start):]]
+            start = min(start, ann.start)
+            end = max(end, ann.end)
+        return ''.join(parts)
 
     @property
     def type(self):
-        if len(self.source_types) == 1:
+        if len(self._type_counts) == 1:
             return self.source_annotations[0].type
-        elif len(self.source_parent_types) == 1:
-            subtypes = [x for x in self.source_annotations if (x.type != x.parent_type)]
-            if len(self.source_child_types) == 1: #if there's only a single child type for the merged annotation
-                return subtypes[0].type #return that child type
+        elif len(self._parent_types) == 1:
+            if len(self._child_scores) == 1: #if there's only a single child type for the merged annotation
+                return self._child_annotations[0].type #return that child type
 
-            top = max(subtypes, key=attrgetter('score'))
+            top = self._top_child
             if top.score >= TYPE_THRESHOLD:
                 return top.type
             return self.source_annotations[0].parent_type
@@ -164,14 +217,13 @@ class MergedAnnotation(Annotation):
 
     @property
     def score(self):
-        if len(self.source_types) == 1:
-            return max([x.score for x in self.source_annotations])
-        elif len(self.source_parent_types) == 1:
-            subtypes = [x for x in self.source_annotations if (x.type != x.parent_type)]
-            top_score = max([x.score for x in subtypes])
+        if len(self._type_counts) == 1:
+            return self._max_score
+        elif len(self._parent_types) == 1:
+            top_score = self._top_child.score
             if top_score >= TYPE_THRESHOLD:
                 return top_score
-            return max([x.score for x in self.source_annotations])
+            return self._max_score
         return TYPE_THRESHOLD
 
     @score.setter
@@ -181,58 +233,69 @@ class MergedAnnotation(Annotation):
     def add_annotation(self, ann):
         if ann.empty():
             raise ValueError("new annotation cannot be empty")
-        elif self.empty():
-            self.text = ann.text
+        elif self.source_annotations and ((self.end < ann.start) or (self.start > ann.end)):
+            raise ValueError("annotation text must overlap")
+        self._extend(ann)
+
+    def _extend(self, ann):
+        if not self.source_annotations:
             self.start = ann.start
             self.end = ann.end
             self.type_map = ann.type_map
-        elif (self.end < ann.start) or (self.start > ann.end):
-            raise ValueError("annotation text must overlap")
         else:
-            if self.start <= ann.start:
-                self.text = self.text + ann.text[(self.end-ann.start):]
-            else:
-                self.text = ann.text + self.text[(ann.end-self.start):]
-            self.start = min([self.start, ann.start])
-            self.end = max([self.end, ann.end])
+            if ann.start < self.start:
+                self.start = ann.start
+            if ann.end > self.end:
+                self.end = ann.end
             self.type_map = self.type_map or ann.type_map
+        self._stitched_text = None
         self.source_annotations.append(ann)
+        self._update_aggregates(ann)
+
+    def _update_aggregates(self, ann):
+        ann_type = ann.type
+        parent_type = ann.parent_type
+        self._type_counts[ann_type] = self._type_counts.get(ann_type, 0) + 1
+        self._parent_types.add(parent_type)
+        if self._max_score is None or ann.score > self._max_score:
+            self._max_score = ann.score
+        if ann_type != parent_type:
+            self._child_annotations.append(ann)
+            best = self._child_scores.get(ann_type)
+            if best is None or ann.score > best:
+                self._child_scores[ann_type] = ann.score
+            # keep the first annotation with the highest score, as max() would
+            if self._top_child is None or ann.score > self._top_child.score:
+                self._top_child = ann
+            if self._child_start is None or ann.start < self._child_start:
+                self._child_start = ann.start
+            if self._child_end is None or ann.end > self._child_end:
+                self._child_end = ann.end
 
     def split_annotations_by_subtypes(self):
-        if (len(self.source_types) == 1) or (len(self.source_child_types) == 1):
+        """
+        [self], or for an annotation of one parent type with several child types whose child
+        annotations cover its whole span, one merged annotation per run of consecutive child
+        annotations of the same type. Runs are built in one pass; the tokens of a run need not
+        touch, so a run spans any whitespace between them.
+        """
+        if len(self._type_counts) == 1 or len(self._child_scores) == 1:
             return [self]
 
-        if len(self.source_parent_types) == 1:
-            if (self.start < min([ a.start for a in self.source_child_annotations]) or
-                    self.end > max([a.end for a in self.source_child_annotations])):
-                '''
-                If the merged annotation spans longer than the constituent child annotations, 
-                then return the unsplit, merged annotation
-                '''
+        if len(self._parent_types) == 1:
+            if self.start < self._child_start or self.end > self._child_end:
+                # the merged annotation spans longer than its child annotations; keep it whole
                 return [self]
-            subtypes = [x for x in self.source_annotations if (x.type != x.parent_type)]
             subtyped_annotations = []
-            running_annos = []
-            for anno in self.source_child_annotations:
+            run = run_type = None
+            for anno in self._child_annotations:
                 if anno.origin.lower() == 'compmed': #if we've made it this far, we are not interested in compmed annotations
                     continue
-
-                if not running_annos or anno.type == running_annos[-1].type:
-                    '''
-                    if we have a new annotation run, 
-                    OR 
-                    the current annotation type is the same as the previous
-                    add the current annotation to the run
-                    '''
-                    running_annos.append(anno)
-                    continue
-
-                #otherwise add the current running annotation to the run, and reset
-                subtyped_annotations.extend(AnnotationFactory.from_unsplittable_annotations(running_annos))
-                running_annos = [anno]
-
-            subtyped_annotations.extend(AnnotationFactory.from_unsplittable_annotations(running_annos))
-
+                if run is None or anno.type != run_type:
+                    run = MergedAnnotation(self.note_text)
+                    run_type = anno.type
+                    subtyped_annotations.append(run)
+                run._extend(anno)
             return subtyped_annotations
 
         raise IncompatibleTypeException("Cannot split by subtype for multiple parent types", self.source_parent_types)
@@ -247,20 +310,32 @@ class MergedAnnotation(Annotation):
         return data
 
 
-def unionize_annotations(annotations):
+def unionize_annotations(annotations, note_text=None):
+    """
+    Group overlapping annotations and merge each group.
+    Pass the note the annotations were found in as note_text to take merged text from it.
+
+    Annotations are swept in start order; an annotation joins the current
+    group when it starts before the furthest end seen so far in that group.
+    Spans that merely touch (one ends where the next starts) are kept apart.
+    Only annotations starting in [0, max end) are considered.
+    """
     if not annotations:
         return []
-    sorted_anns = sorted(annotations, key=lambda x: x.start)
+    max_end = max([ann.end for ann in annotations])
+    sorted_anns = sorted((ann for ann in annotations if 0 <= ann.start < max_end),
+                         key=attrgetter('start'))
     final_anns = []
     current_anns = []
-    for idx in range(0, max([ann.end for ann in annotations])):
-        # check if current annotations end at idx
-        if current_anns and all((ann.end <= idx) for ann in current_anns):
-            final_anns.extend(AnnotationFactory.from_annotations(current_anns))
+    current_end = None
+    for ann in sorted_anns:
+        if current_anns and ann.start >= current_end:
+            final_anns.extend(AnnotationFactory.from_annotations(current_anns, note_text))
             current_anns = []
-        # get all new annotations at idx
-        while sorted_anns and (sorted_anns[0].start == idx):
-            current_anns.append(sorted_anns.pop(0))
+        if not current_anns:
+            current_end = ann.end
+        current_anns.append(ann)
+        current_end = max(current_end, ann.end)
     if current_anns:
-        final_anns.extend(AnnotationFactory.from_annotations(current_anns))
+        final_anns.extend(AnnotationFactory.from_annotations(current_anns, note_text))
     return final_anns
@@ -0,0 +1,412 @@
+"""asyncio-native serving of the PHI endpoints, for an ASGI server
+
+    uvicorn --factory flaskphiid.asgi:create_asgi_app --host 0.0.0.0 --port 5000
+    python -m flaskphiid.asgi --bind 0.0.0.0:5000 --workers 4
+
+Under the WSGI server every request holds a thread for as long as Comprehend Medical takes
+to answer, so the number of slow upstream calls in flight is capped by the thread count.
+Here the single-note endpoints (/compmed, /compmed/phi, /hutchner, /hutchner/phi,
+/identifyphi and /identifyphi/redact) are coroutines: Comprehend Medical calls are awaited
+on aiobotocore (see AsyncCompMedClient), and HutchNER inference, which is CPU-bound, runs
+in the 'hutchner' thread pool (or its process pool) so it does not block the event loop.
+Routes, request bodies and JSON responses are the same as the Flask app's, and backend
+errors map to the same status codes; every backend call here is bounded by COMPMED_TIMEOUT
+or HUTCHNER_TIMEOUT (504 when it runs out). Without aiobotocore (or with COMPMED_ASYNC
+off, or a compmed stand-in from Backends.use) Comprehend Medical calls run in the
+'compmed' thread pool instead.
+
+Every other request (health checks, /metrics, batch, stream, cache and profiles, and a
+request asking to be profiled) is passed to the Flask app in a thread, with its response
+buffered, so /identifyphi/stream should stay on the WSGI server.
+Requires an ASGI server: pip install FlaskPHI_ID[asgi]
+"""
+import argparse
+import asyncio
+import json
+import logging
+from functools import partial
+from time import perf_counter
+
+from flaskphiid import create_app
+from flaskphiid.admission import Rejected, client_id, get_admission, lane_for, too_many_requests
+from flaskphiid.backends import get_backends
+from flaskphiid.cache import EXTENSION_KEY as CACHE_KEY
+from flaskphiid.chunking import chunk_text, merge_chunk_entities
+from flaskphiid.executor import get_executor, BackendError, BackendTimeout
+from flaskphiid.identifyphi import _hutchner_phi, lookup_note, store_note
+from flaskphiid.logconfig import Event
+from flaskphiid.metrics import (BACKEND_ERRORS, BACKEND_IN_FLIGHT, BACKEND_SECONDS, REQUEST_SECONDS,
+                                REQUESTS_IN_FLIGHT, STAGE_SECONDS)
+from flaskphiid.notes import (ENTITY_ERROR_MESSAGES, PHI_ERROR_MESSAGES, backend_error, backend_timeouts,
+                              entities_found, posted_note, redact_mode, redacted, serialize)
+
+logger = logging.getLogger(__name__)
+
+PHI_TYPES = ["PROTECTED_HEALTH_INFORMATION"]
+
+
+class _HTTPError(Exception):
+
+    def __init__(self, status, msg):
+        super(_HTTPError, self).__init__(msg)
+        self.status = status
+        self.msg = msg
+
+
+class ASGIApp(object):
+    """the ASGI callable; create it with create_asgi_app"""
+
+    def __init__(self, app):
+        self.app = app
+        self.config = app.config
+        self.backends = get_backends(app)
+        # path (without a trailing slash): (Flask endpoint name, handler)
+        self.routes = {
+            '/compmed': ('compmed.annotate', self.compmed),
+            '/compmed/phi': ('compmed.annotate_phi', partial(self.compmed, entityTypes=PHI_TYPES)),
+            '/hutchner': ('hutchner.annotate', self.hutchner),
+            '/hutchner/phi': ('hutchner.annotate_phi', partial(self.hutchner, entityTypes=PHI_TYPES)),
+            '/identifyphi': ('identifyphi.annotate', self.identify_phi),
+            '/identifyphi/redact': ('identifyphi.annotate_redact', self.redact),
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        route = self.routes.get(scope['path'].rstrip('/'))
+        if route is None or scope['method'] != 'POST' or self._profile_requested(scope):
+            return await self._call_flask(scope, send, await _read_body(receive))
+        endpoint, handler = route
+        body = await _read_body(receive)
+        try:
+            request = _parse_json(scope, body)
+        except _HTTPError as e:
+            return await _send_response(send, e.status, e.msg.encode('utf-8'), 'text/html; charset=utf-8')
+        if request.get('profile') and self.config.get('PROFILING_ENABLED'):
+            return await self._call_flask(scope, send, body)
+
+        admission = get_admission(self.app)
+        if admission is not None:
+            headers = _headers(scope)
+            client = client_id(headers, (scope.get('client') or ('',))[0], self.config)
+            try:
+                await admission.admit_async(client, lane_for(headers, endpoint))
+            except Rejected as e:
+                logger.info(Event('admission.rejected', endpoint=endpoint, reason=e.reason,
+                                  retry_after=e.retry_after))
+                response = too_many_requests(e)
+                return await _send_response(send, 429, response.get_data(), response.content_type,
+                                            [(b'retry-after', str(e.retry_after).encode('latin-1'))])
+        try:
+            await self._handle(scope, send, endpoint, handler, request)
+        finally:
+            if admission is not None:
+                admission.release(client)
+
+    async def _handle(self, scope, send, endpoint, handler, request):
+        metrics = self.config.get('METRICS_ENABLED')
+        if metrics:
+            REQUESTS_IN_FLIGHT.inc(endpoint=endpoint)
+        started = perf_counter()
+        status = 500
+        try:
+            try:
+                status, body = 200, await handler(request)
+                content_type = 'application/json'
+            except _HTTPError as e:
+                status, body, content_type = e.status, e.msg.encode('utf-8'), 'text/html; charset=utf-8'
+            except Exception:
+                logger.exception("Exception on {} [POST]".format(scope['path']))
+                status, body, content_type = 500, b'Internal Server Error', 'text/html; charset=utf-8'
+            await _send_response(send, status, body, content_type)
+        finally:
+            if metrics:
+                REQUEST_SECONDS.observe(perf_counter() - started, endpoint=endpoint, status=status)
+                REQUESTS_IN_FLIGHT.dec(endpoint=endpoint)
+
+    # endpoints
+
+    async def compmed(self, request, **kwargs):
+        note_text = _posted_note(request)
+        try:
+            with STAGE_SECONDS.time(stage='backends'):
+                entities = await self._compmed_entities(note_text, **kwargs)
+        except BackendError as e:
+            raise _backend_http_error(e, ENTITY_ERROR_MESSAGES)
+        return entities_found(logger, 'compmed', note_text, entities).encode('utf-8')
+
+    async def hutchner(self, request, **kwargs):
+        note_text = _posted_note(request)
+        entities = []
+        # as in the Flask view, only /hutchner/phi runs the model
+        if 'entityTypes' in kwargs:
+            try:
+                with STAGE_SECONDS.time(stage='backends'):
+                    prediction = await self._hutchner(self.backends.predictor, note_text)
+            except BackendError as e:
+                raise _backend_http_error(e, ENTITY_ERROR_MESSAGES)
+            entities = prediction.to_json()
+        return entities_found(logger, 'hutchner', note_text, entities).encode('utf-8')
+
+    async def identify_phi(self, request, **kwargs):
+        note_text = _posted_note(request)
+        try:
+            results = await self.phi_for_note(note_text, detailed=request.get('annotation_by_source', False),
+                                              **kwargs)
+        except BackendError as e:
+            raise _backend_http_error(e)
+        return serialize(results).encode('utf-8')
+
+    async def redact(self, request, **kwargs):
+        note_text = _posted_note(request)
+        mode, error = redact_mode(request)
+        if error is not None:
+            raise _HTTPError(error[1], error[0])
+        try:
+            results = await self.phi_for_note(note_text, **kwargs)
+        except BackendError as e:
+            raise _backend_http_error(e)
+        return redacted(note_text, results, mode, include_spans=request.get('include_spans', False)).encode('utf-8')
+
+    async def phi_for_note(self, note_text, detailed=False, **kwargs):
+        """identifyphi.phi_for_note, awaiting the backends instead of blocking a thread on them"""
+        cache = self.app.extensions.get(CACHE_KEY)
+        key, results = lookup_note(cache, note_text, detailed=detailed, **kwargs)
+        if results is not None:
+            return results
+        with STAGE_SECONDS.time(stage='backends'):
+            compmed_phi, hutchner_phi = await self._get_phi(note_text, **kwargs)
+        return store_note(cache, key, note_text, compmed_phi, hutchner_phi, detailed=detailed)
+
+    # backends
+
+    async def _get_phi(self, note_text, **kwargs):
+        """Comprehend Medical and HutchNER concurrently; the first failure cancels the other"""
+        reducer = self.config['HUTCHNER_SPAN_REDUCER'] if self.config['HUTCHNER_AGGREGATE_SPANS'] else None
+        predict = self.backends.predictor
+        tasks = [asyncio.ensure_future(self._compmed_entities(note_text, entityTypes=PHI_TYPES)),
+                 asyncio.ensure_future(self._hutchner(partial(_hutchner_phi, predict), note_text,
+                                                      reducer, **kwargs))]
+        try:
+            compmed_phi, hutchner_phi = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        return compmed_phi, hutchner_phi
+
+    async def _compmed_entities(self, note_text, **kwargs):
+        """Comprehend Medical entities (PHI with entityTypes=PHI_TYPES), in windows when the note is long"""
+        windows = chunk_text(note_text, self.config['COMPMED_MAX_CHARS'], self.config['COMPMED_CHUNK_OVERLAP'])
+        calls = asyncio.gather(*[self._compmed_call(chunk, **kwargs) for offset, chunk in windows])
+        results = await _within('compmed', calls, backend_timeouts(self.config)['compmed'])
+        if len(windows) == 1:
+            return results[0]
+        return merge_chunk_entities(note_text, windows, results)
+
+    async def _compmed_call(self, chunk, entityTypes=None, **kwargs):
+        client = self.backends.async_compmed
+        if client is not None:
+            if entityTypes == PHI_TYPES:
+                call = client.get_phi(chunk)
+            else:
+                call = client.get_entities(chunk, entityTypes=entityTypes, **kwargs)
+        else:
+            client = self.backends.compmed
+            if entityTypes == PHI_TYPES:
+                fn = partial(client.get_phi, chunk)
+            else:
+                fn = partial(client.get_entities, chunk, entityTypes=entityTypes, **kwargs)
+            call = self._in_thread('compmed', self.config.get('COMPMED_POOL_SIZE'), fn)
+        return await _timed('compmed', call)
+
+    async def _hutchner(self, fn, note_text, *args, **kwargs):
+        call = self._in_thread('hutchner', None, partial(fn, note_text, *args, **kwargs))
+        return await _within('hutchner', _timed('hutchner', call), backend_timeouts(self.config)['hutchner'])
+
+    def _in_thread(self, name, max_workers, fn):
+        """run fn in the thread pool called name, as an awaitable"""
+        executor = get_executor(max_workers or self.config.get('BACKEND_MAX_WORKERS'), name=name)
+        return asyncio.get_running_loop().run_in_executor(executor, fn)
+
+    # everything else
+
+    def _profile_requested(self, scope):
+        if not self.config.get('PROFILING_ENABLED'):
+            return False
+        return _headers(scope).get('X-Profile', '').lower() in ('1', 'true', 'yes')
+
+    async def _call_flask(self, scope, send, body):
+        environ = _wsgi_environ(scope, body)
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = headers
+
+        def run():
+            result = self.app(environ, start_response)
+            try:
+                return b''.join(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+
+        content = await self._in_thread('wsgi', None, run)
+        await send({'type': 'http.response.start', 'status': response['status'],
+                    'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                for name, value in response['headers']]})
+        await send({'type': 'http.response.body', 'body': content})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                client = self.backends.async_compmed
+                if client is not None:
+                    await client.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def _posted_note(request):
+    note_text, error = posted_note(request)
+    if error is not None:
+        raise _HTTPError(error[1], error[0])
+    return note_text
+
+
+def _parse_json(scope, body):
+    """the posted JSON object, with the errors Flask's request.json gives"""
+    content_type = _headers(scope).get('Content-Type', '').split(';')[0].strip().lower()
+    if content_type != 'application/json' and not content_type.endswith('+json'):
+        raise _HTTPError(415, "Unsupported Media Type")
+    try:
+        request = json.loads(body)
+    except ValueError:
+        raise _HTTPError(400, "Bad Request")
+    if not isinstance(request, dict):
+        raise _HTTPError(400, "Bad Request")
+    return request
+
+
+def _backend_http_error(e, messages=PHI_ERROR_MESSAGES):
+    error = backend_error(e, messages)
+    if error is None:
+        raise e.error
+    msg, status = error
+    return _HTTPError(status, msg)
+
+
+async def _within(backend, awaitable, timeout):
+    """await a backend call, raising its failure as BackendError and a timeout as BackendTimeout"""
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        raise BackendTimeout(backend, timeout)
+    except BackendError:
+        raise
+    except Exception as e:
+        raise BackendError(backend, e)
+
+
+async def _timed(backend, awaitable):
+    """metrics.timed_backend for an awaited call"""
+    BACKEND_IN_FLIGHT.inc(backend=backend)
+    started = perf_counter()
+    try:
+        return await awaitable
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        BACKEND_ERRORS.inc(backend=backend, error=type(e).__name__)
+        raise
+    finally:
+        BACKEND_SECONDS.observe(perf_counter() - started, backend=backend)
+        BACKEND_IN_FLIGHT.dec(backend=backend)
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            break
+    return b''.join(chunks)
+
+
+def _headers(scope):
+    """the request headers as a werkzeug Headers, so lookups ignore case as Flask's do"""
+    from werkzeug.datastructures import Headers
+    return Headers([(name.decode('latin-1'), value.decode('latin-1')) for name, value in scope.get('headers') or []])
+
+
+async def _send_response(send, status, body, content_type, headers=()):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', content_type.encode('latin-1')),
+                            (b'content-length', str(len(body)).encode('latin-1'))] + list(headers)})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _wsgi_environ(scope, body):
+    import io
+    import sys
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers') or []:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = 'HTTP_' + name
+            environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+def create_asgi_app(flask_app=None):
+    """an ASGI app serving flask_app (by default create_app()) with the async endpoints"""
+    return ASGIApp(flask_app or create_app())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve flaskphiid with uvicorn")
+    parser.add_argument('-b', '--bind', default='127.0.0.1:5000')
+    parser.add_argument('-w', '--workers', type=int, default=1)
+    args = parser.parse_args(argv)
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit("flaskphiid.asgi requires uvicorn: pip install FlaskPHI_ID[asgi]")
+    host, _, port = args.bind.rpartition(':')
+    uvicorn.run('flaskphiid.asgi:create_asgi_app', factory=True, host=host or '127.0.0.1', port=int(port),
+                workers=args.workers, lifespan='on')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+"""App-scoped, lazily created PHI backends
+
+Nothing here is built at import time. Each app gets a Backends object in
+app.extensions; the Comprehend Medical client and the HutchNER model (or its worker
+process pool) are created on first use, or up front by warm_up(). /readyz reports
+ready once both exist.
+"""
+import logging
+import threading
+from time import monotonic
+
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+EXTENSION_KEY = 'backends'
+
+
+class Backends(object):
+
+    def __init__(self, app):
+        self.config = app.config
+        self._lock = threading.RLock()
+        self._compmed = None
+        self._async_compmed = None
+        self._hutchner = None
+        self._coalescer = None
+        self.warm_up_seconds = None
+
+    @property
+    def compmed(self):
+        if self._compmed is None:
+            with self._lock:
+                if self._compmed is None:
+                    self._compmed = self._load_compmed()
+        return self._compmed
+
+    def _load_compmed(self):
+        from flaskphiid.compmed_client import CompMedClient
+        client = CompMedClient()
+        client.configure_from(self.config)
+        return client
+
+    def _warm_up_compmed(self):
+        with self._lock:
+            client = self._compmed or self._load_compmed()
+            # build the boto3 client before publishing, so a failure leaves compmed unset rather than half made
+            if hasattr(client, 'connected'):
+                client.client
+            self._compmed = client
+
+    @property
+    def async_compmed(self):
+        """
+        an AsyncCompMedClient for the ASGI app when COMPMED_ASYNC is set and aiobotocore is
+        installed, otherwise None: callers then run compmed's blocking calls in threads
+        """
+        if self._async_compmed is None:
+            with self._lock:
+                if self._async_compmed is None:
+                    self._async_compmed = self._load_async_compmed() or False
+        return self._async_compmed or None
+
+    def _load_async_compmed(self):
+        if not self.config.get('COMPMED_ASYNC'):
+            return None
+        try:
+            import aiobotocore
+        except ImportError:
+            logger.info("aiobotocore is not installed; Comprehend Medical calls run in threads")
+            return None
+        from flaskphiid.compmed_client import AsyncCompMedClient
+        client = AsyncCompMedClient()
+        client.configure_from(self.config)
+        return client
+
+    @property
+    def hutchner(self):
+        """the HutchNER model, or a HutchNERProcessPool when HUTCHNER_PROCESSES is set; both have predict()"""
+        if self._hutchner is None:
+            with self._lock:
+                if self._hutchner is None:
+                    self._hutchner = self._load_hutchner()
+        return self._hutchner
+
+    @property
+    def coalescer(self):
+        """a Coalescer batching predictions for the HutchNER backend (see flaskphiid.coalescer)"""
+        if self._coalescer is None:
+            with self._lock:
+                if self._coalescer is None:
+                    from flaskphiid.coalescer import Coalescer, predict_batch
+                    hutchner = self.hutchner
+                    self._coalescer = Coalescer(
+                        lambda note_texts, **kwargs: predict_batch(hutchner, note_texts, **kwargs),
+                        max_batch_size=self.config['HUTCHNER_BATCH_MAX_SIZE'],
+                        max_wait=self.config['HUTCHNER_BATCH_MAX_WAIT_MS'] / 1000.0,
+                        dispatchers=self.config['HUTCHNER_PROCESSES'] or 1)
+        return self._coalescer
+
+    @property
+    def predictor(self):
+        """the HutchNER predict callable: through the coalescer when HUTCHNER_COALESCE is set"""
+        if self.config.get('HUTCHNER_COALESCE'):
+            return self.coalescer.predict
+        return self.hutchner.predict
+
+    def _load_hutchner(self):
+        from flaskphiid.hutchner_pool import DEFAULT_CLUSTERS_ATTRIBUTE, DEFAULT_MODEL_FACTORY
+        started = monotonic()
+        model_factory = self.config.get('HUTCHNER_MODEL_FACTORY', DEFAULT_MODEL_FACTORY)
+        clusters_attribute = self.config.get('HUTCHNER_CLUSTERS_ATTRIBUTE', DEFAULT_CLUSTERS_ATTRIBUTE)
+        if self.config['HUTCHNER_PROCESSES']:
+            from flaskphiid.hutchner_pool import HutchNERProcessPool
+            # each worker process loads its own model
+            hutchner = HutchNERProcessPool(self.config['HUTCHNER_PROCESSES'],
+                                           model_path=self.config['HUTCHNER_MODEL'],
+                                           clusters_path=self.config['CLINIC_NOTE_CLUSTERS'],
+                                           queue_size=self.config.get('HUTCHNER_PROCESS_QUEUE'),
+                                           queue_timeout=self.config.get('HUTCHNER_TIMEOUT'),
+                                           model_factory=model_factory,
+                                           clusters_attribute=clusters_attribute)
+            hutchner.warm_up()
+            logger.info("HutchNER inference runs in {} worker processes".format(self.config['HUTCHNER_PROCESSES']))
+        else:
+            from flaskphiid.hutchner_pool import load_hutchner
+            hutchner = load_hutchner(model_factory, self.config['HUTCHNER_MODEL'],
+                                     self.config['CLINIC_NOTE_CLUSTERS'], clusters_attribute)
+        logger.info("HutchNER loaded in {:.2f}s".format(monotonic() - started))
+        return hutchner
+
+    def use(self, compmed=None, hutchner=None, async_compmed=None):
+        """
+        replace backends with stand-ins that have the same calls, e.g. for benchmarks;
+        a compmed stand-in is also used by the ASGI app unless an async_compmed is given
+        """
+        with self._lock:
+            if compmed is not None:
+                self._compmed = compmed
+                self._async_compmed = False
+            if async_compmed is not None:
+                self._async_compmed = async_compmed
+            if hutchner is not None:
+                self._hutchner = hutchner
+                self._shutdown_coalescer()
+
+    @property
+    def status(self):
+        # a CompMedClient drops its boto3 client when reconfigured; stand-ins are always ready
+        compmed = self._compmed
+        return {'compmed': compmed is not None and getattr(compmed, 'connected', True),
+                'hutchner': self._hutchner is not None}
+
+    @property
+    def ready(self):
+        return all(self.status.values())
+
+    def warm_up(self):
+        """
+        create every backend now rather than on the first request; a backend that fails is
+        logged and left to load on first use, without keeping the others from loading
+        """
+        started = monotonic()
+        for name, load in (('compmed', self._warm_up_compmed), ('hutchner', lambda: self.hutchner)):
+            try:
+                load()
+            except Exception:
+                logger.exception("Warming up {} failed; it will load on first use".format(name))
+        self.warm_up_seconds = monotonic() - started
+        logger.info("Backends warmed up in {:.2f}s: {}".format(self.warm_up_seconds, self.status))
+
+    def after_fork(self):
+        """
+        call in a child process forked after warm-up: the in-process model is kept, shared
+        copy-on-write with the parent, but the Comprehend Medical client's connections and
+        a HutchNER process pool belong to the parent and are created again on next use
+        """
+        with self._lock:
+            self._compmed = None
+            self._async_compmed = None
+            # the coalescer's dispatcher threads were not carried over by the fork
+            self._coalescer = None
+            if self._hutchner is not None and hasattr(self._hutchner, 'shutdown'):
+                self._hutchner = None
+
+    def shutdown(self):
+        with self._lock:
+            self._shutdown_coalescer()
+            if self._hutchner is not None and hasattr(self._hutchner, 'shutdown'):
+                self._hutchner.shutdown()
+            self._hutchner = None
+
+
+    def _shutdown_coalescer(self):
+        if self._coalescer is not None:
+            self._coalescer.shutdown()
+            self._coalescer = None
+
+
+def init_app(app):
+    app.extensions[EXTENSION_KEY] = Backends(app)
+
+
+def get_backends(app=None):
+    return (app or current_app).extensions[EXTENSION_KEY]
+
+
+def warm_up(app):
+    get_backends(app).warm_up()
+
+
+def start_warm_up(app):
+    """warm up the app's backends in a daemon thread; returns the thread"""
+    def run():
+        try:
+            warm_up(app)
+        except Exception:
+            logger.exception("Backend warm-up failed; backends will load on first use")
+    thread = threading.Thread(target=run, name='warm-up', daemon=True)
+    thread.start()
+    return thread
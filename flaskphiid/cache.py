@@ -0,0 +1,166 @@
+"""Content-addressed cache of identify_phi results
+
+Results are keyed on a hash of the note text plus a hash of the backend versions and
+request options, held in a memory-bounded LRU, and optionally persisted to the SQLite
+file configured as DATABASE. Cached values contain the PHI found in the note, so the
+on-disk tier should only be enabled where the instance folder is protected accordingly.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from time import time
+
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+EXTENSION_KEY = 'result_cache'
+
+
+class ResultCache(object):
+
+    def __init__(self, max_bytes, ttl=None, db_path=None, version=''):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.db_path = db_path
+        self.version = version
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        if db_path:
+            with self._db() as db:
+                db.execute("CREATE TABLE IF NOT EXISTS result_cache "
+                           "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)")
+                db.execute("DELETE FROM result_cache WHERE expires_at IS NOT NULL AND expires_at <= ?", (time(),))
+
+    @staticmethod
+    def note_digest(note_text):
+        return hashlib.sha256(note_text.encode('utf-8')).hexdigest()
+
+    def key(self, note_text, **options):
+        """'<note digest>:<digest of backend versions and options>'"""
+        options_blob = json.dumps([self.version, options], sort_keys=True, default=str)
+        return "{}:{}".format(self.note_digest(note_text),
+                              hashlib.sha256(options_blob.encode('utf-8')).hexdigest()[:32])
+
+    def get(self, key):
+        now = time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at, _ = entry
+                if expires_at is None or expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+        if self.db_path:
+            row = self._db().execute("SELECT value, expires_at FROM result_cache WHERE key = ?", (key,)).fetchone()
+            if row is not None and (row[1] is None or row[1] > now):
+                with self._lock:
+                    self.hits += 1
+                    self.disk_hits += 1
+                    self._store(key, row[0], row[1])
+                return row[0]
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, value):
+        expires_at = time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._store(key, value, expires_at)
+        if self.db_path:
+            with self._db() as db:
+                db.execute("INSERT OR REPLACE INTO result_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                           (key, value, expires_at))
+
+    def invalidate_note(self, note_text):
+        """drop every cached result for note_text, whatever the options"""
+        prefix = self.note_digest(note_text) + ':'
+        with self._lock:
+            for key in [k for k in self._entries if k.startswith(prefix)]:
+                self._remove(key)
+        if self.db_path:
+            with self._db() as db:
+                db.execute("DELETE FROM result_cache WHERE key LIKE ?", (prefix + '%',))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        if self.db_path:
+            with self._db() as db:
+                db.execute("DELETE FROM result_cache")
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'disk_hits': self.disk_hits,
+                    'entries': len(self._entries), 'bytes': self._bytes, 'max_bytes': self.max_bytes}
+
+    def after_fork(self):
+        """call in a forked child; SQLite connections must not be shared with the parent"""
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _store(self, key, value, expires_at):
+        # max_bytes bounds the UTF-8 size, which is more than len() for non-ASCII notes
+        size = len(value.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, expires_at, size)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def _db(self):
+        # sqlite connections cannot be shared between threads
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.db_path, timeout=5)
+            self._local.db = db
+        return db
+
+
+def backend_version(app):
+    """anything that changes what the backends return for the same note"""
+    version = {'version': app.config.get('RESULT_CACHE_VERSION'),
+               'compmed_max_chars': app.config.get('COMPMED_MAX_CHARS'),
+               'compmed_chunk_overlap': app.config.get('COMPMED_CHUNK_OVERLAP'),
+               'hutchner_aggregate_spans': app.config.get('HUTCHNER_AGGREGATE_SPANS'),
+               'hutchner_span_reducer': app.config.get('HUTCHNER_SPAN_REDUCER')}
+    for name in ('HUTCHNER_MODEL', 'CLINIC_NOTE_CLUSTERS'):
+        path = app.config.get(name)
+        version[name] = [path, os.path.getmtime(path) if path and os.path.exists(path) else None]
+    return json.dumps(version, sort_keys=True)
+
+
+def init_app(app):
+    if not app.config.get('RESULT_CACHE_ENABLED'):
+        return
+    db_path = app.config['DATABASE'] if app.config.get('RESULT_CACHE_PERSIST') else None
+    app.extensions[EXTENSION_KEY] = ResultCache(max_bytes=app.config['RESULT_CACHE_MAX_BYTES'],
+                                                ttl=app.config.get('RESULT_CACHE_TTL'),
+                                                db_path=db_path,
+                                                version=backend_version(app))
+    logger.info("Result cache enabled ({} bytes in memory, persisted: {})".format(
+        app.config['RESULT_CACHE_MAX_BYTES'], bool(db_path)))
+
+
+def get_cache():
+    """the current app's ResultCache, or None when caching is disabled"""
+    return current_app.extensions.get(EXTENSION_KEY)
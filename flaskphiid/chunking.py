@@ -0,0 +1,110 @@
+"""Split long notes into overlapping windows for size-limited backends, and merge the results back"""
+import re
+
+WHITESPACE = re.compile(r'\s+')
+# preferred cut points, best first
+BOUNDARY_PATTERNS = [
+    re.compile(r'\n\s*\n'),             # paragraph break
+    re.compile(r'[.!?]["\')\]]*\s+'),   # end of sentence
+    re.compile(r'\n'),                  # line break
+    WHITESPACE,
+]
+
+
+def chunk_text(text, max_chars, overlap=0):
+    """
+    Split text into windows of at most max_chars characters, returned as a list of
+    (offset, chunk) pairs. Windows end on the best boundary found in their second half
+    (paragraph, sentence, line, then whitespace) and each window after the first starts
+    about `overlap` characters before the previous one ended, at a word boundary.
+    """
+    if max_chars <= 0:
+        raise ValueError("max_chars must be positive")
+    if len(text) <= max_chars:
+        return [(0, text)]
+    overlap = max(0, min(overlap, max_chars // 2))
+
+    windows = []
+    start = 0
+    while True:
+        end = start + max_chars
+        if end >= len(text):
+            windows.append((start, text[start:]))
+            return windows
+        cut = _find_cut(text, start + max_chars // 2, end)
+        windows.append((start, text[start:cut]))
+        next_start = _word_start(text, cut - overlap, cut)
+        start = next_start if next_start > start else cut
+
+
+def _find_cut(text, lower, upper):
+    """offset in (lower, upper] just after the best boundary, or upper if there is none"""
+    for pattern in BOUNDARY_PATTERNS:
+        cut = None
+        for match in pattern.finditer(text, lower, upper):
+            cut = match.end()
+        if cut is not None and lower < cut <= upper:
+            return cut
+    return upper
+
+
+def _word_start(text, lower, upper):
+    """first offset in [lower, upper] that starts a word"""
+    lower = max(lower, 0)
+    if lower == 0 or text[lower - 1].isspace():
+        return lower
+    match = WHITESPACE.search(text, lower, upper)
+    return match.end() if match else upper
+
+
+def _remap(entity, offset):
+    entity = dict(entity)
+    for key in ('BeginOffset', 'EndOffset'):
+        if entity.get(key) is not None:
+            entity[key] += offset
+    if entity.get('Attributes'):
+        entity['Attributes'] = [_remap(attribute, offset) for attribute in entity['Attributes']]
+    return entity
+
+
+def merge_chunk_entities(note_text, windows, results):
+    """
+    Combine per-window Comprehend Medical entities into one list for the whole note.
+    Offsets are shifted by each window's offset. An entity found in the overlap between
+    two windows that has the same Type as, and overlaps, an entity from the previous
+    window is merged into it: the span becomes their union and the score their maximum.
+    """
+    if len(windows) == 1:
+        return results[0]
+
+    merged = []
+    previous = []
+    for idx, ((offset, chunk), entities) in enumerate(zip(windows, results)):
+        current = []
+        prev_end = windows[idx - 1][0] + len(windows[idx - 1][1]) if idx else None
+        for entity in sorted((_remap(e, offset) for e in entities), key=lambda e: e.get('BeginOffset')):
+            duplicate = None
+            if prev_end is not None and entity['BeginOffset'] < prev_end:
+                duplicate = next((p for p in previous
+                                  if p.get('Type') == entity.get('Type') and
+                                  p['BeginOffset'] < entity['EndOffset'] and
+                                  entity['BeginOffset'] < p['EndOffset']), None)
+            if duplicate is None:
+                merged.append(entity)
+                current.append(entity)
+                continue
+            duplicate['BeginOffset'] = min(duplicate['BeginOffset'], entity['BeginOffset'])
+            duplicate['EndOffset'] = max(duplicate['EndOffset'], entity['EndOffset'])
+            duplicate['Text'] = note_text[duplicate['BeginOffset']:duplicate['EndOffset']]
+            if entity.get('Score') is not None and entity['Score'] > (duplicate.get('Score') or 0):
+                duplicate['Score'] = entity['Score']
+            current.append(duplicate)
+        # only entities reaching past the start of the next window can be duplicated there
+        next_start = windows[idx + 1][0] if idx + 1 < len(windows) else None
+        previous = [e for e in current if next_start is not None and e['EndOffset'] > next_start]
+
+    merged.sort(key=lambda e: e['BeginOffset'])
+    for idx, entity in enumerate(merged):
+        if 'Id' in entity:
+            entity['Id'] = idx
+    return merged
@@ -0,0 +1,125 @@
+"""A read-only word -> Brown cluster mapping stored in a memory-mapped file
+
+load_clusters unpickles the cluster table into a dict in every process that loads
+HutchNER, and touching the dict's objects defeats copy-on-write sharing after a fork.
+A MappedClusterTable reads the same mapping from a file built once with
+
+    python -m flaskphiid.cluster_table clusters.pkl clusters.tbl
+
+so every process maps the same page-cache pages and keeps almost nothing private.
+File layout (little-endian): magic, entry count, value kind, then (count + 1) key
+offsets, (count + 1) value offsets, the UTF-8 keys in sorted order and their values.
+"""
+import mmap
+import os
+import pickle
+import struct
+import sys
+from collections.abc import Mapping
+
+MAGIC = b'FPCLUST1'
+HEADER = struct.Struct('<8sQB7x')
+OFFSET = struct.Struct('<Q')
+STR_VALUES, INT_VALUES = 0, 1
+
+
+def is_cluster_table(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def write_cluster_table(clusters, path):
+    """write a {word: cluster} mapping (str or int clusters) to path, atomically"""
+    if not isinstance(clusters, Mapping):
+        raise ValueError("expected a mapping of words to clusters, got {}".format(type(clusters).__name__))
+    items = sorted((str(word).encode('utf-8'), cluster) for word, cluster in clusters.items())
+    kind = INT_VALUES if items and all(isinstance(v, int) for _, v in items) else STR_VALUES
+    keys = [key for key, _ in items]
+    values = [str(value).encode('utf-8') for _, value in items]
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(items), kind))
+        for blobs in (keys, values):
+            offset = 0
+            f.write(OFFSET.pack(offset))
+            for blob in blobs:
+                offset += len(blob)
+                f.write(OFFSET.pack(offset))
+        for blobs in (keys, values):
+            f.write(b''.join(blobs))
+    os.replace(tmp_path, path)
+
+
+class MappedClusterTable(Mapping):
+    """{word: cluster} backed by a file written by write_cluster_table; lookups are a binary search"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count, kind = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError("{} is not a cluster table".format(path))
+        self._convert = int if kind == INT_VALUES else str
+        self._key_offsets = HEADER.size
+        self._value_offsets = self._key_offsets + (self._count + 1) * OFFSET.size
+        self._keys = self._value_offsets + (self._count + 1) * OFFSET.size
+        self._values = self._keys + self._offset(self._key_offsets, self._count)
+
+    def _offset(self, table, i):
+        return OFFSET.unpack_from(self._map, table + i * OFFSET.size)[0]
+
+    def _key(self, i):
+        return self._map[self._keys + self._offset(self._key_offsets, i):
+                         self._keys + self._offset(self._key_offsets, i + 1)]
+
+    def _value(self, i):
+        blob = self._map[self._values + self._offset(self._value_offsets, i):
+                         self._values + self._offset(self._value_offsets, i + 1)]
+        return self._convert(blob.decode('utf-8'))
+
+    def _find(self, word):
+        if not isinstance(word, str):
+            return -1
+        key = word.encode('utf-8')
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < self._count and self._key(lo) == key else -1
+
+    def __getitem__(self, word):
+        i = self._find(word)
+        if i < 0:
+            raise KeyError(word)
+        return self._value(i)
+
+    def __contains__(self, word):
+        return self._find(word) >= 0
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self._key(i).decode('utf-8')
+
+    def close(self):
+        self._map.close()
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 2:
+        sys.exit("usage: python -m flaskphiid.cluster_table CLUSTERS_PICKLE OUTPUT")
+    with open(argv[0], 'rb') as f:
+        clusters = pickle.load(f)
+    write_cluster_table(clusters, argv[1])
+    print("wrote {} clusters to {}".format(len(clusters), argv[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""Coalesce concurrent HutchNER predictions into batched inference calls
+
+Each HutchNER predict call has a fixed cost besides the note itself (feature extractor
+setup, model dispatch, and with HUTCHNER_PROCESSES a round trip to a worker process).
+With HUTCHNER_COALESCE set, predictions from concurrent /hutchner and /identifyphi
+requests go to a Coalescer instead: it holds them for up to HUTCHNER_BATCH_MAX_WAIT_MS,
+or until HUTCHNER_BATCH_MAX_SIZE notes are waiting, runs them as one batch and hands each
+caller its own prediction. A lone request waits at most the max wait; a full batch goes
+at once. Batch sizes and the time notes spend waiting are exported as metrics.
+"""
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+from time import monotonic
+
+from flaskphiid.logconfig import Event
+from flaskphiid.metrics import HUTCHNER_BATCH_SIZE, HUTCHNER_QUEUE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+def predict_batch(model, note_texts, **kwargs):
+    """a list of predictions for note_texts: the model's own predict_batch if it has one, else one predict per note"""
+    batched = getattr(model, 'predict_batch', None)
+    if batched is not None:
+        return batched(note_texts, **kwargs)
+    return [model.predict(note_text, **kwargs) for note_text in note_texts]
+
+
+class _Waiting(object):
+    __slots__ = ('note_text', 'kwargs', 'key', 'future', 'enqueued')
+
+    def __init__(self, note_text, kwargs):
+        self.note_text = note_text
+        self.kwargs = kwargs
+        # only notes predicted with the same options can share a batch
+        self.key = tuple(sorted((name, repr(value)) for name, value in kwargs.items()))
+        self.future = Future()
+        self.enqueued = monotonic()
+
+
+class Coalescer(object):
+    """
+    Collects predict calls and runs them through predict_batch(note_texts, **kwargs) in
+    batches of up to max_batch_size, waiting at most max_wait seconds for a batch to fill.
+    `dispatchers` threads each run one batch at a time, so up to that many batches are in
+    flight (one per HutchNER worker process is a good number). If a batch is rejected as bad
+    input (a ValueError), its notes are retried one by one so that one bad note only fails
+    its own request; any other error fails the whole batch. A batch that comes back with a
+    different number of predictions than notes is also retried one by one.
+    """
+
+    def __init__(self, predict_batch, max_batch_size=16, max_wait=0.005, dispatchers=1):
+        self.predict_batch = predict_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.dispatchers = max(1, dispatchers)
+        self._waiting = deque()
+        self._ready = threading.Condition(threading.Lock())
+        self._threads = []
+        self._closed = False
+
+    def submit(self, note_text, **kwargs):
+        """queue a note for the next batch; returns a future of its prediction"""
+        waiting = _Waiting(note_text, kwargs)
+        with self._ready:
+            if self._closed:
+                raise RuntimeError("coalescer is shut down")
+            if not self._threads:
+                self._start()
+            self._waiting.append(waiting)
+            self._ready.notify()
+        return waiting.future
+
+    def predict(self, note_text, **kwargs):
+        return self.submit(note_text, **kwargs).result()
+
+    def _start(self):
+        for i in range(self.dispatchers):
+            thread = threading.Thread(target=self._dispatch, name='hutchner-coalescer-{}'.format(i), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _dispatch(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self._run(batch)
+
+    def _next_batch(self):
+        """wait for the oldest note's max wait to run out or for a full batch, and take it"""
+        with self._ready:
+            while True:
+                while not self._waiting and not self._closed:
+                    self._ready.wait()
+                if not self._waiting:
+                    return None
+                oldest = self._waiting[0]
+                remaining = oldest.enqueued + self.max_wait - monotonic()
+                if remaining <= 0 or self._closed or len(self._waiting) >= self.max_batch_size:
+                    break
+                self._ready.wait(remaining)
+            batch = []
+            skipped = deque()
+            while self._waiting and len(batch) < self.max_batch_size:
+                waiting = self._waiting.popleft()
+                (batch if waiting.key == oldest.key else skipped).append(waiting)
+            # notes with other options keep their place at the front of the queue
+            self._waiting.extendleft(reversed(skipped))
+            if self._waiting:
+                self._ready.notify()
+            return batch
+
+    def _run(self, batch):
+        started = monotonic()
+        HUTCHNER_BATCH_SIZE.observe(len(batch))
+        for waiting in batch:
+            HUTCHNER_QUEUE_SECONDS.observe(started - waiting.enqueued)
+        batch = [waiting for waiting in batch if waiting.future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            predictions = self.predict_batch([waiting.note_text for waiting in batch], **batch[0].kwargs)
+        except Exception as e:
+            if len(batch) == 1 or not isinstance(e, ValueError):
+                for waiting in batch:
+                    waiting.future.set_exception(e)
+                return
+            logger.info(Event('hutchner.batch_failed', notes=len(batch), error=e))
+            return self._one_by_one(batch)
+        if len(predictions) != len(batch):
+            # which prediction belongs to which note is unknowable, so predict each on its own
+            logger.warning(Event('hutchner.batch_mismatch', notes=len(batch), predictions=len(predictions)))
+            return self._one_by_one(batch)
+        for waiting, prediction in zip(batch, predictions):
+            waiting.future.set_result(prediction)
+
+    def _one_by_one(self, batch):
+        for waiting in batch:
+            try:
+                predictions = self.predict_batch([waiting.note_text], **waiting.kwargs)
+                if len(predictions) != 1:
+                    raise ValueError("expected 1 prediction, got {}".format(len(predictions)))
+                waiting.future.set_result(predictions[0])
+            except Exception as e:
+                waiting.future.set_exception(e)
+
+    def shutdown(self, wait=True):
+        """stop taking notes; notes already queued are still predicted"""
+        with self._ready:
+            self._closed = True
+            self._ready.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
@@ -0,0 +1,201 @@
+"""Comprehend Medical client with a sized connection pool and retry/backoff tuned for throttling
+
+CompMedClient provides the get_phi/get_entities calls the blueprints use. It owns one
+boto3 client (thread-safe, shared by every worker thread) whose HTTP pool is sized to the
+service's concurrency, and it does its own retries: exponential backoff with full jitter on
+throttling and transient errors. Failures are raised as distinct types so that callers can
+tell bad input (a ValueError, as before) from throttling and from the service being down.
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+
+from flaskphiid.logconfig import Event
+
+logger = logging.getLogger(__name__)
+
+THROTTLING_CODES = {'ThrottlingException', 'TooManyRequestsException', 'Throttling',
+                    'ThrottledException', 'RequestLimitExceeded', 'LimitExceededException'}
+TRANSIENT_CODES = {'InternalServerException', 'ServiceUnavailableException', 'ServiceUnavailable',
+                   'InternalFailure', 'RequestTimeout', 'RequestTimeoutException'}
+
+
+class CompMedError(Exception):
+    pass
+
+
+class CompMedBadInput(CompMedError, ValueError):
+    """the request was rejected as invalid; retrying will not help"""
+
+
+class CompMedThrottled(CompMedError):
+    """Comprehend Medical kept throttling the request after all retries"""
+
+
+class CompMedUnavailable(CompMedError):
+    """Comprehend Medical kept failing or could not be reached after all retries"""
+
+
+class CompMedClient(object):
+
+    def __init__(self, region_name=None, endpoint_url=None, pool_size=10, max_retries=4,
+                 backoff_base=0.1, backoff_cap=5.0, connect_timeout=5, read_timeout=60):
+        self._lock = threading.Lock()
+        self._client = None
+        self.configure(region_name=region_name, endpoint_url=endpoint_url, pool_size=pool_size,
+                       max_retries=max_retries, backoff_base=backoff_base, backoff_cap=backoff_cap,
+                       connect_timeout=connect_timeout, read_timeout=read_timeout)
+
+    def configure(self, **settings):
+        """update settings; the underlying boto3 client is rebuilt on next use"""
+        with self._lock:
+            for name, value in settings.items():
+                setattr(self, name, value)
+            self._client = None
+
+    def configure_from(self, config):
+        """apply the COMPMED_* settings of a Flask config"""
+        self.configure(region_name=config.get('COMPMED_REGION'),
+                       endpoint_url=config.get('COMPMED_ENDPOINT_URL'),
+                       pool_size=config.get('COMPMED_POOL_SIZE') or config['BACKEND_MAX_WORKERS'],
+                       max_retries=config['COMPMED_MAX_RETRIES'],
+                       backoff_base=config['COMPMED_BACKOFF_BASE'],
+                       backoff_cap=config['COMPMED_BACKOFF_CAP'],
+                       connect_timeout=config['COMPMED_CONNECT_TIMEOUT'],
+                       read_timeout=config['COMPMED_READ_TIMEOUT'])
+
+    @property
+    def client(self):
+        client = self._client
+        if client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._create_client()
+                client = self._client
+        return client
+
+    @property
+    def connected(self):
+        """whether the boto3 client has been built"""
+        return self._client is not None
+
+    def _create_client(self):
+        import boto3
+        from botocore.config import Config
+        config = Config(max_pool_connections=self.pool_size,
+                        connect_timeout=self.connect_timeout,
+                        read_timeout=self.read_timeout,
+                        tcp_keepalive=True,
+                        # retries are handled in _call, with backoff suited to throttling
+                        retries={'total_max_attempts': 1, 'mode': 'standard'})
+        return boto3.session.Session().client('comprehendmedical', region_name=self.region_name,
+                                              endpoint_url=self.endpoint_url, config=config)
+
+    def get_phi(self, note_text):
+        return self._call('detect_phi', Text=note_text)['Entities']
+
+    def get_entities(self, note_text, entityTypes=None, **kwargs):
+        """all medical entities, or only those whose Category is in entityTypes"""
+        return _in_categories(self._call('detect_entities_v2', Text=note_text)['Entities'], entityTypes)
+
+    def _call(self, operation, **params):
+        from botocore.exceptions import ClientError, BotoCoreError
+        attempt = 0
+        while True:
+            try:
+                return getattr(self.client, operation)(**params)
+            except (ClientError, BotoCoreError) as e:
+                error = classify_error(operation, e)
+                if isinstance(error, CompMedBadInput):
+                    raise error
+            if attempt >= self.max_retries:
+                raise error
+            delay = self._backoff(attempt)
+            attempt += 1
+            logger.info(Event('compmed.retry', operation=operation, attempt=attempt, delay=delay, error=error))
+            time.sleep(delay)
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+
+
+class AsyncCompMedClient(CompMedClient):
+    """
+    CompMedClient for asyncio, on aiobotocore: calls are awaited instead of holding a thread
+    for the round-trip, so one process can have thousands in flight. The client is created
+    on first use in the running event loop; close() it from the same loop.
+    Requires aiobotocore: pip install FlaskPHI_ID[asgi]
+    """
+
+    async def get_phi(self, note_text):
+        return (await self._call('detect_phi', Text=note_text))['Entities']
+
+    async def get_entities(self, note_text, entityTypes=None, **kwargs):
+        return _in_categories((await self._call('detect_entities_v2', Text=note_text))['Entities'], entityTypes)
+
+    async def _async_client(self):
+        if self._client is None:
+            from aiobotocore.config import AioConfig
+            from aiobotocore.session import get_session
+            config = AioConfig(max_pool_connections=self.pool_size,
+                               connect_timeout=self.connect_timeout,
+                               read_timeout=self.read_timeout,
+                               retries={'total_max_attempts': 1, 'mode': 'standard'})
+            creator = get_session().create_client('comprehendmedical', region_name=self.region_name,
+                                                  endpoint_url=self.endpoint_url, config=config)
+            client = await creator.__aenter__()
+            # another task may have created one while this one was waiting
+            if self._client is None:
+                self._client = client
+            else:
+                await client.close()
+        return self._client
+
+    async def _call(self, operation, **params):
+        from botocore.exceptions import ClientError, BotoCoreError
+        client = await self._async_client()
+        attempt = 0
+        while True:
+            try:
+                return await getattr(client, operation)(**params)
+            except (ClientError, BotoCoreError) as e:
+                error = classify_error(operation, e)
+                if isinstance(error, CompMedBadInput):
+                    raise error
+            if attempt >= self.max_retries:
+                raise error
+            delay = self._backoff(attempt)
+            attempt += 1
+            logger.info(Event('compmed.retry', operation=operation, attempt=attempt, delay=delay, error=error))
+            await asyncio.sleep(delay)
+
+    async def close(self):
+        client, self._client = self._client, None
+        if client is not None:
+            await client.close()
+
+
+def classify_error(operation, e):
+    """the CompMedError for a botocore error; CompMedBadInput is never worth retrying"""
+    from botocore.exceptions import ClientError
+    if not isinstance(e, ClientError):
+        # connection errors, read timeouts and the like
+        return CompMedUnavailable("{} failed: {}".format(operation, e))
+    code = e.response.get('Error', {}).get('Code', '')
+    status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+    if code in THROTTLING_CODES or status == 429:
+        return CompMedThrottled("{} throttled: {}".format(operation, e))
+    if code in TRANSIENT_CODES or status >= 500:
+        return CompMedUnavailable("{} failed: {}".format(operation, e))
+    return CompMedBadInput("{} rejected: {}".format(operation, e))
+
+
+def _in_categories(entities, entityTypes):
+    """the entities whose Category is in entityTypes; None or "all" (as compmed-pkg takes it) keeps them all"""
+    if not entityTypes or entityTypes == "all":
+        return entities
+    # a single category may be passed as a string, which `in` would match as a substring
+    categories = {entityTypes} if isinstance(entityTypes, str) else set(entityTypes)
+    return [entity for entity in entities if entity.get('Category') in categories]
@@ -0,0 +1,294 @@
+"""A local stand-in for Comprehend Medical, for offline load and failure testing
+
+    python -m flaskphiid.compmed_stub --port 4566 --latency lognormal:0.08,0.5 --max-tps 20 --error-rate 0.01
+
+It speaks the service's JSON protocol for DetectPHI and DetectEntitiesV2, so the app's
+CompMedClient talks to it unchanged once COMPMED_ENDPOINT_URL points at it (boto3 still
+wants credentials and a region: any AWS_ACCESS_KEY_ID/AWS_SECRET_ACCESS_KEY and
+COMPMED_REGION will do). Entities come from regular expressions and small word lists.
+Every call can be delayed by a latency distribution, throttled past --max-tps or at
+random, failed at random, and rejected when longer than the service's text limit.
+Injection settings can be changed while it runs by POSTing JSON to /_stub/config;
+GET /_stub/stats returns the call counts.
+"""
+import argparse
+import json
+import logging
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+TARGET_PREFIX = 'ComprehendMedical_20181030.'
+TEXT_LIMIT = 20000
+PHI = 'PROTECTED_HEALTH_INFORMATION'
+
+FIRST_NAMES = {"John", "Mary", "Edward", "James", "Robert", "Linda", "Maria", "David", "Susan", "Ana",
+               "Wei", "Fatima", "Carlos", "Grace", "Michael", "Jennifer", "William", "Elizabeth"}
+LOCATIONS = {"Seattle", "Tacoma", "Spokane", "Portland", "Bellevue", "Everett", "Olympia", "Boston"}
+PROFESSIONS = {"teacher", "nurse", "engineer", "farmer", "lawyer", "accountant", "carpenter", "pilot"}
+MEDICATIONS = {"aspirin", "ibuprofen", "acetaminophen", "metformin", "lisinopril", "atorvastatin",
+               "amoxicillin", "prednisone", "warfarin", "insulin", "morphine", "ondansetron"}
+CONDITIONS = {"pain", "fever", "fatigue", "diabetes", "hypertension", "nausea", "pneumonia", "cancer",
+              "asthma", "depression", "anemia", "infection"}
+
+MONTH = r'(?:Jan(?:uary)?|Feb(?:ruary)?|Mar(?:ch)?|Apr(?:il)?|May|June?|July?|Aug(?:ust)?|' \
+        r'Sep(?:tember)?|Oct(?:ober)?|Nov(?:ember)?|Dec(?:ember)?)'
+PHI_PATTERNS = [
+    ('NAME', re.compile(r'\b(?:Mr|Mrs|Ms|Dr)\.?\s+((?:[A-Z][a-z]+\s+)?[A-Z][a-z]+)')),
+    ('NAME', re.compile(r'\b((?:{})\s+[A-Z][a-z]+)\b'.format('|'.join(sorted(FIRST_NAMES))))),
+    ('DATE', re.compile(r'\b({}\.?\s+\d{{1,2}}(?:st|nd|rd|th)?(?:,?\s+\d{{4}})?)'.format(MONTH))),
+    ('DATE', re.compile(r'\b(\d{1,2}/\d{1,2}/\d{2,4})\b')),
+    ('AGE', re.compile(r'\b(\d{1,3})(?=\s*(?:yo\b|y/o|year[- ]old))')),
+    ('ID', re.compile(r'\bMRN:?\s*(\d{5,10})\b')),
+    ('PHONE_OR_FAX', re.compile(r'(\(?\b\d{3}\)?[-. ]\d{3}[-.]\d{4})\b')),
+    ('EMAIL', re.compile(r'\b([\w.+-]+@[\w-]+\.[\w.]+)\b')),
+    ('ADDRESS', re.compile(r'\b({})\b'.format('|'.join(sorted(LOCATIONS))))),
+    ('PROFESSION', re.compile(r'\b({})\b'.format('|'.join(sorted(PROFESSIONS))), re.IGNORECASE)),
+]
+ENTITY_PATTERNS = [
+    ('MEDICATION', 'GENERIC_NAME', re.compile(r'\b({})\b'.format('|'.join(sorted(MEDICATIONS))), re.IGNORECASE)),
+    ('MEDICAL_CONDITION', 'DX_NAME', re.compile(r'\b({})\b'.format('|'.join(sorted(CONDITIONS))), re.IGNORECASE)),
+]
+
+
+def find_phi(text, rng=random):
+    """DetectPHI-style entities for text"""
+    spans = {}
+    for entity_type, pattern in PHI_PATTERNS:
+        for match in pattern.finditer(text):
+            start, end = match.span(1)
+            # the first pattern to claim a span keeps it
+            if not any(start < other_end and other_start < end for other_start, other_end in spans):
+                spans[(start, end)] = entity_type
+    return [_entity(i, text, start, end, PHI, entity_type, rng)
+            for i, ((start, end), entity_type) in enumerate(sorted(spans.items()))]
+
+
+def find_entities(text, rng=random):
+    """DetectEntitiesV2-style entities for text: medications, conditions and PHI"""
+    entities = find_phi(text, rng)
+    for category, entity_type, pattern in ENTITY_PATTERNS:
+        for match in pattern.finditer(text):
+            entities.append(_entity(len(entities), text, match.start(1), match.end(1), category, entity_type, rng))
+    return entities
+
+
+def _entity(entity_id, text, start, end, category, entity_type, rng):
+    return {'Id': entity_id, 'BeginOffset': start, 'EndOffset': end, 'Score': round(rng.uniform(0.7, 0.999), 4),
+            'Text': text[start:end], 'Category': category, 'Type': entity_type, 'Traits': []}
+
+
+def parse_latency(spec):
+    """
+    a function of a Random returning a delay in seconds, from 'SECONDS', 'fixed:SECONDS',
+    'uniform:LOW,HIGH', 'normal:MEAN,STDEV', 'lognormal:MEDIAN,SIGMA' or 'exp:MEAN'
+    """
+    kind, _, args = str(spec).partition(':')
+    if not args:
+        kind, args = 'fixed', kind
+    try:
+        values = [float(value) for value in args.split(',')]
+        if kind == 'fixed' and len(values) == 1:
+            return lambda rng: values[0]
+        if kind == 'uniform' and len(values) == 2:
+            return lambda rng: rng.uniform(*values)
+        if kind == 'normal' and len(values) == 2:
+            return lambda rng: max(0.0, rng.gauss(*values))
+        if kind == 'lognormal' and len(values) == 2:
+            median, sigma = values
+            return lambda rng: median * rng.lognormvariate(0, sigma)
+        if kind == 'exp' and len(values) == 1:
+            return lambda rng: rng.expovariate(1 / values[0]) if values[0] > 0 else 0.0
+    except ValueError:
+        pass
+    raise ValueError("bad latency {!r}".format(spec))
+
+
+class _TokenBucket(object):
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class CompMedStubServer(object):
+    """
+    the stand-in as a server running in a background thread; use as a context manager
+    or call start() and stop(). Settings are described under configure().
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, seed=None, **settings):
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+        self.stats = {}
+        self.latency = parse_latency(0)
+        self.latency_per_char = 0.0
+        self.throttle_rate = 0.0
+        self.max_tps = None
+        self.error_rate = 0.0
+        self.text_limit = TEXT_LIMIT
+        self._bucket = None
+        self.configure(**settings)
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.url = 'http://{}:{}'.format(*self.server.server_address[:2])
+        self._thread = None
+
+    def configure(self, latency=None, latency_per_char=None, throttle_rate=None, max_tps=None, error_rate=None,
+                  text_limit=None):
+        """
+        latency: a parse_latency spec for each call; latency_per_char: seconds added per
+        character of text; throttle_rate / error_rate: chance of a ThrottlingException /
+        InternalServerException; max_tps: calls per second allowed before throttling
+        (0 for no limit); text_limit: longest text accepted
+        """
+        with self._lock:
+            if latency is not None:
+                self.latency = parse_latency(latency)
+            if latency_per_char is not None:
+                self.latency_per_char = float(latency_per_char)
+            if throttle_rate is not None:
+                self.throttle_rate = float(throttle_rate)
+            if max_tps is not None:
+                self.max_tps = float(max_tps) or None
+                self._bucket = _TokenBucket(self.max_tps) if self.max_tps else None
+            if error_rate is not None:
+                self.error_rate = float(error_rate)
+            if text_limit is not None:
+                self.text_limit = int(text_limit)
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] = self.stats.get(name, 0) + 1
+
+    def respond(self, operation, body):
+        """(status, reply) for a call, after the injected delay"""
+        self._count('calls')
+        text = body.get('Text')
+        if operation not in ('DetectPHI', 'DetectEntitiesV2'):
+            return 400, _error('UnknownOperationException', "{} is not supported".format(operation))
+        if not isinstance(text, str) or not text:
+            return 400, _error('InvalidRequestException', "Text is required")
+        with self._lock:
+            delay = self.latency(self._rng) + self.latency_per_char * len(text)
+            throttled = (self._bucket is not None and not self._bucket.take()) or self._rng.random() < self.throttle_rate
+            failed = self._rng.random() < self.error_rate
+            seed = self._rng.random()
+        if throttled:
+            self._count('throttled')
+            return 400, _error('ThrottlingException', "Rate exceeded")
+        if len(text) > self.text_limit:
+            self._count('rejected')
+            return 400, _error('TextSizeLimitExceededException',
+                               "Text is {} characters, the limit is {}".format(len(text), self.text_limit))
+        if delay > 0:
+            time.sleep(delay)
+        if failed:
+            self._count('errors')
+            return 500, _error('InternalServerException', "Injected failure")
+        self._count(operation)
+        find = find_phi if operation == 'DetectPHI' else find_entities
+        return 200, {'Entities': find(text, random.Random(seed)), 'ModelVersion': 'stub'}
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                try:
+                    body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+                except ValueError:
+                    return self.reply(400, _error('SerializationException', "Body is not JSON"))
+                if self.path == '/_stub/config':
+                    try:
+                        stub.configure(**body)
+                    except (TypeError, ValueError) as e:
+                        return self.reply(400, {'message': str(e)})
+                    return self.reply(200, {'ok': True})
+                target = self.headers.get('X-Amz-Target', '')
+                self.reply(*stub.respond(target[len(TARGET_PREFIX):] if target.startswith(TARGET_PREFIX) else target,
+                                         body))
+
+            def do_GET(self):
+                if self.path == '/_stub/stats':
+                    with stub._lock:
+                        return self.reply(200, dict(stub.stats))
+                self.reply(404, {'message': "Not found"})
+
+            def reply(self, status, reply):
+                data = json.dumps(reply).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/x-amz-json-1.1')
+                self.send_header('Content-Length', str(len(data)))
+                self.send_header('x-amzn-RequestId', '{:032x}'.format(random.getrandbits(128)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                logger.debug("{} {}".format(self.address_string(), format % args))
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='compmed-stub', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def _error(code, message):
+    return {'__type': code, 'message': message}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local Comprehend Medical stand-in")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=4566)
+    parser.add_argument('--latency', default='0', help="e.g. 0.05, uniform:0.02,0.2, lognormal:0.08,0.5, exp:0.1")
+    parser.add_argument('--latency-per-char', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--max-tps', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--text-limit', type=int, default=TEXT_LIMIT)
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    server = CompMedStubServer(args.host, args.port, seed=args.seed, latency=args.latency,
+                               latency_per_char=args.latency_per_char, throttle_rate=args.throttle_rate,
+                               max_tps=args.max_tps, error_rate=args.error_rate, text_limit=args.text_limit)
+    logger.info("Comprehend Medical stand-in listening on {}".format(server.url))
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,25 +2,23 @@ import json
 import logging
 
 from flask import Blueprint, render_template, request, session, abort, jsonify, Response, current_app, g
-from flaskphiid import compmedInterface
+from flaskphiid.backends import get_backends
+from flaskphiid.chunking import chunk_text, merge_chunk_entities
+from flaskphiid.executor import get_executor, gather, BackendError
+from flaskphiid.metrics import STAGE_SECONDS, timed_backend
+from flaskphiid.notes import ENTITY_ERROR_MESSAGES, backend_error, backend_timeouts, entities_found, posted_note
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
 
 bp = Blueprint('compmed', __name__, url_prefix='/compmed')
 
 @bp.route("/", methods=['POST'])
 def annotate(**kwargs):
-    if not request.json or not 'extract_text' in request.json:
-        abort(400)
-
-    note_text = request.json['extract_text']
-    if note_text:
-        return _get_entities(note_text, **kwargs)
-    else:
-        msg = "No Entity Text was found"
-        logger.info("No entities returned")
-        return Response(msg, status=400)
+    note_text, error = posted_note(request.json)
+    if error is not None:
+        msg, status = error
+        return Response(msg, status=status)
+    return _get_entities(note_text, **kwargs)
 
 
 @bp.route("/phi", methods=['POST'])
@@ -30,17 +28,34 @@ def annotate_phi():
 
 def _get_entities(note_text, **kwargs):
 
+    compmed = get_backends().compmed
     try:
-        if 'entityTypes' in kwargs and kwargs['entityTypes'] == ["PROTECTED_HEALTH_INFORMATION"]:
-            entities = compmedInterface.get_phi(note_text)
-        else:
-            entities = compmedInterface.get_entities(note_text, **kwargs)
-    except ValueError as e:
-        msg = "An error occurred while calling Comprehend Medical/MedLPInterface"
-        logger.warning("An error occurred while calling Comprehend Medical/MedLPInterface: {}".format(e))
-        return Response(msg, status=400)
-
-    logger.info("{} entities returned for entity types".format(len(entities)))
-    return Response(json.dumps(entities), mimetype=u'application/json')
-
-
+        with STAGE_SECONDS.time(stage='backends'):
+            if 'entityTypes' in kwargs and kwargs['entityTypes'] == ["PROTECTED_HEALTH_INFORMATION"]:
+                entities = _call_chunked(timed_backend('compmed', compmed.get_phi), note_text)
+            else:
+                entities = _call_chunked(timed_backend('compmed', compmed.get_entities), note_text, **kwargs)
+    except BackendError as e:
+        error = backend_error(e, ENTITY_ERROR_MESSAGES)
+        if error is None:
+            raise e.error
+        msg, status = error
+        return Response(msg, status=status)
+
+    return Response(entities_found(logger, 'compmed', note_text, entities), mimetype=u'application/json')
+
+
+def _call_chunked(compmed_call, note_text, **kwargs):
+    """
+    call Comprehend Medical on a note, in parallel windows when it is longer than COMPMED_MAX_CHARS,
+    within COMPMED_TIMEOUT; a failure or timeout is raised as a BackendError
+    """
+    windows = chunk_text(note_text, current_app.config['COMPMED_MAX_CHARS'],
+                         current_app.config['COMPMED_CHUNK_OVERLAP'])
+    executor = get_executor(current_app.config.get('BACKEND_MAX_WORKERS'))
+    futures = [executor.submit(compmed_call, chunk, **kwargs) for offset, chunk in windows]
+    gather({future: 'compmed' for future in futures}, timeouts=backend_timeouts(current_app.config))
+    results = [future.result() for future in futures]
+    if len(windows) == 1:
+        return results[0]
+    return merge_chunk_entities(note_text, windows, results)
@@ -0,0 +1,122 @@
+"""Shared, bounded thread pools used to fan requests out to the PHI backends
+
+The 'backend' pool runs the Comprehend Medical and HutchNER calls. Work that
+itself waits on backend calls (e.g. one task per note of a batch) must run in a
+different pool, such as 'notes', so it cannot starve the calls it waits for.
+"""
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from time import monotonic
+
+DEFAULT_MAX_WORKERS = 8
+
+_executors = {}
+_lock = threading.Lock()
+
+
+class BackendError(Exception):
+    """raised by gather when a backend call fails; the original exception is kept in .error"""
+
+    def __init__(self, backend, error):
+        super(BackendError, self).__init__("{}: {}".format(backend, error))
+        self.backend = backend
+        self.error = error
+
+
+class BackendTimeout(BackendError):
+
+    def __init__(self, backend, timeout):
+        super(BackendTimeout, self).__init__(backend, "no result after {}s".format(timeout))
+        self.timeout = timeout
+
+
+class InlineExecutor(object):
+    """runs each call in the submitting thread and returns an already completed future"""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+_inline = threading.local()
+_inline_executor = InlineExecutor()
+
+
+def set_inline(inline):
+    """while set, get_executor returns an InlineExecutor in this thread, e.g. so a profiler sees every call"""
+    _inline.active = inline
+
+
+def get_executor(max_workers=None, name='backend'):
+    """return the process-wide executor called name, creating it on first use"""
+    if getattr(_inline, 'active', False):
+        return _inline_executor
+    executor = _executors.get(name)
+    if executor is None:
+        with _lock:
+            executor = _executors.get(name)
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=max_workers or DEFAULT_MAX_WORKERS,
+                                              thread_name_prefix=name)
+                _executors[name] = executor
+    return executor
+
+
+def _reset_after_fork():
+    # a forked child has none of its parent's pool threads; start it with no pools
+    global _lock
+    _lock = threading.Lock()
+    _executors.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def shutdown_executors(wait_for_calls=True):
+    with _lock:
+        for executor in _executors.values():
+            executor.shutdown(wait=wait_for_calls)
+        _executors.clear()
+
+
+def gather(futures, timeouts):
+    """
+    Wait for backend calls given as {future: backend name}.
+    Each backend has its own timeout in seconds (None for no limit), counted from
+    when gather is called. The first failure or timeout cancels the calls that are
+    still pending and is raised as a BackendError. Calls that are already running
+    cannot be interrupted; their results are discarded.
+    """
+    started = monotonic()
+    deadlines = {}
+    for backend in set(futures.values()):
+        timeout = timeouts.get(backend)
+        deadlines[backend] = None if timeout is None else started + timeout
+
+    pending = set(futures)
+    while pending:
+        pending_deadlines = [deadlines[futures[f]] for f in pending if deadlines[futures[f]] is not None]
+        wait_for = max(0, min(pending_deadlines) - monotonic()) if pending_deadlines else None
+        done, pending = wait(pending, timeout=wait_for, return_when=FIRST_EXCEPTION)
+        for future in done:
+            if future.exception() is not None:
+                _cancel(pending)
+                raise BackendError(futures[future], future.exception())
+        now = monotonic()
+        for future in pending:
+            deadline = deadlines[futures[future]]
+            if deadline is not None and deadline <= now:
+                _cancel(pending)
+                backend = futures[future]
+                raise BackendTimeout(backend, timeouts.get(backend))
+
+
+def _cancel(futures):
+    for future in futures:
+        future.cancel()
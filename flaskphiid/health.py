@@ -0,0 +1,27 @@
+import logging
+
+from flask import Blueprint, jsonify
+
+from flaskphiid.backends import get_backends
+
+logger = logging.getLogger(__name__)
+
+bp = Blueprint('health', __name__)
+
+
+@bp.route("/healthz", methods=['GET'])
+def healthz():
+    """liveness: the process is up and serving requests"""
+    return jsonify({'status': 'ok'})
+
+
+@bp.route("/readyz", methods=['GET'])
+def readyz():
+    """readiness: every backend is loaded, so requests will not wait on a model load"""
+    backends = get_backends()
+    body = {'status': 'ready' if backends.ready else 'loading', 'backends': backends.status}
+    if backends.warm_up_seconds is not None:
+        body['warm_up_seconds'] = round(backends.warm_up_seconds, 3)
+    response = jsonify(body)
+    response.status_code = 200 if backends.ready else 503
+    return response
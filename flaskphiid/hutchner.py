@@ -1,11 +1,14 @@
 import json
 import logging
+from operator import itemgetter
 
 from flask import Blueprint, render_template, request, session, abort, jsonify, Response, current_app, g
-from flaskphiid import hutchNERInterface
+from flaskphiid.backends import get_backends
+from flaskphiid.executor import get_executor, gather, BackendError
+from flaskphiid.metrics import STAGE_SECONDS, timed_backend
+from flaskphiid.notes import ENTITY_ERROR_MESSAGES, backend_error, backend_timeouts, entities_found, posted_note
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
 
 bp = Blueprint('hutchner', __name__, url_prefix='/hutchner')
 
@@ -13,32 +16,109 @@ bp = Blueprint('hutchner', __name__, url_prefix='/hutchner')
 
 @bp.route("/", methods=['POST'])
 def annotate(**kwargs):
-    if not request.json or not 'extract_text' in request.json:
-        abort(400)
-
-    note_text = request.json['extract_text']
-    if note_text:
-        entities = _get_entities(note_text, **kwargs)
-        return entities
-    else:
-        msg = "No Entity Text was found"
-        logger.info("No entities returned")
-        return Response(msg, status=400)
+    note_text, error = posted_note(request.json)
+    if error is not None:
+        msg, status = error
+        return Response(msg, status=status)
+    return _get_entities(note_text, **kwargs)
 
 @bp.route("/phi", methods=['POST'])
 def annotate_phi():
     return annotate(entityTypes=["PROTECTED_HEALTH_INFORMATION"])
 
+def get_predictor():
+    """
+    the HutchNER predict callable for the current app: the worker process pool when
+    HUTCHNER_PROCESSES is set, the in-process model otherwise, either behind the batching
+    coalescer when HUTCHNER_COALESCE is set. Resolve it in the request thread; the callable
+    itself can be run from any thread.
+    """
+    return get_backends().predictor
+
+
+def predict(note_text, **kwargs):
+    return get_predictor()(note_text, **kwargs)
+
+
+SPAN_REDUCERS = {
+    'max': max,
+    'mean': lambda scores: sum(scores) / len(scores),
+}
+
+
+def aggregate_spans(tokens, reducer='max', note_text=None):
+    """
+    Combine runs of adjacent tokens with the same label into one span each, in the token
+    format ({'start', 'stop', 'text', 'label', 'confidence'}), so that a 40-token address
+    enters annotation merging as one annotation instead of 40. Labels may carry BIO
+    prefixes: a B- token always starts a new span and the prefix is dropped from the span
+    label. Tokens are adjacent when only whitespace lies between them in note_text, or
+    without a note, when they are at most one character apart. The span's confidence is
+    the reducer ('max' or 'mean') of its tokens' confidences. "O" tokens are dropped.
+    """
+    reduce_scores = SPAN_REDUCERS[reducer]
+    runs = []
+    run = label = None
+    # an "O" token between two tokens keeps them from being adjacent, so it can simply be skipped
+    for token in sorted(tokens, key=itemgetter('start')):
+        token_label = token.get('label')
+        if not token_label or token_label == 'O':
+            continue
+        begins = False
+        if token_label[1:2] == '-' and token_label[0] in 'BI':
+            begins = token_label[0] == 'B'
+            token_label = token_label[2:]
+        if run is not None and not begins and token_label == label and _adjacent(run[-1], token, note_text):
+            run.append(token)
+        else:
+            run, label = [token], token_label
+            runs.append((label, run))
+    return [_span(label, run, reduce_scores, note_text) for label, run in runs]
+
+
+def _adjacent(previous, token, note_text):
+    if token['start'] < previous['stop']:
+        return False
+    if note_text is None:
+        return token['start'] - previous['stop'] <= 1
+    return not note_text[previous['stop']:token['start']].strip()
+
+
+def _span(label, run, reduce_scores, note_text):
+    first = run[0]
+    if len(run) == 1:
+        return {'start': first['start'], 'stop': first['stop'], 'text': first['text'], 'label': label,
+                'confidence': first['confidence']}
+    start, stop = first['start'], run[-1]['stop']
+    if note_text is not None:
+        text = note_text[start:stop]
+    else:
+        text = first['text']
+        for previous, token in zip(run, run[1:]):
+            text += ' ' * (token['start'] - previous['stop']) + token['text']
+    return {'start': start, 'stop': stop, 'text': text, 'label': label,
+            'confidence': reduce_scores([token['confidence'] for token in run])}
+
+
 def _get_entities(note_text, **kwargs):
     entities = []
     try:
         if 'entityTypes' in kwargs:
-            entities = hutchNERInterface.predict(note_text).to_json()
-    except ValueError as e:
-        msg = "An error occurred while calling HutchNER"
-        logger.warning("An error occurred while calling HutchNER: {}".format(e))
-        return Response(msg, status=400)
-
-    logger.info("{} entities returned for entity types".format(len(entities)))
-    logger.info("entities: {}".format(entities))
-    return Response(json.dumps(entities), mimetype=u'application/json')
\ No newline at end of file
+            with STAGE_SECONDS.time(stage='backends'):
+                entities = _predict_within_timeout(note_text).to_json()
+    except BackendError as e:
+        error = backend_error(e, ENTITY_ERROR_MESSAGES)
+        if error is None:
+            raise e.error
+        msg, status = error
+        return Response(msg, status=status)
+
+    return Response(entities_found(logger, 'hutchner', note_text, entities), mimetype=u'application/json')
+
+
+def _predict_within_timeout(note_text):
+    """predict on the backend executor within HUTCHNER_TIMEOUT; a failure or timeout is raised as a BackendError"""
+    executor = get_executor(current_app.config.get('BACKEND_MAX_WORKERS'))
+    future = executor.submit(timed_backend('hutchner', get_predictor()), note_text)
+    gather({future: 'hutchner'}, timeouts=backend_timeouts(current_app.config))
+    return future.result()
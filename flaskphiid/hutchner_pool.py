@@ -0,0 +1,129 @@
+"""Run HutchNER inference in a pool of worker processes
+
+HutchNER's predict is CPU-bound Python and holds the GIL, so threads cannot run it in
+parallel. HutchNERProcessPool loads HUTCHNER_MODEL and CLINIC_NOTE_CLUSTERS once in each
+worker process and sends notes to them, with at most `processes + queue_size` notes
+submitted at a time. Enabled by setting HUTCHNER_PROCESSES; see flaskphiid.backends.
+"""
+import importlib
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait
+
+from flaskphiid.cluster_table import MappedClusterTable, is_cluster_table
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL_FACTORY = 'HutchNERPredict.hutchner:HutchNER'
+# where HutchNER keeps the table load_clusters reads
+DEFAULT_CLUSTERS_ATTRIBUTE = 'clusters'
+
+# the model loaded by _init_worker, one per worker process
+_worker_model = None
+
+
+class HutchNERPoolBusy(Exception):
+    """every worker is busy and the queue is full"""
+
+
+class PooledPrediction(object):
+    """the parts of a HutchNER prediction the blueprints use, as returned from a worker"""
+
+    def __init__(self, NER_token_labels, json_result):
+        self.NER_token_labels = NER_token_labels
+        self._json = json_result
+
+    def to_json(self):
+        return self._json
+
+
+def load_hutchner(model_factory, model_path, clusters_path, clusters_attribute=DEFAULT_CLUSTERS_ATTRIBUTE):
+    """
+    create a HutchNER model and load its model and clusters. When clusters_path is a
+    cluster table (see flaskphiid.cluster_table) it is memory-mapped and set as the
+    model's clusters_attribute instead of being unpickled by load_clusters.
+    """
+    module_name, class_name = model_factory.split(':')
+    model = getattr(importlib.import_module(module_name), class_name)()
+    model.load_model(input_path=model_path)
+    if clusters_path and os.path.isfile(clusters_path) and is_cluster_table(clusters_path):
+        setattr(model, clusters_attribute, MappedClusterTable(clusters_path))
+    else:
+        model.load_clusters(input_path=clusters_path)
+    return model
+
+
+def _init_worker(model_factory, model_path, clusters_path, clusters_attribute):
+    global _worker_model
+    _worker_model = load_hutchner(model_factory, model_path, clusters_path, clusters_attribute)
+
+
+def _ping(delay):
+    # keeps a worker busy briefly so that warm_up's pings spread over every worker
+    threading.Event().wait(delay)
+    return _worker_model is not None
+
+
+def _predict(note_text, kwargs):
+    prediction = _worker_model.predict(note_text, **kwargs)
+    return PooledPrediction(prediction.NER_token_labels, prediction.to_json())
+
+
+def _predict_batch(note_texts, kwargs):
+    from flaskphiid.coalescer import predict_batch
+    return [PooledPrediction(prediction.NER_token_labels, prediction.to_json())
+            for prediction in predict_batch(_worker_model, note_texts, **kwargs)]
+
+
+class HutchNERProcessPool(object):
+
+    def __init__(self, processes, model_path, clusters_path, queue_size=None,
+                 queue_timeout=None, model_factory=DEFAULT_MODEL_FACTORY, start_method='spawn',
+                 clusters_attribute=DEFAULT_CLUSTERS_ATTRIBUTE):
+        self.processes = processes
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(processes + (processes if queue_size is None else queue_size))
+        self._executor = ProcessPoolExecutor(max_workers=processes,
+                                             mp_context=multiprocessing.get_context(start_method),
+                                             initializer=_init_worker,
+                                             initargs=(model_factory, model_path, clusters_path,
+                                                       clusters_attribute))
+
+    def submit(self, note_text, **kwargs):
+        """submit a note, waiting up to queue_timeout for room in the queue; returns a future"""
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise HutchNERPoolBusy("HutchNER pool is full")
+        try:
+            future = self._executor.submit(_predict, note_text, kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    def predict(self, note_text, **kwargs):
+        return self.submit(note_text, **kwargs).result()
+
+    def predict_batch(self, note_texts, **kwargs):
+        """predictions for several notes, sent to one worker together; a batch takes one queue slot"""
+        return self.submit_batch(note_texts, **kwargs).result()
+
+    def submit_batch(self, note_texts, **kwargs):
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise HutchNERPoolBusy("HutchNER pool is full")
+        try:
+            future = self._executor.submit(_predict_batch, list(note_texts), kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    def warm_up(self):
+        """start every worker process and wait until each has loaded its model"""
+        wait([self._executor.submit(_ping, 0.05) for _ in range(self.processes)])
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -1,49 +1,336 @@
+import collections
 import json
 import logging
+from concurrent.futures import Future, wait, FIRST_COMPLETED
 
 from flaskphiid.annotation import AnnotationFactory, unionize_annotations
+from flaskphiid.cache import get_cache
+from flaskphiid.chunking import chunk_text, merge_chunk_entities
+from flaskphiid.executor import get_executor, gather, BackendError, BackendTimeout
+from flaskphiid.logconfig import Event, log_payload
+from flaskphiid.metrics import ENTITIES, NOTE_CHARS, STAGE_SECONDS, timed_backend
+from flaskphiid.notes import (NO_TEXT, NOT_TEXT, backend_error, backend_timeouts, posted_note, redact_mode, redacted,
+                              serialize)
+from flaskphiid.profiling import is_profiling
 from flask import Blueprint, render_template, request, session, abort, jsonify, Response, current_app, g
+from flask import stream_with_context
 import flaskphiid.hutchner as hutchner
-from flaskphiid import compmedInterface, hutchNERInterface
+from flaskphiid.backends import get_backends
 
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
 
 bp = Blueprint('identifyphi', __name__, url_prefix='/identifyphi')
 
 
 @bp.route("/", methods=['POST'])
 def annotate(**kwargs):
-    if not request.json or 'extract_text' not in request.json:
-        abort(400)
+    note_text, error = posted_note(request.json)
+    if error is None:
+        return identify_phi(note_text, detailed=request.json.get('annotation_by_source', False), **kwargs)
+    msg, status = error
+    return Response(msg, status=status)
 
-    note_text = request.json['extract_text']
 
-    if note_text:
-        return identify_phi(note_text, detailed=request.json.get('annotation_by_source', False), **kwargs)
-    else:
-        msg = "No Entity Text was found"
-        logger.info("No entities returned")
-        return Response(msg, status=400)
+@bp.route("/redact", methods=['POST'])
+def annotate_redact(**kwargs):
+    """
+    The note with its PHI replaced, built server-side from the merged annotations.
+    Expects {"extract_text": ..., "mode": "tag" | "surrogate", "include_spans": bool} and
+    returns {"redacted_text": ..., "spans": [...]}; see flaskphiid.redact.redact.
+    """
+    note_text, error = posted_note(request.json)
+    if error is None:
+        mode, error = redact_mode(request.json)
+    if error is not None:
+        msg, status = error
+        return Response(msg, status=status)
+
+    try:
+        results = phi_for_note(note_text, **kwargs)
+    except BackendError as e:
+        error = backend_error(e)
+        if error is None:
+            raise e.error
+        msg, status = error
+        return Response(msg, status=status)
+    body = redacted(note_text, results, mode, include_spans=request.json.get('include_spans', False))
+    return Response(body, mimetype=u'application/json')
 
 
 def identify_phi(note_text, detailed=False, **kwargs):
-    annotations = []
     try:
-        annotations += [AnnotationFactory.from_compmed(phi) for phi in compmedInterface.get_phi(note_text)]
-    except ValueError as e:
-        msg = "An error occurred while calling MedLP"
-        logger.warning("{}: {}".format(msg, e))
-        return Response(msg, status=400)
+        results = phi_for_note(note_text, detailed=detailed, **kwargs)
+    except BackendError as e:
+        error = backend_error(e)
+        if error is None:
+            raise e.error
+        msg, status = error
+        return Response(msg, status=status)
+    return Response(serialize(results), mimetype=u'application/json')
+
+
+def phi_for_note(note_text, detailed=False, **kwargs):
+    """merged annotation dicts for a single note; backend failures are raised as BackendError"""
+    # a profiled request has to do the work it is profiling
+    cache = None if is_profiling() else get_cache()
+    key, results = lookup_note(cache, note_text, detailed=detailed, **kwargs)
+    if results is not None:
+        return results
+    with STAGE_SECONDS.time(stage='backends'):
+        compmed_phi, hutchner_phi = _get_phi(note_text, **kwargs)
+    return store_note(cache, key, note_text, compmed_phi, hutchner_phi, detailed=detailed)
+
+
+def lookup_note(cache, note_text, detailed=False, **kwargs):
+    """before calling the backends for a note: (cache key, cached results or None)"""
+    NOTE_CHARS.observe(len(note_text))
+    if cache is None:
+        return None, None
+    key = cache.key(note_text, detailed=detailed, **kwargs)
+    with STAGE_SECONDS.time(stage='cache_lookup'):
+        cached = cache.get(key)
+    return key, None if cached is None else json.loads(cached)
+
+
+def store_note(cache, key, note_text, compmed_phi, hutchner_phi, detailed=False):
+    """after the backends: merge their output, record and log it, and cache the results"""
+    with STAGE_SECONDS.time(stage='merge'):
+        results = merge_phi(compmed_phi, hutchner_phi, detailed=detailed, note_text=note_text)
+    ENTITIES.observe(len(compmed_phi), source='compmed')
+    ENTITIES.observe(len(hutchner_phi), source='hutchner')
+    ENTITIES.observe(len(results), source='merged')
+    logger.info(Event('identifyphi.entities', compmed=len(compmed_phi), hutchner=len(hutchner_phi),
+                      merged=len(results), note_chars=len(note_text)))
+    log_payload(logger, "identifyphi entities", results)
+    if cache is not None:
+        cache.set(key, json.dumps(results))
+    return results
+
+
+@bp.route("/cache", methods=['GET'])
+def cache_stats():
+    cache = get_cache()
+    if cache is None:
+        abort(404)
+    return jsonify(cache.stats())
+
+
+@bp.route("/cache", methods=['DELETE'])
+def cache_invalidate():
+    """
+    drop cached results for the posted extract_text, or all of them if none is given;
+    only with RESULT_CACHE_ALLOW_INVALIDATE set, as the endpoint has no access control
+    """
+    cache = get_cache()
+    if cache is None or not current_app.config.get('RESULT_CACHE_ALLOW_INVALIDATE'):
+        abort(404)
+    body = request.get_json(silent=True) or {}
+    if body.get('extract_text'):
+        cache.invalidate_note(body['extract_text'])
+    else:
+        cache.clear()
+    return Response(status=204)
+
+
+@bp.route("/batch", methods=['POST'])
+def annotate_batch(**kwargs):
+    """
+    Identify PHI in many notes at once.
+    Expects {"notes": [{"id": ..., "extract_text": ...}, ...], "annotation_by_source": bool}
+    and returns {"results": {id: [annotations]}, "errors": {id: {"status": ..., "message": ...}}}.
+    A failing note is reported under "errors" and does not fail the rest of the batch.
+    """
+    if not request.json or not isinstance(request.json.get('notes'), list):
+        abort(400)
+    notes = request.json['notes']
+    if len(notes) > current_app.config['BATCH_MAX_NOTES']:
+        return Response("Batch exceeds {} notes".format(current_app.config['BATCH_MAX_NOTES']), status=413)
+    if not all(isinstance(note, dict) and note.get('id') is not None for note in notes):
+        return Response("Every note needs an id", status=400)
+    if not all(_is_note_id(note['id']) for note in notes):
+        return Response("Note ids must be strings or integers", status=400)
+    # ids become keys of the JSON results and errors objects, where 1 and "1" are the same key
+    ids = [str(note['id']) for note in notes]
+    if len(set(ids)) != len(ids):
+        return Response("Note ids must be unique", status=400)
+
+    detailed = request.json.get('annotation_by_source', False)
+    app = current_app._get_current_object()
+    executor = get_executor(app.config['BATCH_MAX_CONCURRENCY'], name='notes')
+    futures = {}
+    errors = {}
+    for note in notes:
+        if not note.get('extract_text'):
+            errors[note['id']] = {'status': 400, 'message': NO_TEXT}
+        elif not isinstance(note['extract_text'], str):
+            errors[note['id']] = {'status': 400, 'message': NOT_TEXT}
+        else:
+            futures[note['id']] = executor.submit(_in_app_context, app, phi_for_note, note['extract_text'],
+                                                  detailed=detailed, **kwargs)
+
+    results = {}
+    for note_id, future in futures.items():
+        annotations, error = _note_outcome(note_id, future)
+        if error is None:
+            results[note_id] = annotations
+        else:
+            errors[note_id] = error
+
+    logger.info(Event('identifyphi.batch', notes=len(notes), succeeded=len(results)))
+    return Response(json.dumps({'results': results, 'errors': errors}), mimetype=u'application/json')
+
+
+@bp.route("/stream", methods=['POST'])
+def annotate_stream(**kwargs):
+    """
+    Identify PHI in a newline-delimited JSON stream of {"id": ..., "extract_text": ...} notes.
+    Results are streamed back as NDJSON lines, {"id": ..., "annotations": [...]} or
+    {"id": ..., "error": {"status": ..., "message": ...}}, as each note finishes.
+    The body is read incrementally and at most STREAM_MAX_IN_FLIGHT notes are in flight.
+    Query options: annotation_by_source=true, ordered=true to keep input order.
+    """
+    detailed = _is_true(request.args.get('annotation_by_source'))
+    ordered = _is_true(request.args.get('ordered'))
+    app = current_app._get_current_object()
+    executor = get_executor(app.config['BATCH_MAX_CONCURRENCY'], name='notes')
+    window = app.config['STREAM_MAX_IN_FLIGHT']
+    notes = _read_ndjson(request.stream, app.config['STREAM_MAX_LINE_BYTES'])
+
+    def generate():
+        in_flight = collections.deque() if ordered else {}
+        for note_id, note_text, error in notes:
+            if error is not None:
+                future = Future()
+                future.set_exception(_StreamLineError(error))
+            else:
+                future = executor.submit(_in_app_context, app, phi_for_note, note_text, detailed=detailed, **kwargs)
+            if ordered:
+                in_flight.append((future, note_id))
+            else:
+                in_flight[future] = note_id
+            while len(in_flight) >= window:
+                yield from _next_results(in_flight, ordered)
+        while in_flight:
+            yield from _next_results(in_flight, ordered)
+
+    return Response(stream_with_context(generate()), mimetype=u'application/x-ndjson')
+
+
+class _StreamLineError(Exception):
+    """an input line that could not be turned into a note; carries the per-note error dict"""
+
+    def __init__(self, error):
+        super(_StreamLineError, self).__init__(error['message'])
+        self.error = error
+
+
+def _read_ndjson(stream, max_line_bytes):
+    """yield (id, extract_text, error) for each non-blank line of an NDJSON body"""
+    for line_no, line in enumerate(iter(lambda: stream.readline(max_line_bytes + 1), b''), 1):
+        if not line.strip():
+            continue
+        if len(line) > max_line_bytes:
+            # skip the rest of the oversized line
+            while line and not line.endswith(b'\n'):
+                line = stream.readline(max_line_bytes + 1)
+            yield None, None, {'status': 413, 'message': "Line {} is too long".format(line_no)}
+            continue
+        try:
+            note = json.loads(line)
+        except ValueError:
+            yield None, None, {'status': 400, 'message': "Line {} is not valid JSON".format(line_no)}
+            continue
+        if not isinstance(note, dict) or note.get('id') is None:
+            yield None, None, {'status': 400, 'message': "Line {} has no note id".format(line_no)}
+        elif not note.get('extract_text'):
+            yield note['id'], None, {'status': 400, 'message': NO_TEXT}
+        elif not isinstance(note['extract_text'], str):
+            yield note['id'], None, {'status': 400, 'message': NOT_TEXT}
+        else:
+            yield note['id'], note['extract_text'], None
+
+
+def _next_results(in_flight, ordered):
+    """yield NDJSON lines for the next finished note(s)"""
+    if ordered:
+        finished = [in_flight.popleft()]
+    else:
+        done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+        finished = [(future, in_flight.pop(future)) for future in done]
+    for future, note_id in finished:
+        annotations, error = _note_outcome(note_id, future)
+        if error is None:
+            line = {'id': note_id, 'annotations': annotations}
+        else:
+            line = {'id': note_id, 'error': error}
+        yield json.dumps(line) + '\n'
+
+
+def _note_outcome(note_id, future):
+    """(annotations, None) for a note that succeeded, or (None, error dict) for one that failed"""
     try:
-        annotations += [AnnotationFactory.from_hutchner(phi) for phi in
-                        hutchNERInterface.predict(note_text, **kwargs).NER_token_labels
-                        if phi.get('label') != "O"]
-    except ValueError as e:
-        msg = "An error occurred while calling HutchNER"
-        logger.warning("{}: {}".format(msg, e))
-        return Response(msg, status=400)
-    merged_results = unionize_annotations(annotations)
-    return Response(json.dumps([res.to_dict(detailed=detailed) for res in merged_results]),
-                    mimetype=u'application/json')
+        return future.result(), None
+    except _StreamLineError as e:
+        return None, e.error
+    except BackendError as e:
+        error = backend_error(e)
+        if error is None:
+            logger.error("Unexpected error for note {}: {!r}".format(note_id, e.error))
+            error = "An unexpected error occurred", 500
+        msg, status = error
+    except Exception as e:
+        logger.error("Unexpected error for note {}: {!r}".format(note_id, e))
+        msg, status = "An unexpected error occurred", 500
+    return None, {'status': status, 'message': msg}
+
+
+def _is_note_id(value):
+    return isinstance(value, (str, int)) and not isinstance(value, bool)
+
+
+def _is_true(value):
+    return str(value).lower() in ('1', 'true', 'yes')
+
+
+def _in_app_context(app, fn, *args, **kwargs):
+    with app.app_context():
+        return fn(*args, **kwargs)
+
+
+def _get_phi(note_text, **kwargs):
+    """
+    run Comprehend Medical and HutchNER concurrently on the shared backend executor;
+    notes longer than COMPMED_MAX_CHARS go to Comprehend Medical as parallel, overlapping windows,
+    and with HUTCHNER_AGGREGATE_SPANS runs of same-label HutchNER tokens come back as single spans
+    """
+    executor = get_executor(current_app.config.get('BACKEND_MAX_WORKERS'))
+    windows = chunk_text(note_text, current_app.config['COMPMED_MAX_CHARS'],
+                         current_app.config['COMPMED_CHUNK_OVERLAP'])
+    get_phi = timed_backend('compmed', get_backends().compmed.get_phi)
+    compmed_futures = [executor.submit(get_phi, chunk) for offset, chunk in windows]
+    reducer = current_app.config['HUTCHNER_SPAN_REDUCER'] if current_app.config['HUTCHNER_AGGREGATE_SPANS'] else None
+    hutchner_future = executor.submit(_hutchner_phi, timed_backend('hutchner', hutchner.get_predictor()),
+                                      note_text, reducer, **kwargs)
+    futures = {future: 'compmed' for future in compmed_futures}
+    futures[hutchner_future] = 'hutchner'
+    gather(futures, timeouts=backend_timeouts(current_app.config))
+    compmed_phi = merge_chunk_entities(note_text, windows, [future.result() for future in compmed_futures])
+    return compmed_phi, hutchner_future.result()
+
+
+def _hutchner_phi(predict, note_text, reducer=None, **kwargs):
+    tokens = predict(note_text, **kwargs).NER_token_labels
+    if reducer:
+        return hutchner.aggregate_spans(tokens, reducer, note_text)
+    return [phi for phi in tokens if phi.get('label') != "O"]
+
+
+def merge_phi(compmed_phi, hutchner_phi, detailed=False, note_text=None):
+    """
+    union the raw Comprehend Medical entities and HutchNER token labels into merged annotation
+    dicts, with merged text taken from note_text when it is given
+    """
+    annotations = [AnnotationFactory.from_compmed(phi) for phi in compmed_phi]
+    annotations += [AnnotationFactory.from_hutchner(phi) for phi in hutchner_phi]
+    return [res.to_dict(detailed=detailed) for res in unionize_annotations(annotations, note_text)]
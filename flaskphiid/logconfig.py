@@ -0,0 +1,140 @@
+"""Logging set-up: structured, lazily formatted and written off the request threads
+
+init_app() gives the root logger a single handler that puts records on a queue; a
+listener thread formats and writes them, so a request thread never waits on log I/O.
+Records keep their message and arguments until the listener formats them, so a record
+that no handler accepts is never formatted at all.
+
+Request paths log events, which carry counts and timings and never note text:
+
+    logger.info(Event('hutchner.entities', entities=12, note_chars=5400, seconds=0.21))
+
+renders as `hutchner.entities entities=12 note_chars=5400 seconds=0.21`, or with
+LOG_FORMAT = 'json' as one JSON object per line with the fields as keys. Payloads (note
+text, entities) contain PHI and are only logged by log_payload(), at DEBUG and for the
+LOG_PAYLOAD_SAMPLE_RATE fraction of calls, which is 0 unless set.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+
+TEXT_FORMAT = "%(asctime)s %(threadName)-11s %(levelname)-10s %(message)s"
+
+_lock = threading.Lock()
+_handler = None
+_listener = None
+_payload_sample_rate = 0.0
+
+
+class Event(object):
+    """a log message of an event name and fields, rendered only when it is written"""
+    __slots__ = ('event', 'fields')
+
+    def __init__(self, event, **fields):
+        self.event = event
+        self.fields = fields
+
+    def __str__(self):
+        return ' '.join([self.event] + ['{}={}'.format(key, _format_value(value))
+                                        for key, value in self.fields.items()])
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return '{:.4g}'.format(value)
+    return value
+
+
+class JSONFormatter(logging.Formatter):
+    """one JSON object per record, with the fields of an Event as keys"""
+
+    def format(self, record):
+        data = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name,
+                'thread': record.threadName}
+        if isinstance(record.msg, Event):
+            data['event'] = record.msg.event
+            data.update(record.msg.fields)
+        else:
+            data['message'] = record.getMessage()
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+
+    def prepare(self, record):
+        # the stock prepare() formats the message in the logging thread; leave that to
+        # the listener, the record only crosses threads
+        return record
+
+
+def log_payload(logger, label, payload):
+    """log payload at DEBUG for the sampled fraction of calls; payloads contain PHI"""
+    if _payload_sample_rate and logger.isEnabledFor(logging.DEBUG) and random.random() < _payload_sample_rate:
+        logger.debug("%s: %s", label, payload)
+
+
+def configure(level=logging.INFO, fmt='text', use_queue=True, payload_sample_rate=0.0, stream=None):
+    """(re)place the handler this module installs on the root logger"""
+    global _handler, _listener, _payload_sample_rate
+    output = logging.StreamHandler(stream)
+    output.setFormatter(JSONFormatter() if fmt == 'json' else logging.Formatter(TEXT_FORMAT))
+    with _lock:
+        _stop()
+        root = logging.getLogger()
+        if use_queue:
+            _handler = _QueueHandler(queue.SimpleQueue())
+            _listener = logging.handlers.QueueListener(_handler.queue, output, respect_handler_level=True)
+            _listener.start()
+        else:
+            _handler = output
+        root.addHandler(_handler)
+        root.setLevel(level)
+        _payload_sample_rate = payload_sample_rate
+    return _handler
+
+
+def _stop():
+    global _handler, _listener
+    if _listener is not None:
+        # writes out whatever is still queued
+        _listener.stop()
+        _listener = None
+    if _handler is not None:
+        logging.getLogger().removeHandler(_handler)
+        _handler = None
+
+
+def shutdown():
+    with _lock:
+        _stop()
+
+
+def _restart_after_fork():
+    # a forked child has no listener thread, and the queue it inherited may have been
+    # mid-operation; give it a queue and a listener of its own
+    global _lock, _listener
+    _lock = threading.Lock()
+    if _listener is not None:
+        _handler.queue = queue.SimpleQueue()
+        _listener = logging.handlers.QueueListener(_handler.queue, *_listener.handlers, respect_handler_level=True)
+        _listener.start()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_after_fork)
+atexit.register(shutdown)
+
+
+def init_app(app):
+    configure(level=app.config['LOG_LEVEL'], fmt=app.config['LOG_FORMAT'], use_queue=app.config['LOG_QUEUE'],
+              payload_sample_rate=app.config['LOG_PAYLOAD_SAMPLE_RATE'])
+    if app.config['LOG_PAYLOAD_SAMPLE_RATE']:
+        logging.getLogger(__name__).warning(
+            "Logging {:.0%} of payloads at DEBUG; these contain PHI".format(app.config['LOG_PAYLOAD_SAMPLE_RATE']))
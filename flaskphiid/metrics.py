@@ -0,0 +1,244 @@
+"""Process-wide latency, size and error metrics, exposed at /metrics in the Prometheus text format
+
+Recording is a perf_counter call, a bisect and a short lock per observation, so the
+instrumentation stays on in production. Metrics are per process: behind a preforking
+server each worker reports its own values.
+"""
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter
+
+from flask import Blueprint, Response, request, g
+
+INF = float('inf')
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, INF)
+NOTE_CHARS_BUCKETS = (100, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000, INF)
+ENTITY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, INF)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, INF)
+QUEUE_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, INF)
+
+REGISTRY = []
+
+
+class _Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames) or not all(name in labels for name in self.labelnames):
+            raise ValueError("{} takes labels {}, got {}".format(self.name, self.labelnames, sorted(labels)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.type)]
+        with self._lock:
+            samples = sorted(self._values.items())
+            lines.extend(self._render_samples(samples))
+        return lines
+
+    def _render_samples(self, samples):
+        return ['{}{} {}'.format(self.name, self._labels(key), _number(value)) for key, value in samples]
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    @contextmanager
+    def track_in_progress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) if buckets[-1] == INF else tuple(buckets) + (INF,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def count(self, **labels):
+        state = self._values.get(self._key(labels))
+        return state[2] if state else 0
+
+    @contextmanager
+    def time(self, **labels):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - started, **labels)
+
+    def _render_samples(self, samples):
+        lines = []
+        for key, (counts, total, count) in samples:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append('{}_bucket{} {}'.format(self.name, self._labels(key, [('le', _number(bound))]),
+                                                     cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, self._labels(key), _number(total)))
+            lines.append('{}_count{} {}'.format(self.name, self._labels(key), count))
+        return lines
+
+
+def _escape(value):
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _number(value):
+    if value == INF:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return repr(value)
+    return str(value)
+
+
+REQUEST_SECONDS = Histogram('flaskphiid_request_seconds', "Time to handle a request, by endpoint",
+                            ['endpoint', 'status'])
+REQUESTS_IN_FLIGHT = Gauge('flaskphiid_requests_in_flight', "Requests being handled, by endpoint", ['endpoint'])
+STAGE_SECONDS = Histogram('flaskphiid_stage_seconds',
+                          "Time spent in each stage of identifying PHI in a note", ['stage'])
+BACKEND_SECONDS = Histogram('flaskphiid_backend_seconds', "Time of each backend call", ['backend'])
+BACKEND_IN_FLIGHT = Gauge('flaskphiid_backend_calls_in_flight', "Backend calls in progress", ['backend'])
+BACKEND_ERRORS = Counter('flaskphiid_backend_errors_total', "Failed backend calls, by error", ['backend', 'error'])
+NOTE_CHARS = Histogram('flaskphiid_note_chars', "Length of the notes processed, in characters", [],
+                       buckets=NOTE_CHARS_BUCKETS)
+ENTITIES = Histogram('flaskphiid_entities', "Entities found per note, by source", ['source'],
+                     buckets=ENTITY_BUCKETS)
+ADMISSION_QUEUED = Gauge('flaskphiid_admission_queued', "Requests waiting to be admitted, by lane", ['lane'])
+ADMISSION_REJECTED = Counter('flaskphiid_admission_rejected_total', "Requests turned away with a 429, by lane and reason",
+                             ['lane', 'reason'])
+ADMISSION_WAIT_SECONDS = Histogram('flaskphiid_admission_wait_seconds', "Time queued requests waited to be admitted",
+                                   ['lane'], buckets=QUEUE_BUCKETS)
+HUTCHNER_BATCH_SIZE = Histogram('flaskphiid_hutchner_batch_size', "Notes per coalesced HutchNER batch", [],
+                                buckets=BATCH_SIZE_BUCKETS)
+HUTCHNER_QUEUE_SECONDS = Histogram('flaskphiid_hutchner_queue_seconds',
+                                   "Time a note waited for its coalesced HutchNER batch", [], buckets=QUEUE_BUCKETS)
+
+
+def timed_backend(backend, call):
+    """wrap a backend call so that its latency, concurrency and errors are recorded"""
+    @wraps(call)
+    def timed(*args, **kwargs):
+        BACKEND_IN_FLIGHT.inc(backend=backend)
+        started = perf_counter()
+        try:
+            return call(*args, **kwargs)
+        except Exception as e:
+            BACKEND_ERRORS.inc(backend=backend, error=type(e).__name__)
+            raise
+        finally:
+            BACKEND_SECONDS.observe(perf_counter() - started, backend=backend)
+            BACKEND_IN_FLIGHT.dec(backend=backend)
+    return timed
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    """forget every recorded value"""
+    for metric in REGISTRY:
+        metric.clear()
+
+
+bp = Blueprint('metrics', __name__)
+
+
+@bp.route("/metrics", methods=['GET'])
+def metrics():
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
+
+def _request_started():
+    g.metrics_endpoint = request.endpoint or 'unknown'
+    g.metrics_started = perf_counter()
+    REQUESTS_IN_FLIGHT.inc(endpoint=g.metrics_endpoint)
+
+
+def _request_finished(response):
+    # streamed responses are counted when their headers are sent
+    if 'metrics_started' in g:
+        REQUEST_SECONDS.observe(perf_counter() - g.metrics_started, endpoint=g.metrics_endpoint,
+                                status=response.status_code)
+    return response
+
+
+def _request_torn_down(error=None):
+    if 'metrics_started' in g:
+        REQUESTS_IN_FLIGHT.dec(endpoint=g.metrics_endpoint)
+
+
+def init_app(app):
+    if not app.config.get('METRICS_ENABLED'):
+        return
+    app.before_request(_request_started)
+    app.after_request(_request_finished)
+    app.teardown_request(_request_torn_down)
+    app.register_blueprint(bp)
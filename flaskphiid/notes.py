@@ -0,0 +1,99 @@
+"""Steps shared by the Flask views and the ASGI app on either side of the backend calls
+
+Checking the posted note before, how long a backend may take, how its failures map to
+responses, and recording, logging and serializing what was found after; only waiting on
+the backends differs between the two.
+"""
+import json
+import logging
+
+from flaskphiid import redact
+from flaskphiid.compmed_client import CompMedThrottled, CompMedUnavailable
+from flaskphiid.executor import BackendTimeout
+from flaskphiid.hutchner_pool import HutchNERPoolBusy
+from flaskphiid.logconfig import Event, log_payload
+from flaskphiid.metrics import BACKEND_ERRORS, ENTITIES, NOTE_CHARS, STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+NO_TEXT = "No Entity Text was found"
+NOT_TEXT = "extract_text must be a string"
+
+# the 400 message when a backend rejects the note, for /identifyphi and for the single-backend endpoints
+PHI_ERROR_MESSAGES = {
+    'compmed': "An error occurred while calling MedLP",
+    'hutchner': "An error occurred while calling HutchNER",
+}
+ENTITY_ERROR_MESSAGES = {
+    'compmed': "An error occurred while calling Comprehend Medical/MedLPInterface",
+    'hutchner': "An error occurred while calling HutchNER",
+}
+
+
+def posted_note(body):
+    """(note_text, None) for a posted {"extract_text": ...}, otherwise (None, (message, status))"""
+    if not body or not isinstance(body, dict) or 'extract_text' not in body:
+        return None, ("Bad Request", 400)
+    if not body['extract_text']:
+        logger.info("No entities returned")
+        return None, (NO_TEXT, 400)
+    if not isinstance(body['extract_text'], str):
+        return None, (NOT_TEXT, 400)
+    return body['extract_text'], None
+
+
+def redact_mode(body):
+    """(mode, None) for a valid redaction mode, otherwise (None, (message, status))"""
+    mode = body.get('mode', 'tag')
+    if mode not in redact.MODES:
+        return None, ("mode must be one of {}".format(', '.join(redact.MODES)), 400)
+    return mode, None
+
+
+def backend_timeouts(config):
+    """seconds a call to each backend may take before the request gets a 504; None for no limit"""
+    return {'compmed': config.get('COMPMED_TIMEOUT'), 'hutchner': config.get('HUTCHNER_TIMEOUT')}
+
+
+def backend_error(e, messages=PHI_ERROR_MESSAGES):
+    """map a BackendError to the (message, status) returned to the client, or None if it is unexpected"""
+    if isinstance(e, BackendTimeout):
+        # failed calls are counted by timed_backend, timeouts only here
+        BACKEND_ERRORS.inc(backend=e.backend, error='timeout')
+        msg, status = "Timed out waiting for {}".format(e.backend), 504
+    elif isinstance(e.error, CompMedThrottled):
+        msg, status = "Comprehend Medical is throttling requests", 503
+    elif isinstance(e.error, CompMedUnavailable):
+        msg, status = "Comprehend Medical is unavailable", 502
+    elif isinstance(e.error, HutchNERPoolBusy):
+        msg, status = "HutchNER is busy", 503
+    elif isinstance(e.error, ValueError):
+        msg, status = messages[e.backend], 400
+    else:
+        return None
+    logger.warning("{}: {}".format(msg, e.error))
+    return msg, status
+
+
+def serialize(body):
+    with STAGE_SECONDS.time(stage='serialize'):
+        return json.dumps(body)
+
+
+def entities_found(source_logger, source, note_text, entities):
+    """record and log the entities one backend found in a note; returns them as JSON"""
+    NOTE_CHARS.observe(len(note_text))
+    source_logger.info(Event('{}.entities'.format(source), entities=len(entities), note_chars=len(note_text)))
+    log_payload(source_logger, "{} entities".format(source), entities)
+    ENTITIES.observe(len(entities), source=source)
+    return serialize(entities)
+
+
+def redacted(note_text, results, mode, include_spans=False):
+    """the /identifyphi/redact response body for a note and its merged annotations, as JSON"""
+    with STAGE_SECONDS.time(stage='redact'):
+        redacted_text, spans = redact.redact(note_text, results, mode)
+    body = {'redacted_text': redacted_text}
+    if include_spans:
+        body['spans'] = spans
+    return serialize(body)
@@ -0,0 +1,137 @@
+"""Opt-in cProfile capture of single requests
+
+With PROFILING_ENABLED set, a request that carries an `X-Profile: 1` header or a
+`"profile": true` JSON field runs under cProfile from before_request to after_request,
+which covers the whole view: identify_phi, the backend calls and annotation merging.
+Work that would go to the backend and note thread pools runs in the request thread
+instead, so the profile sees it (HutchNER running in a process pool still shows up as
+waiting), and the result cache is bypassed. The profile is saved as <id>.prof under PROFILE_DIR, downloadable from
+/profiles/<id>, and the response gets X-Profile-Id and an X-Profile-Top summary of the
+PROFILE_TOP_N functions with the most time of their own. One request is profiled at a
+time; others that ask while one is running are served normally with X-Profile: busy.
+"""
+import cProfile
+import logging
+import os
+import pstats
+import re
+import threading
+import time
+import uuid
+
+from flask import Blueprint, abort, current_app, g, jsonify, request, send_from_directory
+
+from flaskphiid.executor import set_inline
+
+logger = logging.getLogger(__name__)
+
+PROFILE_ID = re.compile(r'^[0-9a-f]{32}$')
+
+_profiling = threading.Lock()
+_local = threading.local()
+
+bp = Blueprint('profiles', __name__, url_prefix='/profiles')
+
+
+def profile_dir(app=None):
+    app = app or current_app
+    return app.config.get('PROFILE_DIR') or os.path.join(app.instance_path, 'profiles')
+
+
+def is_profiling():
+    """whether the current thread is running a profiled request"""
+    return getattr(_local, 'active', False)
+
+
+def _requested():
+    if request.headers.get('X-Profile', '').lower() in ('1', 'true', 'yes'):
+        return True
+    body = request.get_json(silent=True)
+    return isinstance(body, dict) and body.get('profile') is True
+
+
+def _start_profile():
+    if request.blueprint == bp.name or not _requested():
+        return
+    if not _profiling.acquire(blocking=False):
+        g.profile_busy = True
+        return
+    g.profiler = cProfile.Profile()
+    _local.active = True
+    set_inline(True)
+    g.profiler.enable()
+
+
+def _stop_profile():
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return None
+    profiler.disable()
+    set_inline(False)
+    _local.active = False
+    _profiling.release()
+    return profiler
+
+
+def _finish_profile(response):
+    if g.pop('profile_busy', False):
+        response.headers['X-Profile'] = 'busy'
+    profiler = _stop_profile()
+    if profiler is None:
+        return response
+    # time first, so that ids sort oldest to newest
+    profile_id = '{:016x}{}'.format(time.time_ns(), uuid.uuid4().hex[:16])
+    directory = profile_dir()
+    os.makedirs(directory, exist_ok=True)
+    profiler.dump_stats(os.path.join(directory, profile_id + '.prof'))
+    _prune(directory, current_app.config['PROFILE_KEEP'])
+    stats = pstats.Stats(profiler)
+    response.headers['X-Profile-Id'] = profile_id
+    response.headers['X-Profile-Url'] = '/profiles/{}'.format(profile_id)
+    response.headers['X-Profile-Seconds'] = '{:.4f}'.format(stats.total_tt)
+    response.headers['X-Profile-Top'] = summarize(stats, current_app.config['PROFILE_TOP_N'])
+    logger.info("Profiled {} in {:.3f}s as {}".format(request.path, stats.total_tt, profile_id))
+    return response
+
+
+def _teardown_profile(error=None):
+    # the view raised, so after_request did not run
+    _stop_profile()
+
+
+def summarize(stats, top_n):
+    """'function (file:line) self-seconds', for the top_n functions by their own time"""
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:top_n]
+    return ', '.join('{} ({}:{}) {:.4f}s'.format(function, os.path.basename(filename), line, own_time)
+                     for (filename, line, function), (_, _, own_time, _, _) in rows)
+
+
+def _prune(directory, keep):
+    profiles = sorted((name for name in os.listdir(directory) if name.endswith('.prof')), reverse=True)
+    for name in profiles[keep:]:
+        os.remove(os.path.join(directory, name))
+
+
+@bp.route("/", methods=['GET'])
+def list_profiles():
+    directory = profile_dir()
+    names = os.listdir(directory) if os.path.isdir(directory) else []
+    return jsonify(sorted(name[:-len('.prof')] for name in names if name.endswith('.prof')))
+
+
+@bp.route("/<profile_id>", methods=['GET'])
+def download_profile(profile_id):
+    if not PROFILE_ID.match(profile_id):
+        abort(404)
+    return send_from_directory(profile_dir(), profile_id + '.prof', as_attachment=True,
+                               mimetype='application/octet-stream')
+
+
+def init_app(app):
+    if not app.config.get('PROFILING_ENABLED'):
+        return
+    logger.warning("Request profiling is enabled; profiles are written to {}".format(profile_dir(app)))
+    app.before_request(_start_profile)
+    app.after_request(_finish_profile)
+    app.teardown_request(_teardown_profile)
+    app.register_blueprint(bp)
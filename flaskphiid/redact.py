@@ -0,0 +1,54 @@
+"""Rebuild a note with its PHI spans replaced, in one pass over the merged annotations"""
+
+MODES = ('tag', 'surrogate')
+UNKNOWN_TYPE = 'PHI'
+
+
+def _tag(phi_type, text, seen):
+    return '[{}]'.format(phi_type)
+
+
+def _surrogate(phi_type, text, seen):
+    # the same text gets the same surrogate everywhere in the note, so "Smith" stays
+    # one person; numbering is per type, in order of first appearance
+    surrogates = seen.setdefault(phi_type, {})
+    surrogate = surrogates.get(text)
+    if surrogate is None:
+        surrogate = surrogates[text] = '[{}-{}]'.format(phi_type, len(surrogates) + 1)
+    return surrogate
+
+
+REPLACERS = {'tag': _tag, 'surrogate': _surrogate}
+
+
+def redact(note_text, annotations, mode='tag'):
+    """
+    note_text with each annotation's span replaced by a [TYPE] tag, or in 'surrogate'
+    mode by a [TYPE-n] surrogate that is consistent for repeated text. annotations are
+    merged annotation dicts (start, end, type); they are sorted here, and a span that
+    overlaps the previous one only has its remainder replaced.
+    Returns (redacted text, [{start, end, type, replacement}] in the redacted text).
+    """
+    if mode not in REPLACERS:
+        raise ValueError("unknown redaction mode {}".format(mode))
+    replace = REPLACERS[mode]
+    seen = {}
+    parts = []
+    spans = []
+    position = 0
+    length = 0
+    for ann in sorted(annotations, key=lambda ann: (ann['start'], ann['end'])):
+        start, end = max(ann['start'], position), min(ann['end'], len(note_text))
+        if start >= end:
+            continue
+        phi_type = ann.get('type') or UNKNOWN_TYPE
+        replacement = replace(phi_type, note_text[start:end], seen)
+        parts.append(note_text[position:start])
+        length += start - position
+        parts.append(replacement)
+        spans.append({'start': length, 'end': length + len(replacement), 'type': phi_type,
+                      'replacement': replacement})
+        length += len(replacement)
+        position = end
+    parts.append(note_text[position:])
+    return ''.join(parts), spans
@@ -0,0 +1,95 @@
+"""Production entry point: gunicorn workers forked from a master that has already loaded HutchNER
+
+    python -m flaskphiid.serve --bind 0.0.0.0:5000 --workers 16
+
+The master process creates the app and loads the HutchNER model before forking, then
+freezes the garbage collector so that collections in the workers do not write to (and
+so un-share) the pages holding the model. Workers share those pages copy-on-write
+instead of each unpickling a copy. Point CLINIC_NOTE_CLUSTERS at a cluster table
+(python -m flaskphiid.cluster_table) to share the clusters through the page cache too.
+With HUTCHNER_PROCESSES set, each worker starts its own process pool after the fork.
+Requires gunicorn: pip install FlaskPHI_ID[serve]
+"""
+import argparse
+import gc
+import logging
+
+from flaskphiid import create_app
+from flaskphiid.backends import get_backends
+from flaskphiid.cache import get_cache
+
+logger = logging.getLogger(__name__)
+
+
+def load_app(preload=True):
+    """create the app and load its backends; with preload, ready it to be forked"""
+    app = create_app(warm_up=False)
+    backends = get_backends(app)
+    if preload and app.config['HUTCHNER_PROCESSES']:
+        # a process pool cannot be shared across a fork; workers create their own
+        logger.info("HUTCHNER_PROCESSES is set, HutchNER is loaded in each worker's pool")
+    elif preload:
+        backends.hutchner
+    else:
+        backends.warm_up()
+    if preload:
+        gc.collect()
+        # keep everything loaded so far out of later collections, which would touch it
+        gc.freeze()
+    return app
+
+
+def after_fork(app):
+    """reset the state a forked worker cannot share with the master, then finish warming up"""
+    get_backends(app).after_fork()
+    with app.app_context():
+        cache = get_cache()
+        if cache is not None:
+            cache.after_fork()
+    get_backends(app).warm_up()
+
+
+def run(bind='127.0.0.1:5000', workers=2, threads=8, timeout=120, preload=True):
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise SystemExit("flaskphiid.serve requires gunicorn: pip install FlaskPHI_ID[serve]")
+
+    class Server(BaseApplication):
+
+        def __init__(self):
+            self.application = None
+            super(Server, self).__init__()
+
+        def load_config(self):
+            for name, value in {'bind': bind, 'workers': workers, 'threads': threads, 'timeout': timeout,
+                                'preload_app': preload, 'post_fork': self.post_fork}.items():
+                self.cfg.set(name, value)
+
+        def post_fork(self, server, worker):
+            # without preload the app is created in the worker, after this hook
+            if self.application is not None:
+                after_fork(self.application)
+
+        def load(self):
+            if self.application is None:
+                self.application = load_app(preload=preload)
+            return self.application
+
+    Server().run()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve flaskphiid with gunicorn")
+    parser.add_argument('-b', '--bind', default='127.0.0.1:5000')
+    parser.add_argument('-w', '--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--timeout', type=int, default=120)
+    parser.add_argument('--no-preload', dest='preload', action='store_false',
+                        help="load the app and models separately in each worker")
+    args = parser.parse_args(argv)
+    run(bind=args.bind, workers=args.workers, threads=args.threads, timeout=args.timeout, preload=args.preload)
+
+
+if __name__ == '__main__':
+    main()
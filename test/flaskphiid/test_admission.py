@@ -0,0 +1,196 @@
+import asyncio
+import json
+import threading
+import time
+import unittest
+
+from flaskphiid import create_app
+from flaskphiid.admission import Admission, Rejected, get_admission, lane_for
+from flaskphiid.backends import get_backends
+from flaskphiid.metrics import ADMISSION_REJECTED
+
+
+class AdmissionTests(unittest.TestCase):
+
+    def admit_in_thread(self, admission, client, lane='interactive'):
+        """start admitting in a thread; returns (thread, outcome list)"""
+        outcome = []
+
+        def run():
+            try:
+                admission.admit(client, lane)
+                outcome.append('admitted')
+            except Rejected as e:
+                outcome.append(e)
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread, outcome
+
+    def wait_until_queued(self, admission, count):
+        for _ in range(200):
+            if sum(admission.stats()['queued'].values()) == count:
+                return
+            time.sleep(0.005)
+        self.fail("requests were not queued")
+
+    def test_admits_up_to_max_concurrency(self):
+        admission = Admission(max_concurrency=2, max_queue=0)
+        admission.admit('a')
+        admission.admit('b')
+        with self.assertRaises(Rejected) as raised:
+            admission.admit('c')
+        self.assertEqual(raised.exception.reason, 'queue_full')
+        admission.release('a')
+        admission.admit('c')
+        self.assertEqual(admission.stats()['running'], 2)
+
+    def test_queued_request_gets_the_freed_slot(self):
+        admission = Admission(max_concurrency=1, max_queue=1)
+        admission.admit('a')
+        thread, outcome = self.admit_in_thread(admission, 'b')
+        self.wait_until_queued(admission, 1)
+        self.assertEqual(outcome, [])
+        admission.release('a')
+        thread.join(5)
+        self.assertEqual(outcome, ['admitted'])
+
+    def test_interactive_lane_goes_first(self):
+        admission = Admission(max_concurrency=1, max_queue=2)
+        admission.admit('a')
+        bulk, bulk_outcome = self.admit_in_thread(admission, 'bulk', 'bulk')
+        self.wait_until_queued(admission, 1)
+        interactive, interactive_outcome = self.admit_in_thread(admission, 'interactive')
+        self.wait_until_queued(admission, 2)
+        admission.release('a')
+        interactive.join(5)
+        self.assertEqual(interactive_outcome, ['admitted'])
+        self.assertEqual(bulk_outcome, [])
+        admission.release('interactive')
+        bulk.join(5)
+        self.assertEqual(bulk_outcome, ['admitted'])
+
+    def test_bulk_queue_is_bounded_separately(self):
+        admission = Admission(max_concurrency=1, max_queue=5, max_bulk_queue=0)
+        admission.admit('a')
+        self.assertRaises(Rejected, admission.admit, 'b', 'bulk')
+
+    def test_per_client_limit(self):
+        admission = Admission(max_concurrency=4, max_queue=4, max_per_client=1)
+        admission.admit('a')
+        with self.assertRaises(Rejected) as raised:
+            admission.admit('a')
+        self.assertEqual(raised.exception.reason, 'client_limit')
+        admission.admit('b')
+        admission.release('a')
+        admission.admit('a')
+
+    def test_queue_timeout(self):
+        admission = Admission(max_concurrency=1, max_queue=1, queue_timeout=0.05)
+        admission.admit('a')
+        with self.assertRaises(Rejected) as raised:
+            admission.admit('b')
+        self.assertEqual(raised.exception.reason, 'queue_timeout')
+        self.assertEqual(admission.stats()['queued'], {'interactive': 0, 'bulk': 0})
+        # the timed out client no longer counts against its limit
+        admission.release('a')
+        admission.admit('b')
+
+    def test_retry_after_follows_the_drain_rate(self):
+        admission = Admission(max_concurrency=1, max_queue=0, max_retry_after=60)
+        self.assertEqual(admission.retry_after(10), 1)
+        admission.admit('a')
+        time.sleep(0.2)
+        admission.release('a')
+        self.assertAlmostEqual(admission.drain_rate, 5, delta=1.5)
+        self.assertIn(admission.retry_after(20), (3, 4, 5, 6))
+        self.assertEqual(admission.retry_after(10 ** 6), 60)
+
+    def test_idle_time_does_not_slow_the_drain_rate(self):
+        admission = Admission(max_concurrency=1, max_queue=0)
+        admission.admit('a')
+        admission.release('a')
+        time.sleep(0.2)
+        admission.admit('a')
+        admission.release('a')
+        self.assertGreater(admission.drain_rate, 50)
+
+    def test_admit_async(self):
+        admission = Admission(max_concurrency=1, max_queue=1, queue_timeout=0.2)
+
+        async def run():
+            await admission.admit_async('a')
+            waiting = asyncio.ensure_future(admission.admit_async('b'))
+            await asyncio.sleep(0.01)
+            self.assertFalse(waiting.done())
+            admission.release('a')
+            await asyncio.wait_for(waiting, 5)
+            with self.assertRaises(Rejected):
+                await admission.admit_async('c')
+            admission.release('b')
+
+        asyncio.run(run())
+        self.assertEqual(admission.stats()['running'], 0)
+
+    def test_lane_for(self):
+        self.assertEqual(lane_for({}, 'identifyphi.annotate'), 'interactive')
+        self.assertEqual(lane_for({}, 'identifyphi.annotate_batch'), 'bulk')
+        self.assertEqual(lane_for({'X-Priority': 'bulk'}, 'identifyphi.annotate'), 'bulk')
+        self.assertEqual(lane_for({'X-Priority': 'urgent'}, 'identifyphi.annotate_stream'), 'bulk')
+
+
+class SlowCompMed(object):
+
+    def __init__(self):
+        self.release = threading.Event()
+
+    def get_phi(self, note_text):
+        self.release.wait(5)
+        return []
+
+    def get_entities(self, note_text, entityTypes=None, **kwargs):
+        return self.get_phi(note_text)
+
+
+class AdmissionEndpointTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app({'SECRET_KEY': 'dev', 'TESTING': True, 'LOG_LEVEL': 'WARNING',
+                               'ADMISSION_ENABLED': True, 'ADMISSION_MAX_CONCURRENCY': 1,
+                               'ADMISSION_MAX_QUEUE': 0, 'ADMISSION_MAX_RETRY_AFTER': 30})
+        self.compmed = SlowCompMed()
+        get_backends(self.app).use(compmed=self.compmed)
+
+    def post(self, path, **headers):
+        with self.app.test_client() as client:
+            return client.post(path, data=json.dumps({'extract_text': "John Smith"}),
+                               content_type='application/json', headers=headers)
+
+    def test_disabled_by_default(self):
+        app = create_app({'SECRET_KEY': 'dev', 'TESTING': True})
+        self.assertIsNone(get_admission(app))
+
+    def test_full_queue_gets_429_with_retry_after(self):
+        ADMISSION_REJECTED.clear()
+        first = []
+        thread = threading.Thread(target=lambda: first.append(self.post('/compmed/phi')))
+        thread.start()
+        for _ in range(200):
+            if get_admission(self.app).stats()['running']:
+                break
+            time.sleep(0.005)
+        response = self.post('/compmed/phi')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        self.assertEqual(ADMISSION_REJECTED.value(lane='interactive', reason='queue_full'), 1)
+        # health checks are not admission controlled
+        with self.app.test_client() as client:
+            self.assertEqual(client.get('/healthz').status_code, 200)
+        self.compmed.release.set()
+        thread.join(5)
+        self.assertEqual(first[0].status_code, 200)
+        self.assertEqual(get_admission(self.app).stats()['running'], 0)
+        self.assertEqual(self.post('/compmed/phi').status_code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,7 @@
 from unittest import TestCase
 
+from hypothesis import given, settings, strategies as st
+
 from flaskphiid.annotation import Annotation, AnnotationFactory, MergedAnnotation
 from flaskphiid.annotation import unionize_annotations
 from flaskphiid.annotation import IncompatibleTypeException
@@ -367,5 +369,76 @@ class AnnotationTest(TestCase):
         self.assertEqual(actual[0], merged)
 
 
+def reference_split_annotations_by_subtypes(merged):
+    """the original run-by-run split, kept as the equivalence oracle"""
+    if (len(merged.source_types) == 1) or (len(merged.source_child_types) == 1):
+        return [merged]
+    if len(merged.source_parent_types) == 1:
+        if (merged.start < min([a.start for a in merged.source_child_annotations]) or
+                merged.end > max([a.end for a in merged.source_child_annotations])):
+            return [merged]
+        subtyped_annotations = []
+        running_annos = []
+        for anno in merged.source_child_annotations:
+            if anno.origin.lower() == 'compmed':
+                continue
+            if not running_annos or anno.type == running_annos[-1].type:
+                running_annos.append(anno)
+                continue
+            subtyped_annotations.extend(AnnotationFactory.from_unsplittable_annotations(running_annos))
+            running_annos = [anno]
+        subtyped_annotations.extend(AnnotationFactory.from_unsplittable_annotations(running_annos))
+        return subtyped_annotations
+    raise IncompatibleTypeException("Cannot split by subtype for multiple parent types", merged.source_parent_types)
+
+
+ADDRESS_CHILD_TYPES = ["HOSPITAL_NAME", "WARD", "SPECIALTY"]
+
+
+@st.composite
+def touching_tokens(draw):
+    """an ADDRESS entity covered by touching HutchNER tokens of address child types"""
+    lengths = draw(st.lists(st.integers(min_value=1, max_value=6), min_size=1, max_size=40))
+    tokens, start = [], 0
+    for length in lengths:
+        tokens.append({"start": start, "stop": start + length, "text": "x" * length,
+                       "confidence": draw(st.floats(min_value=0.0, max_value=1.0)),
+                       "label": draw(st.sampled_from(ADDRESS_CHILD_TYPES))})
+        start += length
+    compmed_end = draw(st.integers(min_value=1, max_value=start + 2))
+    compmed = {"BeginOffset": 0, "EndOffset": compmed_end, "Score": 0.9, "Text": "x" * compmed_end,
+               "Type": "ADDRESS"}
+    return compmed, tokens
+
+
+class SinglePassSplitTest(TestCase):
+
+    def merge(self, compmed, tokens, note_text=None):
+        merged = MergedAnnotation(note_text)
+        anns = [AnnotationFactory.from_compmed(compmed)] + [AnnotationFactory.from_hutchner(t) for t in tokens]
+        for ann in sorted(anns, key=lambda ann: ann.start):
+            merged.add_annotation(ann)
+        return merged
+
+    @settings(max_examples=300, deadline=None)
+    @given(touching_tokens())
+    def test_matches_reference_split(self, case):
+        compmed, tokens = case
+        expected = [ann.to_dict(detailed=True)
+                    for ann in reference_split_annotations_by_subtypes(self.merge(compmed, tokens))]
+        actual = [ann.to_dict(detailed=True) for ann in self.merge(compmed, tokens).split_annotations_by_subtypes()]
+        self.assertEqual(actual, expected)
 
+    def test_runs_span_whitespace(self):
+        note = "Sesame Hospital Sick Burns Unit"
+        words = [(0, 6, "HOSPITAL_NAME"), (7, 15, "HOSPITAL_NAME"),
+                 (16, 20, "SPECIALTY"), (21, 26, "SPECIALTY"), (27, 31, "SPECIALTY")]
+        tokens = [{"start": start, "stop": stop, "text": note[start:stop], "confidence": 0.9, "label": label}
+                  for start, stop, label in words]
+        compmed = {"BeginOffset": 0, "EndOffset": 31, "Score": 0.9, "Text": note, "Type": "ADDRESS"}
+        for note_text in (note, None):
+            actual = self.merge(compmed, tokens, note_text).split_annotations_by_subtypes()
+            self.assertEqual([(ann.type, ann.start, ann.end, ann.text) for ann in actual],
+                             [("HOSPITAL_NAME", 0, 15, "Sesame Hospital"), ("SPECIALTY", 16, 31, "Sick Burns Unit")])
+            self.assertEqual(len(actual[1].source_annotations), 3)
 
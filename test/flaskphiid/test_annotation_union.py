@@ -0,0 +1,152 @@
+from unittest import TestCase
+
+from hypothesis import given, settings, strategies as st
+
+from flaskphiid.annotation import AnnotationFactory, MergedAnnotation, TYPE_THRESHOLD
+from flaskphiid.annotation import unionize_annotations
+
+
+NOTE_LENGTH = 300
+COMPMED_TYPES = ["NAME", "ADDRESS", "ID", "AGE", "PROFESSION", "DATE"]
+HUTCHNER_TYPES = ["WARD", "SPECIALTY", "HOSPITAL_NAME", "MEDICAL_RECORD_NUMBER",
+                  "PATIENT_OR_FAMILY_NAME", "PROVIDER_NAME", "EMPLOYER", "AGE", "DATE"]
+NOTE_TEXT = "".join(chr(ord('a') + (i % 26)) for i in range(NOTE_LENGTH))
+
+
+def reference_unionize_annotations(annotations):
+    """the original per-character scan, kept as the equivalence oracle"""
+    if not annotations:
+        return []
+    sorted_anns = sorted(annotations, key=lambda x: x.start)
+    final_anns = []
+    current_anns = []
+    for idx in range(0, max([ann.end for ann in annotations])):
+        if current_anns and all((ann.end <= idx) for ann in current_anns):
+            final_anns.extend(AnnotationFactory.from_annotations(current_anns))
+            current_anns = []
+        while sorted_anns and (sorted_anns[0].start == idx):
+            current_anns.append(sorted_anns.pop(0))
+    if current_anns:
+        final_anns.extend(AnnotationFactory.from_annotations(current_anns))
+    return final_anns
+
+
+def reference_type_and_score(anns):
+    """type/score resolution recomputed from scratch over the source annotations"""
+    types = set(a.type for a in anns)
+    parents = set(a.parent_type for a in anns)
+    children = [a for a in anns if a.type != a.parent_type]
+    if len(types) == 1:
+        return anns[0].type, max(a.score for a in anns)
+    if len(parents) == 1:
+        top = max(children, key=lambda a: a.score)
+        if len(set(a.type for a in children)) == 1:
+            top_type = children[0].type
+        elif top.score >= TYPE_THRESHOLD:
+            top_type = top.type
+        else:
+            top_type = anns[0].parent_type
+        if top.score >= TYPE_THRESHOLD:
+            return top_type, top.score
+        return top_type, max(a.score for a in anns)
+    return "UNKNOWN", TYPE_THRESHOLD
+
+
+@st.composite
+def annotation_specs(draw):
+    start = draw(st.integers(min_value=0, max_value=NOTE_LENGTH - 1))
+    end = draw(st.integers(min_value=start + 1, max_value=min(NOTE_LENGTH, start + 40)))
+    score = draw(st.floats(min_value=0.0, max_value=1.0))
+    if draw(st.booleans()):
+        return 'compmed', {"BeginOffset": start, "EndOffset": end, "Score": score,
+                           "Text": NOTE_TEXT[start:end], "Type": draw(st.sampled_from(COMPMED_TYPES))}
+    return 'hutchner', {"start": start, "stop": end, "confidence": score,
+                        "text": NOTE_TEXT[start:end], "label": draw(st.sampled_from(HUTCHNER_TYPES))}
+
+
+def build_annotations(specs):
+    anns = []
+    for origin, spec in specs:
+        if origin == 'compmed':
+            anns.append(AnnotationFactory.from_compmed(spec))
+        else:
+            anns.append(AnnotationFactory.from_hutchner(spec))
+    return anns
+
+
+class UnionizeEquivalenceTest(TestCase):
+
+    @settings(max_examples=300, deadline=None)
+    @given(st.lists(annotation_specs(), max_size=25))
+    def test_matches_reference_implementation(self, specs):
+        expected = [ann.to_dict(detailed=True)
+                    for ann in reference_unionize_annotations(build_annotations(specs))]
+        actual = [ann.to_dict(detailed=True)
+                  for ann in unionize_annotations(build_annotations(specs))]
+        self.assertEqual(actual, expected)
+
+    def test_touching_spans_are_not_merged(self):
+        anns = build_annotations([
+            ('hutchner', {"start": 0, "stop": 5, "confidence": 0.9, "text": NOTE_TEXT[0:5], "label": "AGE"}),
+            ('hutchner', {"start": 5, "stop": 9, "confidence": 0.9, "text": NOTE_TEXT[5:9], "label": "AGE"}),
+        ])
+        union = unionize_annotations(anns)
+        self.assertEqual(len(union), 2)
+
+    def test_long_note_sparse_spans(self):
+        offset = 200000
+        anns = build_annotations([
+            ('compmed', {"BeginOffset": offset, "EndOffset": offset + 4, "Score": 0.9,
+                         "Text": "Test", "Type": "NAME"}),
+            ('hutchner', {"start": offset + 2, "stop": offset + 8, "confidence": 0.2,
+                          "text": "stJohn", "label": "PROVIDER_NAME"}),
+        ])
+        union = unionize_annotations(anns)
+        self.assertEqual(len(union), 1)
+        self.assertEqual(union[0].text, "TestJohn")
+        self.assertEqual(union[0].start, offset)
+        self.assertEqual(union[0].end, offset + 8)
+
+
+class NoteTextTest(TestCase):
+
+    @settings(max_examples=200, deadline=None)
+    @given(st.lists(annotation_specs(), max_size=25))
+    def test_text_is_note_slice(self, specs):
+        without_note = unionize_annotations(build_annotations(specs))
+        with_note = unionize_annotations(build_annotations(specs), NOTE_TEXT)
+        # the sources here agree with the note, so both ways give the same text
+        self.assertEqual([ann.to_dict(detailed=True) for ann in with_note],
+                         [ann.to_dict(detailed=True) for ann in without_note])
+        for ann in with_note:
+            self.assertEqual(ann.text, NOTE_TEXT[ann.start:ann.end])
+
+    def test_disagreeing_sources(self):
+        note = "Mr John Smithson was seen"
+        anns = build_annotations([
+            ('compmed', {"BeginOffset": 3, "EndOffset": 13, "Score": 0.9, "Text": "John Smith", "Type": "NAME"}),
+            # text from a differently normalized copy of the note
+            ('hutchner', {"start": 8, "stop": 16, "confidence": 0.9, "text": "SMITHSON", "label": "PROVIDER_NAME"}),
+        ])
+        self.assertEqual(unionize_annotations(anns)[0].text, "John SmithSON")
+        self.assertEqual(unionize_annotations(anns, note)[0].text, "John Smithson")
+
+
+class MergedAggregateTest(TestCase):
+
+    @settings(max_examples=300, deadline=None)
+    @given(st.lists(annotation_specs(), min_size=1, max_size=25))
+    def test_incremental_type_and_score(self, specs):
+        anns = build_annotations(specs)
+        # force every annotation to overlap the first so they can all be merged
+        for ann in anns:
+            ann.start, ann.end, ann.text = 0, NOTE_LENGTH, NOTE_TEXT
+        merged = MergedAnnotation()
+        for idx, ann in enumerate(anns):
+            merged.add_annotation(ann)
+            added = anns[:idx + 1]
+            self.assertEqual((merged.type, merged.score), reference_type_and_score(added))
+            self.assertEqual(merged.source_types, set(a.type for a in added))
+            self.assertEqual(merged.source_parent_types, set(a.parent_type for a in added))
+            self.assertEqual(merged.source_child_types,
+                             set(a.type for a in added if a.type != a.parent_type))
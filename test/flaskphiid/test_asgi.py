@@ -0,0 +1,228 @@
+import asyncio
+import json
+import time
+import unittest
+
+from flaskphiid import create_app
+from flaskphiid.asgi import create_asgi_app
+from flaskphiid.backends import get_backends
+from flaskphiid.compmed_client import CompMedThrottled
+
+NOTE = "Mr. John Smith is a 48 yo teacher"
+COMPMED_PHI = [{"BeginOffset": 4, "EndOffset": 14, "Score": 0.99, "Text": "John Smith", "Type": "NAME"}]
+HUTCHNER_PHI = [{"start": 4, "stop": 8, "confidence": 0.9, "text": "John", "label": "PATIENT_OR_FAMILY_NAME"},
+                {"start": 9, "stop": 14, "confidence": 0.8, "text": "Smith", "label": "PATIENT_OR_FAMILY_NAME"},
+                {"start": 15, "stop": 17, "confidence": 0.9, "text": "is", "label": "O"}]
+
+
+class StubCompMed(object):
+
+    def __init__(self, delay=0, error=None):
+        self.delay = delay
+        self.error = error
+
+    def get_phi(self, note_text):
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return list(COMPMED_PHI)
+
+    def get_entities(self, note_text, entityTypes=None, **kwargs):
+        self.get_phi(note_text)
+        return [dict(COMPMED_PHI[0], Category='PROTECTED_HEALTH_INFORMATION')]
+
+
+class AsyncStubCompMed(object):
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.in_flight = 0
+        self.most_in_flight = 0
+        self.closed = False
+
+    async def get_phi(self, note_text):
+        self.in_flight += 1
+        self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.in_flight -= 1
+        return list(COMPMED_PHI)
+
+    async def get_entities(self, note_text, entityTypes=None, **kwargs):
+        return await self.get_phi(note_text)
+
+    async def close(self):
+        self.closed = True
+
+
+class StubPrediction(object):
+    NER_token_labels = HUTCHNER_PHI
+
+    def to_json(self):
+        return HUTCHNER_PHI
+
+
+class StubHutchNER(object):
+
+    def __init__(self, delay=0, error=None):
+        self.delay = delay
+        self.error = error
+
+    def predict(self, note_text, **kwargs):
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return StubPrediction()
+
+
+def call(asgi_app, method, path, body=None, headers=None):
+    """drive one request through an ASGI app; returns (status, headers, body)"""
+    return asyncio.run(_call(asgi_app, method, path, body, headers))
+
+
+async def _call(asgi_app, method, path, body=None, headers=None):
+    if body is not None and not isinstance(body, bytes):
+        body = json.dumps(body).encode('utf-8')
+        headers = dict({'content-type': 'application/json'}, **(headers or {}))
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': b'', 'root_path': '',
+             'headers': [(name.encode('latin-1'), value.encode('latin-1')) for name, value in (headers or {}).items()],
+             'server': ('testserver', 80), 'client': ('127.0.0.1', 1234), 'scheme': 'http', 'http_version': '1.1'}
+    messages = [{'type': 'http.request', 'body': body or b'', 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    await asgi_app(scope, receive, send)
+    start = sent[0]
+    return start['status'], dict(start['headers']), b''.join(m.get('body', b'') for m in sent[1:])
+
+
+class ASGITests(unittest.TestCase):
+
+    def setUp(self):
+        self.flask_app = create_app({'SECRET_KEY': 'dev', 'TESTING': True, 'LOG_LEVEL': 'WARNING',
+                                     'RESULT_CACHE_ENABLED': False, 'COMPMED_TIMEOUT': 5, 'HUTCHNER_TIMEOUT': 5})
+        get_backends(self.flask_app).use(compmed=StubCompMed(), hutchner=StubHutchNER())
+        self.asgi_app = create_asgi_app(self.flask_app)
+        self.client = self.flask_app.test_client()
+
+    def assert_same_error_as_flask(self, path, status):
+        asgi_status, headers, content = call(self.asgi_app, 'POST', path, {'extract_text': NOTE})
+        response = self.client.post(path, data=json.dumps({'extract_text': NOTE}), content_type='application/json')
+        self.assertEqual((asgi_status, content), (response.status_code, response.data), path)
+        self.assertEqual(asgi_status, status, path)
+
+    def assert_same_as_flask(self, path, body):
+        status, headers, content = call(self.asgi_app, 'POST', path, body)
+        response = self.client.post(path, data=json.dumps(body), content_type='application/json')
+        self.assertEqual(status, response.status_code)
+        self.assertEqual(json.loads(content), response.json)
+        self.assertEqual(headers[b'content-type'], b'application/json')
+
+    def test_same_json_as_the_flask_routes(self):
+        self.assert_same_as_flask('/identifyphi/', {'extract_text': NOTE})
+        self.assert_same_as_flask('/identifyphi', {'extract_text': NOTE, 'annotation_by_source': True})
+        self.assert_same_as_flask('/identifyphi/redact', {'extract_text': NOTE, 'mode': 'surrogate',
+                                                          'include_spans': True})
+        self.assert_same_as_flask('/compmed/phi', {'extract_text': NOTE})
+        self.assert_same_as_flask('/compmed/', {'extract_text': NOTE})
+        self.assert_same_as_flask('/hutchner/phi', {'extract_text': NOTE})
+        self.assert_same_as_flask('/hutchner/', {'extract_text': NOTE})
+
+    def test_bad_requests(self):
+        self.assertEqual(call(self.asgi_app, 'POST', '/identifyphi/', {'extract_text': ''})[0], 400)
+        self.assertEqual(call(self.asgi_app, 'POST', '/identifyphi/', {'text': NOTE})[0], 400)
+        self.assertEqual(call(self.asgi_app, 'POST', '/identifyphi/', b'{not json',
+                              {'content-type': 'application/json'})[0], 400)
+        self.assertEqual(call(self.asgi_app, 'POST', '/identifyphi/redact', {'extract_text': NOTE, 'mode': 'x'})[0],
+                         400)
+
+    def test_backend_errors_map_to_the_same_statuses(self):
+        compmed_paths = ('/identifyphi/', '/identifyphi/redact', '/compmed/', '/compmed/phi')
+        get_backends(self.flask_app).use(compmed=StubCompMed(error=CompMedThrottled("slow down")))
+        for path in compmed_paths:
+            self.assert_same_error_as_flask(path, 503)
+        get_backends(self.flask_app).use(compmed=StubCompMed(error=ValueError("bad text")))
+        for path in compmed_paths:
+            self.assert_same_error_as_flask(path, 400)
+        get_backends(self.flask_app).use(compmed=StubCompMed(), hutchner=StubHutchNER(error=ValueError("bad text")))
+        for path in ('/identifyphi/', '/hutchner/phi'):
+            self.assert_same_error_as_flask(path, 400)
+
+    def test_backend_timeouts_are_the_same(self):
+        self.flask_app.config.update(COMPMED_TIMEOUT=0.05, HUTCHNER_TIMEOUT=0.05)
+        get_backends(self.flask_app).use(compmed=StubCompMed(delay=0.3))
+        for path in ('/identifyphi/', '/compmed/', '/compmed/phi'):
+            self.assert_same_error_as_flask(path, 504)
+        get_backends(self.flask_app).use(compmed=StubCompMed(), hutchner=StubHutchNER(delay=0.3))
+        for path in ('/identifyphi/', '/hutchner/phi'):
+            self.assert_same_error_as_flask(path, 504)
+
+    def test_slow_backend_times_out(self):
+        self.flask_app.config['COMPMED_TIMEOUT'] = 0.05
+        get_backends(self.flask_app).use(compmed=StubCompMed(delay=0.5))
+        status, headers, content = call(self.asgi_app, 'POST', '/identifyphi/', {'extract_text': NOTE})
+        self.assertEqual(status, 504)
+
+    def test_slow_upstream_calls_do_not_hold_threads(self):
+        compmed = AsyncStubCompMed(delay=0.2)
+        get_backends(self.flask_app).use(async_compmed=compmed)
+
+        async def many():
+            return await asyncio.gather(*[_call(self.asgi_app, 'POST', '/compmed/phi', {'extract_text': NOTE})
+                                          for _ in range(500)])
+
+        started = time.monotonic()
+        responses = asyncio.run(many())
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual({status for status, headers, content in responses}, {200})
+        self.assertEqual(compmed.most_in_flight, 500)
+
+    def test_admission_control_rejects_with_retry_after(self):
+        self.flask_app.config.update(ADMISSION_ENABLED=True, ADMISSION_MAX_CONCURRENCY=1, ADMISSION_MAX_QUEUE=0)
+        from flaskphiid import admission
+        admission.init_app(self.flask_app)
+        get_backends(self.flask_app).use(async_compmed=AsyncStubCompMed(delay=0.1))
+
+        async def two():
+            return await asyncio.gather(*[_call(self.asgi_app, 'POST', '/compmed/phi', {'extract_text': NOTE})
+                                          for _ in range(2)])
+
+        (first, first_headers, _), (second, second_headers, _) = asyncio.run(two())
+        self.assertEqual((first, second), (200, 429))
+        self.assertEqual(second_headers[b'retry-after'], b'1')
+        self.assertEqual(admission.get_admission(self.flask_app).stats()['running'], 0)
+
+    def test_other_routes_go_to_flask(self):
+        status, headers, content = call(self.asgi_app, 'GET', '/healthz')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(content), {'status': 'ok'})
+        status, headers, content = call(self.asgi_app, 'POST', '/identifyphi/batch',
+                                        {'notes': [{'id': 1, 'extract_text': NOTE}]})
+        self.assertEqual(status, 200)
+        self.assertEqual(list(json.loads(content)['results']), ['1'])
+
+    def test_lifespan_closes_the_async_client(self):
+        compmed = AsyncStubCompMed()
+        get_backends(self.flask_app).use(async_compmed=compmed)
+        messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message['type'])
+
+        asyncio.run(self.asgi_app({'type': 'lifespan'}, receive, send))
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        self.assertTrue(compmed.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
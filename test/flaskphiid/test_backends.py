@@ -0,0 +1,90 @@
+import subprocess
+import sys
+import unittest
+from unittest.mock import patch
+
+from flaskphiid import create_app
+from flaskphiid.backends import get_backends, start_warm_up
+
+
+class ImportTests(unittest.TestCase):
+
+    def test_import_does_not_load_backends(self):
+        # a fresh interpreter, so modules imported by other tests do not count
+        code = ("import sys, flaskphiid, flaskphiid.annotation; "
+                "print(','.join(m for m in ('boto3', 'HutchNERPredict') if m in sys.modules))")
+        output = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEqual(output.strip(), b'')
+
+
+class BackendsTests(unittest.TestCase):
+
+    def setUp(self):
+        patchers = [patch('HutchNERPredict.hutchner.HutchNER.load_model'),
+                    patch('HutchNERPredict.hutchner.HutchNER.load_clusters')]
+        self.load_model, self.load_clusters = [patcher.start() for patcher in patchers]
+        for patcher in patchers:
+            self.addCleanup(patcher.stop)
+        self.flask_app = create_app({'SECRET_KEY': 'dev',
+                                     'TESTING': True,
+                                     'HUTCHNER_MODEL': "test_resources/simple_crf_ner.pkl",
+                                     'CLINIC_NOTE_CLUSTERS': "test_resources/clusters.pkl",
+                                     'COMPMED_REGION': 'us-west-2'})
+        self.app = self.flask_app.test_client()
+        self.backends = get_backends(self.flask_app)
+
+    def test_create_app_does_not_load_models(self):
+        self.load_model.assert_not_called()
+        self.assertEqual(self.backends.status, {'compmed': False, 'hutchner': False})
+
+    def test_backends_load_on_first_use(self):
+        hutchner = self.backends.hutchner
+        self.assertIs(self.backends.hutchner, hutchner)
+        self.load_model.assert_called_once_with(input_path="test_resources/simple_crf_ner.pkl")
+        self.load_clusters.assert_called_once_with(input_path="test_resources/clusters.pkl")
+        self.assertEqual(self.backends.status, {'compmed': False, 'hutchner': True})
+
+    def test_after_fork_keeps_model(self):
+        self.backends.warm_up()
+        hutchner = self.backends.hutchner
+        self.backends.after_fork()
+        self.assertEqual(self.backends.status, {'compmed': False, 'hutchner': True})
+        self.assertIs(self.backends.hutchner, hutchner)
+        self.assertEqual(self.load_model.call_count, 1)
+
+    def test_healthz(self):
+        result = self.app.get('/healthz')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.get_json(), {'status': 'ok'})
+
+    def test_readyz_after_warm_up(self):
+        result = self.app.get('/readyz')
+        self.assertEqual(result.status_code, 503)
+        self.assertEqual(result.get_json()['backends'], {'compmed': False, 'hutchner': False})
+
+        start_warm_up(self.flask_app).join()
+        result = self.app.get('/readyz')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.get_json()['status'], 'ready')
+        self.assertIn('warm_up_seconds', result.get_json())
+
+    def test_warm_up_failure_does_not_hide_the_other_backend(self):
+        with patch('flaskphiid.compmed_client.CompMedClient._create_client', side_effect=RuntimeError("no region")):
+            with self.assertLogs('flaskphiid.backends', 'ERROR'):
+                self.backends.warm_up()
+        self.assertEqual(self.backends.status, {'compmed': False, 'hutchner': True})
+        self.assertIsNotNone(self.backends.warm_up_seconds)
+        self.assertEqual(self.app.get('/readyz').status_code, 503)
+        # compmed was never published, so the next use builds it again
+        self.assertIsNotNone(self.backends.compmed.client)
+        self.assertEqual(self.backends.status, {'compmed': True, 'hutchner': True})
+
+    def test_status_follows_the_underlying_compmed_client(self):
+        self.backends.warm_up()
+        self.assertTrue(self.backends.status['compmed'])
+        self.backends.compmed.configure(read_timeout=5)
+        self.assertFalse(self.backends.status['compmed'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from contextlib import redirect_stderr, redirect_stdout
+from io import StringIO
+
+from benchmarks import run
+from benchmarks.notes import generate_corpus, OVERLAP_PATTERNS
+
+
+class NoteGeneratorTests(unittest.TestCase):
+
+    def test_offsets_match_text(self):
+        for overlap in OVERLAP_PATTERNS + ('mixed',):
+            for note in generate_corpus(5, seed=1, length=500, phi_density=0.2, overlap=overlap):
+                self.assertGreaterEqual(len(note.text), 500)
+                for entity in note.compmed:
+                    self.assertEqual(note.text[entity['BeginOffset']:entity['EndOffset']], entity['Text'])
+                for token in note.hutchner_tokens:
+                    self.assertEqual(note.text[token['start']:token['stop']], token['text'])
+
+    def test_reproducible_and_density(self):
+        self.assertEqual(generate_corpus(3, seed=7), generate_corpus(3, seed=7))
+        self.assertNotEqual(generate_corpus(3, seed=7), generate_corpus(3, seed=8))
+        sparse = sum(len(note.compmed) for note in generate_corpus(5, phi_density=0.01))
+        dense = sum(len(note.compmed) for note in generate_corpus(5, phi_density=0.2))
+        self.assertGreater(dense, sparse)
+        self.assertRaises(ValueError, generate_corpus, 1, overlap='sideways')
+
+
+class BenchmarkRunnerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def run_main(self, *args):
+        with redirect_stdout(StringIO()), redirect_stderr(StringIO()):
+            return run.main(['--notes', '3', '--length', '300', '--repeat', '2', '--min-time', '0'] + list(args))
+
+    def test_baseline_round_trip(self):
+        baseline = os.path.join(self.dir, 'baseline.json')
+        self.assertEqual(self.run_main('--save-baseline', baseline), 0)
+        with open(baseline) as f:
+            results = json.load(f)
+        self.assertEqual(set(results['results']), set(run.BENCHMARKS))
+
+        # a baseline that was ten times faster is a regression
+        for result in results['results'].values():
+            result['median_s'] /= 10
+        with open(baseline, 'w') as f:
+            json.dump(results, f)
+        self.assertEqual(self.run_main('--only', 'to_dict', '--compare', baseline), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
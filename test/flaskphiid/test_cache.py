@@ -0,0 +1,102 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from flask import Flask
+
+from flaskphiid.cache import ResultCache, backend_version
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.db_path = os.path.join(self.tmpdir.name, 'flaskphiid.sqlite')
+
+    def test_key_depends_on_note_options_and_version(self):
+        cache = ResultCache(max_bytes=1000, version='v1')
+        key = cache.key("note", detailed=False)
+        self.assertEqual(key, cache.key("note", detailed=False))
+        self.assertNotEqual(key, cache.key("other note", detailed=False))
+        self.assertNotEqual(key, cache.key("note", detailed=True))
+        self.assertNotEqual(key, ResultCache(max_bytes=1000, version='v2').key("note", detailed=False))
+
+    def test_version_covers_settings_that_change_results(self):
+        app = Flask(__name__)
+        app.config.update(RESULT_CACHE_VERSION=3, COMPMED_MAX_CHARS=20000, COMPMED_CHUNK_OVERLAP=200,
+                          HUTCHNER_AGGREGATE_SPANS=True, HUTCHNER_SPAN_REDUCER='max')
+        versions = {backend_version(app)}
+        for name, value in [('HUTCHNER_SPAN_REDUCER', 'mean'), ('HUTCHNER_AGGREGATE_SPANS', False),
+                            ('COMPMED_MAX_CHARS', 10000)]:
+            app.config[name] = value
+            versions.add(backend_version(app))
+        self.assertEqual(len(versions), 4)
+
+    def test_hits_and_misses(self):
+        cache = ResultCache(max_bytes=1000)
+        key = cache.key("note")
+        self.assertIsNone(cache.get(key))
+        cache.set(key, "[]")
+        self.assertEqual(cache.get(key), "[]")
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_lru_eviction_by_size(self):
+        cache = ResultCache(max_bytes=10)
+        cache.set('a', "aaaa")
+        cache.set('b', "bbbb")
+        cache.get('a')
+        cache.set('c', "cccc")
+        self.assertEqual(cache.get('a'), "aaaa")
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), "cccc")
+        self.assertLessEqual(cache.stats()['bytes'], 10)
+        cache.set('d', "x" * 11)
+        self.assertIsNone(cache.get('d'))
+
+    def test_size_is_counted_in_utf8_bytes(self):
+        cache = ResultCache(max_bytes=10)
+        # four characters, eight bytes
+        cache.set('a', "éééé")
+        self.assertEqual(cache.stats()['bytes'], 8)
+        cache.set('b', "bbb")
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['bytes'], 3)
+        cache.set('c', "é" * 6)
+        self.assertIsNone(cache.get('c'))
+
+    def test_ttl_expiry(self):
+        cache = ResultCache(max_bytes=1000, ttl=60, db_path=self.db_path)
+        with patch('flaskphiid.cache.time', return_value=1000.0):
+            cache.set('a', "[]")
+        with patch('flaskphiid.cache.time', return_value=1059.0):
+            self.assertEqual(cache.get('a'), "[]")
+        with patch('flaskphiid.cache.time', return_value=1061.0):
+            self.assertIsNone(cache.get('a'))
+
+    def test_sqlite_tier_survives_restart(self):
+        cache = ResultCache(max_bytes=1000, db_path=self.db_path)
+        key = cache.key("note")
+        cache.set(key, "[1]")
+        restarted = ResultCache(max_bytes=1000, db_path=self.db_path)
+        self.assertEqual(restarted.get(key), "[1]")
+        self.assertEqual(restarted.stats()['disk_hits'], 1)
+
+    def test_invalidation(self):
+        cache = ResultCache(max_bytes=1000, db_path=self.db_path)
+        note_keys = [cache.key("note", detailed=False), cache.key("note", detailed=True)]
+        other_key = cache.key("other note")
+        for key in note_keys + [other_key]:
+            cache.set(key, "[]")
+        cache.invalidate_note("note")
+        self.assertEqual([cache.get(key) for key in note_keys], [None, None])
+        self.assertEqual(cache.get(other_key), "[]")
+        cache.clear()
+        self.assertIsNone(cache.get(other_key))
+        self.assertIsNone(ResultCache(max_bytes=1000, db_path=self.db_path).get(other_key))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+from unittest import TestCase
+
+from flaskphiid.chunking import chunk_text, merge_chunk_entities
+
+
+class ChunkingTest(TestCase):
+
+    def setUp(self):
+        self.note_text = ("Patient is Mr. John Smith. He is a teacher in Seattle.\n\n"
+                          "Seen by Dr. Jane Doe on October 5th. Follow up with Dr. Jane Doe in two weeks. "
+                          "Call (555) 867-5309 with questions.")
+
+    def entity(self, begin, end, score=0.9, entity_type="NAME", text=None):
+        return {"Id": 0, "BeginOffset": begin, "EndOffset": end, "Score": score, "Type": entity_type,
+                "Text": text, "Category": "PROTECTED_HEALTH_INFORMATION", "Traits": []}
+
+    def test_short_note_is_one_window(self):
+        self.assertEqual(chunk_text(self.note_text, 1000), [(0, self.note_text)])
+
+    def test_windows_cover_note_within_limit(self):
+        for max_chars, overlap in [(40, 0), (40, 10), (60, 20), (25, 12)]:
+            windows = chunk_text(self.note_text, max_chars, overlap)
+            self.assertGreater(len(windows), 1)
+            covered_to = 0
+            for offset, chunk in windows:
+                self.assertLessEqual(len(chunk), max_chars)
+                self.assertEqual(self.note_text[offset:offset + len(chunk)], chunk)
+                self.assertLessEqual(offset, covered_to)
+                covered_to = offset + len(chunk)
+            self.assertEqual(covered_to, len(self.note_text))
+
+    def test_prefers_paragraph_and_sentence_boundaries(self):
+        windows = chunk_text(self.note_text, 70, 0)
+        self.assertTrue(windows[0][1].endswith("\n\n"))
+        self.assertTrue(windows[1][1].rstrip().endswith("."))
+
+    def test_windows_overlap_at_word_boundaries(self):
+        windows = chunk_text(self.note_text, 60, 20)
+        for (prev_offset, prev_chunk), (offset, chunk) in zip(windows, windows[1:]):
+            self.assertLess(offset, prev_offset + len(prev_chunk))
+            self.assertTrue(self.note_text[offset - 1].isspace())
+
+    def test_single_window_results_pass_through(self):
+        entities = [self.entity(15, 25)]
+        self.assertIs(merge_chunk_entities(self.note_text, [(0, self.note_text)], [entities]), entities)
+
+    def test_offsets_remapped_and_seam_duplicates_merged(self):
+        text = self.note_text
+        begin = text.index("Jane Doe")
+        windows = [(0, text[:begin + 4]), (begin - 4, text[begin - 4:])]
+        results = [
+            [self.entity(15, 25), self.entity(begin, begin + 4, score=0.6)],
+            [self.entity(4, 12, score=0.8), self.entity(text.rindex("Jane Doe") - begin + 4,
+                                                        text.rindex("Jane Doe") - begin + 12)],
+        ]
+        merged = merge_chunk_entities(text, windows, results)
+        self.assertEqual([(e['BeginOffset'], e['EndOffset']) for e in merged],
+                         [(15, 25), (begin, begin + 8), (text.rindex("Jane Doe"), text.rindex("Jane Doe") + 8)])
+        self.assertEqual(merged[1]['Text'], "Jane Doe")
+        self.assertEqual(merged[1]['Score'], 0.8)
+        self.assertEqual([e['Id'] for e in merged], [0, 1, 2])
+        # the backend's own results are not modified
+        self.assertEqual(results[1][0]['BeginOffset'], 4)
+
+    def test_different_types_in_overlap_are_kept(self):
+        text = self.note_text
+        windows = [(0, text[:60]), (40, text[40:])]
+        results = [[self.entity(45, 52, entity_type="ADDRESS")], [self.entity(5, 12, entity_type="NAME")]]
+        merged = merge_chunk_entities(text, windows, results)
+        self.assertEqual(len(merged), 2)
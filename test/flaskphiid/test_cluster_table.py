@@ -0,0 +1,73 @@
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from flaskphiid.cluster_table import MappedClusterTable, write_cluster_table, is_cluster_table, main
+from flaskphiid.hutchner_pool import load_hutchner
+
+
+class ClusterModel(object):
+    """records how its clusters were loaded"""
+
+    def load_model(self, input_path=None):
+        self.model_path = input_path
+
+    def load_clusters(self, input_path=None):
+        with open(input_path, 'rb') as f:
+            self.clusters = pickle.load(f)
+
+
+class MappedClusterTableTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.clusters = {'the': '0010', 'patient': '110101', 'Smith': '1110', 'café': '01', 'z': '1'}
+
+    def write(self, clusters):
+        path = os.path.join(self.dir, 'clusters.tbl')
+        write_cluster_table(clusters, path)
+        table = MappedClusterTable(path)
+        self.addCleanup(table.close)
+        return table
+
+    def test_lookup_matches_dict(self):
+        table = self.write(self.clusters)
+        self.assertEqual(len(table), len(self.clusters))
+        self.assertEqual(dict(table), self.clusters)
+        for word, cluster in self.clusters.items():
+            self.assertEqual(table[word], cluster)
+        self.assertNotIn('Jones', table)
+        self.assertIsNone(table.get('Jones'))
+        self.assertRaises(KeyError, table.__getitem__, 'Jones')
+        self.assertNotIn(3, table)
+
+    def test_int_values_and_empty_table(self):
+        self.assertEqual(dict(self.write({'a': 3, 'b': 10})), {'a': 3, 'b': 10})
+        self.assertEqual(len(self.write({})), 0)
+
+    def test_rejects_non_mappings(self):
+        self.assertRaises(ValueError, write_cluster_table, ['the'], os.path.join(self.dir, 'bad.tbl'))
+
+    def test_convert_pickle_and_load_into_model(self):
+        pickle_path = os.path.join(self.dir, 'clusters.pkl')
+        table_path = os.path.join(self.dir, 'clusters.tbl')
+        with open(pickle_path, 'wb') as f:
+            pickle.dump(self.clusters, f)
+        main([pickle_path, table_path])
+        self.assertTrue(is_cluster_table(table_path))
+        self.assertFalse(is_cluster_table(pickle_path))
+
+        factory = 'test.flaskphiid.test_cluster_table:ClusterModel'
+        model = load_hutchner(factory, 'model.pkl', table_path)
+        self.assertIsInstance(model.clusters, MappedClusterTable)
+        self.assertEqual(model.clusters['patient'], '110101')
+        model.clusters.close()
+        # a pickled table still goes through load_clusters
+        self.assertEqual(load_hutchner(factory, 'model.pkl', pickle_path).clusters, self.clusters)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+import json
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from flaskphiid import create_app
+from flaskphiid.backends import get_backends
+from flaskphiid.coalescer import Coalescer, predict_batch
+from flaskphiid.metrics import HUTCHNER_BATCH_SIZE, HUTCHNER_QUEUE_SECONDS
+
+
+class RecordingModel(object):
+    """predicts each note as its upper-cased text and records the batches it was given"""
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.batches = []
+
+    def predict_batch(self, note_texts, **kwargs):
+        self.batches.append((list(note_texts), kwargs))
+        time.sleep(self.delay)
+        if any(note_text == 'bad' for note_text in note_texts):
+            raise ValueError("bad note")
+        return [note_text.upper() for note_text in note_texts]
+
+
+class CoalescerTests(unittest.TestCase):
+
+    def make_coalescer(self, model, **settings):
+        coalescer = Coalescer(model.predict_batch, **settings)
+        self.addCleanup(coalescer.shutdown)
+        return coalescer
+
+    def test_concurrent_predictions_share_a_batch(self):
+        model = RecordingModel()
+        coalescer = self.make_coalescer(model, max_batch_size=8, max_wait=0.2)
+        futures = [coalescer.submit("note {}".format(i)) for i in range(8)]
+        self.assertEqual([future.result(timeout=5) for future in futures], ["NOTE {}".format(i) for i in range(8)])
+        self.assertEqual(len(model.batches), 1)
+
+    def test_full_batch_does_not_wait(self):
+        model = RecordingModel()
+        coalescer = self.make_coalescer(model, max_batch_size=4, max_wait=10)
+        started = time.monotonic()
+        futures = [coalescer.submit(str(i)) for i in range(4)]
+        [future.result(timeout=5) for future in futures]
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_lone_prediction_waits_at_most_max_wait(self):
+        model = RecordingModel()
+        coalescer = self.make_coalescer(model, max_batch_size=16, max_wait=0.05)
+        started = time.monotonic()
+        self.assertEqual(coalescer.predict("alone"), "ALONE")
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(model.batches, [(["alone"], {})])
+
+    def test_batches_are_capped(self):
+        model = RecordingModel(delay=0.05)
+        coalescer = self.make_coalescer(model, max_batch_size=3, max_wait=0.01)
+        with ThreadPoolExecutor(10) as pool:
+            results = list(pool.map(coalescer.predict, [str(i) for i in range(10)]))
+        self.assertEqual(results, [str(i) for i in range(10)])
+        self.assertTrue(all(len(notes) <= 3 for notes, kwargs in model.batches))
+        self.assertEqual(sum(len(notes) for notes, kwargs in model.batches), 10)
+
+    def test_notes_with_other_options_are_batched_separately(self):
+        model = RecordingModel()
+        coalescer = self.make_coalescer(model, max_batch_size=8, max_wait=0.05)
+        futures = [coalescer.submit("a"), coalescer.submit("b", threshold=0.5), coalescer.submit("c")]
+        [future.result(timeout=5) for future in futures]
+        self.assertEqual(sorted(model.batches, key=len), [(["a", "c"], {}), (["b"], {'threshold': 0.5})])
+
+    def test_bad_note_only_fails_its_own_prediction(self):
+        model = RecordingModel()
+        coalescer = self.make_coalescer(model, max_batch_size=3, max_wait=0.2)
+        futures = [coalescer.submit(text) for text in ("ok", "bad", "fine")]
+        self.assertEqual(futures[0].result(timeout=5), "OK")
+        self.assertRaises(ValueError, futures[1].result, 5)
+        self.assertEqual(futures[2].result(timeout=5), "FINE")
+
+    def test_other_errors_fail_the_batch(self):
+        def fail(note_texts):
+            raise RuntimeError("model crashed")
+        coalescer = Coalescer(fail, max_batch_size=2, max_wait=0.2)
+        self.addCleanup(coalescer.shutdown)
+        futures = [coalescer.submit("a"), coalescer.submit("b")]
+        for future in futures:
+            self.assertRaises(RuntimeError, future.result, 5)
+
+    def test_short_batch_is_retried_one_by_one(self):
+        def drop_last(note_texts):
+            predictions = [note_text.upper() for note_text in note_texts]
+            return predictions[:-1] if len(note_texts) > 1 or note_texts == ["empty"] else predictions
+        coalescer = Coalescer(drop_last, max_batch_size=3, max_wait=0.2)
+        self.addCleanup(coalescer.shutdown)
+        with self.assertLogs('flaskphiid.coalescer', 'WARNING'):
+            futures = [coalescer.submit(text) for text in ("a", "empty", "c")]
+            self.assertEqual(futures[0].result(timeout=5), "A")
+            self.assertRaises(ValueError, futures[1].result, 5)
+            self.assertEqual(futures[2].result(timeout=5), "C")
+
+    def test_metrics(self):
+        HUTCHNER_BATCH_SIZE.clear()
+        HUTCHNER_QUEUE_SECONDS.clear()
+        coalescer = self.make_coalescer(RecordingModel(), max_batch_size=2, max_wait=0.2)
+        [future.result(timeout=5) for future in [coalescer.submit("a"), coalescer.submit("b")]]
+        self.assertEqual(HUTCHNER_BATCH_SIZE.count(), 1)
+        self.assertEqual(HUTCHNER_QUEUE_SECONDS.count(), 2)
+
+    def test_shutdown_finishes_queued_notes(self):
+        coalescer = Coalescer(RecordingModel().predict_batch, max_batch_size=16, max_wait=10)
+        future = coalescer.submit("queued")
+        coalescer.shutdown()
+        self.assertEqual(future.result(timeout=5), "QUEUED")
+        self.assertRaises(RuntimeError, coalescer.submit, "late")
+
+    def test_predict_batch_falls_back_to_predict(self):
+        class OneAtATime(object):
+            def predict(self, note_text, **kwargs):
+                return note_text[::-1]
+        self.assertEqual(predict_batch(OneAtATime(), ["ab", "cd"]), ["ba", "dc"])
+
+
+class StubPrediction(object):
+
+    def __init__(self, note_text):
+        self.NER_token_labels = [{"start": 0, "stop": len(note_text), "confidence": 0.9,
+                                  "text": note_text, "label": "PATIENT_OR_FAMILY_NAME"}]
+
+    def to_json(self):
+        return self.NER_token_labels
+
+
+class BatchingHutchNER(object):
+
+    def __init__(self):
+        self.batch_sizes = []
+        self._lock = threading.Lock()
+
+    def predict_batch(self, note_texts, **kwargs):
+        with self._lock:
+            self.batch_sizes.append(len(note_texts))
+        return [StubPrediction(note_text) for note_text in note_texts]
+
+
+class CoalescedEndpointTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app({'SECRET_KEY': 'dev', 'TESTING': True, 'LOG_LEVEL': 'WARNING',
+                               'HUTCHNER_COALESCE': True, 'HUTCHNER_BATCH_MAX_SIZE': 4,
+                               'HUTCHNER_BATCH_MAX_WAIT_MS': 200})
+        self.hutchner = BatchingHutchNER()
+        get_backends(self.app).use(hutchner=self.hutchner)
+        self.addCleanup(get_backends(self.app).shutdown)
+
+    def post(self, note_text):
+        with self.app.test_client() as client:
+            return client.post('/hutchner/phi', data=json.dumps({'extract_text': note_text}),
+                               content_type='application/json')
+
+    def test_concurrent_requests_are_coalesced(self):
+        notes = ["Smith{}".format(i) for i in range(4)]
+        with ThreadPoolExecutor(4) as pool:
+            responses = list(pool.map(self.post, notes))
+        self.assertEqual([response.status_code for response in responses], [200] * 4)
+        self.assertEqual([response.json[0]['text'] for response in responses], notes)
+        self.assertEqual(self.hutchner.batch_sizes, [4])
+
+
+if __name__ == '__main__':
+    unittest.main()
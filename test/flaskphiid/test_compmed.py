@@ -51,7 +51,7 @@ class CompMedEndpointTests(unittest.TestCase):
         self.assertEqual(result.status_code, 400)
 
 
-    @patch('flaskphiid.compMedInterface.get_entities')
+    @patch('flaskphiid.compmed_client.CompMedClient.get_entities')
     def test_get_entities_happy_case(self, mockCompMedInterface):
 
         entity_response_json = [{'fox': 'PHI'}, {'dog': 'PHI'}]
@@ -62,7 +62,7 @@ class CompMedEndpointTests(unittest.TestCase):
         mockCompMedInterface.assert_called_with(self.INPUT_TEXT, entityTypes="all")
 
 
-    @patch('flaskphiid.compMedInterface.get_entities')
+    @patch('flaskphiid.compmed_client.CompMedClient.get_entities')
     def test_annotate_no_specified_types(self, mockCompMedInterface):
         entity_response_json = [{'fox': 'PHI'}, {'dog': 'PHI'}]
         mockCompMedInterface.return_value = entity_response_json
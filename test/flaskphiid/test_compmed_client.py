@@ -0,0 +1,141 @@
+import json
+import os
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+from flaskphiid.compmed_client import CompMedClient, CompMedBadInput, CompMedThrottled, CompMedUnavailable
+
+
+class StubComprehendMedical(object):
+    """local HTTP endpoint speaking the Comprehend Medical JSON protocol; replies are scripted per test"""
+
+    def __init__(self):
+        self.replies = []
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                stub.requests.append((self.headers['X-Amz-Target'], body, self.client_address))
+                status, reply = stub.replies.pop(0) if stub.replies else (200, {'Entities': []})
+                data = json.dumps(reply).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/x-amz-json-1.1')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class CompMedClientTests(unittest.TestCase):
+
+    def setUp(self):
+        env = patch.dict(os.environ, {'AWS_ACCESS_KEY_ID': 'testing', 'AWS_SECRET_ACCESS_KEY': 'testing'})
+        env.start()
+        self.addCleanup(env.stop)
+        self.stub = StubComprehendMedical()
+        self.addCleanup(self.stub.close)
+        self.client = CompMedClient(region_name='us-west-2', endpoint_url=self.stub.url, pool_size=4,
+                                    max_retries=3, backoff_base=0.001, backoff_cap=0.01)
+        self.entity = {"Id": 0, "BeginOffset": 4, "EndOffset": 14, "Score": 0.99, "Text": "John Smith",
+                       "Category": "PROTECTED_HEALTH_INFORMATION", "Type": "NAME", "Traits": []}
+
+    def error(self, status, code):
+        return status, {'__type': code, 'message': code}
+
+    def test_get_phi(self):
+        self.stub.replies = [(200, {'Entities': [self.entity], 'ModelVersion': '1'})]
+        self.assertEqual(self.client.get_phi("Mr. John Smith"), [self.entity])
+        target, body, _ = self.stub.requests[0]
+        self.assertEqual(target, 'ComprehendMedical_20181030.DetectPHI')
+        self.assertEqual(body, {'Text': "Mr. John Smith"})
+
+    def test_get_entities_filters_categories(self):
+        medication = dict(self.entity, Category="MEDICATION", Text="aspirin")
+        self.stub.replies = [(200, {'Entities': [self.entity, medication], 'ModelVersion': '1'})]
+        self.assertEqual(self.client.get_entities("note", entityTypes=["MEDICATION"]), [medication])
+        self.assertEqual(self.stub.requests[0][0], 'ComprehendMedical_20181030.DetectEntitiesV2')
+
+    def test_get_entities_single_category_string(self):
+        partial = dict(self.entity, Category="HEALTH")
+        self.stub.replies = [(200, {'Entities': [self.entity, partial], 'ModelVersion': '1'})]
+        # "HEALTH" is a substring of the one category asked for, but not that category
+        self.assertEqual(self.client.get_entities("note", entityTypes="PROTECTED_HEALTH_INFORMATION"), [self.entity])
+
+    def test_get_entities_all_categories(self):
+        medication = dict(self.entity, Category="MEDICATION", Text="aspirin")
+        for entityTypes in ("all", None):
+            self.stub.replies = [(200, {'Entities': [self.entity, medication], 'ModelVersion': '1'})]
+            self.assertEqual(self.client.get_entities("note", entityTypes=entityTypes), [self.entity, medication])
+
+    def test_classify_error_returns_every_error(self):
+        from botocore.exceptions import ClientError, EndpointConnectionError
+        from flaskphiid.compmed_client import classify_error
+
+        def client_error(status, code):
+            return ClientError({'Error': {'Code': code}, 'ResponseMetadata': {'HTTPStatusCode': status}}, 'DetectPHI')
+        self.assertIsInstance(classify_error('detect_phi', client_error(400, 'ThrottlingException')), CompMedThrottled)
+        self.assertIsInstance(classify_error('detect_phi', client_error(503, 'ServiceUnavailable')),
+                              CompMedUnavailable)
+        self.assertIsInstance(classify_error('detect_phi', client_error(400, 'InvalidRequestException')),
+                              CompMedBadInput)
+        self.assertIsInstance(classify_error('detect_phi', EndpointConnectionError(endpoint_url='http://x')),
+                              CompMedUnavailable)
+
+    def test_retries_throttling_then_succeeds(self):
+        self.stub.replies = [self.error(400, 'ThrottlingException'),
+                             self.error(503, 'ServiceUnavailableException'),
+                             (200, {'Entities': [self.entity], 'ModelVersion': '1'})]
+        with self.assertLogs('flaskphiid.compmed_client', 'INFO') as logs:
+            self.assertEqual(self.client.get_phi("Mr. John Smith"), [self.entity])
+        self.assertEqual(len(self.stub.requests), 3)
+        # retries are logged as Events, which are only rendered when written
+        self.assertEqual([record.msg.event for record in logs.records], ['compmed.retry', 'compmed.retry'])
+
+    def test_persistent_throttling_is_not_bad_input(self):
+        self.stub.replies = [self.error(400, 'TooManyRequestsException')] * 4
+        with self.assertRaises(CompMedThrottled) as context:
+            self.client.get_phi("note")
+        self.assertNotIsInstance(context.exception, ValueError)
+        self.assertEqual(len(self.stub.requests), 4)
+
+    def test_persistent_server_errors(self):
+        self.stub.replies = [self.error(500, 'InternalServerException')] * 4
+        self.assertRaises(CompMedUnavailable, self.client.get_phi, "note")
+
+    def test_bad_input_is_value_error_and_not_retried(self):
+        self.stub.replies = [self.error(400, 'TextSizeLimitExceededException')]
+        self.assertRaises(ValueError, self.client.get_phi, "note")
+        self.stub.replies = [self.error(400, 'InvalidRequestException')]
+        self.assertRaises(CompMedBadInput, self.client.get_phi, "note")
+        self.assertEqual(len(self.stub.requests), 2)
+
+    def test_connections_are_reused(self):
+        for _ in range(5):
+            self.client.get_phi("note")
+        self.assertEqual(len(set(address for _, _, address in self.stub.requests)), 1)
+
+    def test_unreachable_endpoint(self):
+        client = CompMedClient(region_name='us-west-2', endpoint_url='http://127.0.0.1:1', max_retries=1,
+                               backoff_base=0.001, connect_timeout=1)
+        self.assertRaises(CompMedUnavailable, client.get_phi, "note")
+
+
+if __name__ == '__main__':
+    unittest.main()
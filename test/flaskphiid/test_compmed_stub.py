@@ -0,0 +1,90 @@
+import json
+import random
+import os
+import unittest
+from time import monotonic
+from unittest.mock import patch, MagicMock
+
+from flaskphiid import create_app
+from flaskphiid.compmed_client import CompMedClient, CompMedBadInput, CompMedThrottled, CompMedUnavailable
+from flaskphiid.compmed_stub import CompMedStubServer, find_phi, find_entities, parse_latency
+
+
+class StubEntityTests(unittest.TestCase):
+
+    def test_find_phi(self):
+        text = "Mr. Edward Jones is a 75 yo Seattle teacher, seen October 5th, MRN 1234567"
+        found = {(entity['Text'], entity['Type']) for entity in find_phi(text)}
+        self.assertEqual(found, {("Edward Jones", 'NAME'), ("75", 'AGE'), ("Seattle", 'ADDRESS'),
+                                 ("teacher", 'PROFESSION'), ("October 5th", 'DATE'), ("1234567", 'ID')})
+        for entity in find_phi(text):
+            self.assertEqual(text[entity['BeginOffset']:entity['EndOffset']], entity['Text'])
+
+    def test_find_entities_adds_medical_categories(self):
+        categories = {entity['Text']: entity['Category'] for entity in find_entities("John Smith took aspirin for pain")}
+        self.assertEqual(categories, {"John Smith": 'PROTECTED_HEALTH_INFORMATION', "aspirin": 'MEDICATION',
+                                      "pain": 'MEDICAL_CONDITION'})
+
+    def test_parse_latency(self):
+        self.assertEqual(parse_latency('0.25')(None), 0.25)
+        self.assertTrue(0.1 <= parse_latency("uniform:0.1,0.2")(random.Random(0)) <= 0.2)
+        self.assertRaises(ValueError, parse_latency, 'gamma:1,2')
+
+
+class StubServerTests(unittest.TestCase):
+
+    def setUp(self):
+        env = patch.dict(os.environ, {'AWS_ACCESS_KEY_ID': 'testing', 'AWS_SECRET_ACCESS_KEY': 'testing'})
+        env.start()
+        self.addCleanup(env.stop)
+        self.stub = CompMedStubServer(seed=1).start()
+        self.addCleanup(self.stub.stop)
+        self.client = CompMedClient(region_name='us-west-2', endpoint_url=self.stub.url, max_retries=1,
+                                    backoff_base=0.001, backoff_cap=0.001)
+
+    def test_client_round_trip(self):
+        entities = self.client.get_phi("Mr. John Smith is a 48 yo teacher")
+        self.assertEqual([entity['Text'] for entity in entities], ["John Smith", "48", "teacher"])
+        medications = self.client.get_entities("aspirin for pain", entityTypes=['MEDICATION'])
+        self.assertEqual([entity['Text'] for entity in medications], ["aspirin"])
+
+    def test_injected_failures(self):
+        self.stub.configure(throttle_rate=1)
+        self.assertRaises(CompMedThrottled, self.client.get_phi, "note")
+        self.stub.configure(throttle_rate=0, error_rate=1)
+        self.assertRaises(CompMedUnavailable, self.client.get_phi, "note")
+        self.stub.configure(error_rate=0, text_limit=3)
+        self.assertRaises(CompMedBadInput, self.client.get_phi, "note")
+        self.assertEqual(self.stub.stats, {'calls': 5, 'throttled': 2, 'errors': 2, 'rejected': 1})
+
+    def test_max_tps_and_latency(self):
+        self.stub.configure(max_tps=2, latency='0.05')
+        started = monotonic()
+        self.client.get_phi("note")
+        self.assertGreaterEqual(monotonic() - started, 0.05)
+        self.client.get_phi("note")
+        self.assertRaises(CompMedThrottled, CompMedClient(region_name='us-west-2', endpoint_url=self.stub.url,
+                                                          max_retries=0).get_phi, "note")
+
+    def test_identifyphi_through_config(self):
+        patchers = [patch('HutchNERPredict.hutchner.HutchNER.load_model'),
+                    patch('HutchNERPredict.hutchner.HutchNER.load_clusters'),
+                    patch('HutchNERPredict.hutchner.HutchNER.predict',
+                          return_value=MagicMock(NER_token_labels=[]))]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        app = create_app({'TESTING': True,
+                          'HUTCHNER_MODEL': "test_resources/simple_crf_ner.pkl",
+                          'CLINIC_NOTE_CLUSTERS': "test_resources/clusters.pkl",
+                          'COMPMED_REGION': 'us-west-2',
+                          'COMPMED_ENDPOINT_URL': self.stub.url}).test_client()
+        result = app.post('/identifyphi/', data=json.dumps({'extract_text': "Dr. Grace Kim saw the patient"}),
+                          content_type='application/json')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual([ann['text'] for ann in json.loads(result.data)], ["Grace Kim"])
+        self.assertEqual(self.stub.stats['DetectPHI'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
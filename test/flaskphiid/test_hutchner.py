@@ -4,6 +4,7 @@ import json
 
 from flask import g, session, Response
 from flaskphiid import create_app
+from flaskphiid.backends import get_backends
 from unittest.mock import patch, MagicMock
 import flaskphiid.hutchner as hutchner
 
@@ -51,17 +52,57 @@ class hutchnerEndpointTests(unittest.TestCase):
         self.assertEqual(result.status_code, 400)
 
 
-    @patch('flaskphiid.hutchNERInterface.predict')
+    @patch('HutchNERPredict.hutchner.HutchNER.predict')
     def test_get_entities_happy_case(self, mockHutchNERInterface):
         mockEntityResponse = MagicMock()
         entity_response_json = [{'fox': 'PHI'}, {'dog': 'PHI'}]
         mockEntityResponse.to_json.return_value = entity_response_json
         mockHutchNERInterface.return_value = mockEntityResponse
         expected_result = Response(entity_response_json, mimetype=u'application/json')
-        result = hutchner._get_entities(self.INPUT_TEXT, entityTypes="all")
+        # the backends belong to the app, so the call needs its context; skip loading the model
+        from HutchNERPredict.hutchner import HutchNER
+        get_backends(self.app.application).use(hutchner=HutchNER())
+        with self.app.application.app_context():
+            result = hutchner._get_entities(self.INPUT_TEXT, entityTypes="all")
 
         mockHutchNERInterface.assert_called_with(self.INPUT_TEXT)
 
 
+class SpanAggregationTests(unittest.TestCase):
+
+    NOTE = "Seen at Harborview Medical  Center by John Smith"
+
+    def token(self, word, label, confidence=0.9):
+        start = self.NOTE.index(word)
+        return {'start': start, 'stop': start + len(word), 'text': word, 'label': label, 'confidence': confidence}
+
+    def test_adjacent_tokens_become_one_span(self):
+        tokens = [self.token("Seen", "O"),
+                  self.token("Harborview", "HOSPITAL_NAME", 0.6),
+                  self.token("Medical", "HOSPITAL_NAME", 0.9),
+                  self.token("Center", "HOSPITAL_NAME", 0.9),
+                  self.token("by", "O"),
+                  self.token("John", "B-PATIENT_OR_FAMILY_NAME"),
+                  self.token("Smith", "I-PATIENT_OR_FAMILY_NAME")]
+        spans = hutchner.aggregate_spans(tokens, 'max', self.NOTE)
+        self.assertEqual([(span['text'], span['label']) for span in spans],
+                         [("Harborview Medical  Center", "HOSPITAL_NAME"), ("John Smith", "PATIENT_OR_FAMILY_NAME")])
+        self.assertEqual(spans[0]['confidence'], 0.9)
+        self.assertAlmostEqual(hutchner.aggregate_spans(tokens, 'mean', self.NOTE)[0]['confidence'], 0.8)
+        for span in spans:
+            self.assertEqual(self.NOTE[span['start']:span['stop']], span['text'])
+
+    def test_span_boundaries(self):
+        tokens = [self.token("John", "B-PROVIDER_NAME"), self.token("Smith", "B-PROVIDER_NAME")]
+        self.assertEqual(len(hutchner.aggregate_spans(tokens, 'max', self.NOTE)), 2)
+        tokens = [self.token("Medical", "HOSPITAL_NAME"), self.token("Center", "HOSPITAL_NAME")]
+        # two spaces apart, which only the note shows is whitespace
+        self.assertEqual(len(hutchner.aggregate_spans(tokens, 'max', self.NOTE)), 1)
+        self.assertEqual(len(hutchner.aggregate_spans(tokens, 'max')), 2)
+        tokens = [self.token("at", "WARD"), self.token("Harborview", "HOSPITAL_NAME")]
+        self.assertEqual([span['label'] for span in hutchner.aggregate_spans(tokens)], ["WARD", "HOSPITAL_NAME"])
+        self.assertEqual(hutchner.aggregate_spans([]), [])
+
+
 if __name__ == '__main__':
     unittest.main()
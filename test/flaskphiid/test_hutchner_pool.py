@@ -0,0 +1,74 @@
+import os
+import threading
+import unittest
+
+from flaskphiid.hutchner_pool import HutchNERProcessPool, HutchNERPoolBusy
+
+
+class FakeHutchNER(object):
+    """stands in for HutchNERPredict's HutchNER inside the worker processes"""
+
+    def load_model(self, input_path=None):
+        self.model_path = input_path
+
+    def load_clusters(self, input_path=None):
+        self.clusters_path = input_path
+
+    def predict(self, note_text, **kwargs):
+        if note_text == "block":
+            threading.Event().wait(2)
+        if note_text == "bad":
+            raise ValueError("bad input")
+        return FakePrediction(note_text, self.model_path, os.getpid())
+
+
+class FakePrediction(object):
+
+    def __init__(self, note_text, model_path, pid):
+        self.NER_token_labels = [{"start": 0, "stop": len(note_text), "confidence": 0.9,
+                                  "text": note_text, "label": "O"}]
+        self.model_path = model_path
+        self.pid = pid
+
+    def to_json(self):
+        return {"model": self.model_path, "pid": self.pid}
+
+
+class HutchNERProcessPoolTests(unittest.TestCase):
+
+    def make_pool(self, processes=2, queue_size=None, queue_timeout=None):
+        pool = HutchNERProcessPool(processes, model_path="model.pkl", clusters_path="clusters.pkl",
+                                   queue_size=queue_size, queue_timeout=queue_timeout,
+                                   model_factory='test.flaskphiid.test_hutchner_pool:FakeHutchNER')
+        self.addCleanup(pool.shutdown)
+        return pool
+
+    def test_predict_in_worker_process(self):
+        pool = self.make_pool()
+        prediction = pool.predict("John Smith")
+        self.assertEqual(prediction.NER_token_labels[0]["text"], "John Smith")
+        self.assertEqual(prediction.to_json()["model"], "model.pkl")
+        self.assertNotEqual(prediction.to_json()["pid"], os.getpid())
+
+    def test_errors_are_raised_in_caller(self):
+        pool = self.make_pool()
+        self.assertRaises(ValueError, pool.predict, "bad")
+        # the pool keeps working after a failed note
+        self.assertEqual(pool.predict("ok").NER_token_labels[0]["text"], "ok")
+
+    def test_queue_is_bounded(self):
+        pool = self.make_pool(processes=1, queue_size=0, queue_timeout=0.1)
+        future = pool.submit("block")
+        self.assertRaises(HutchNERPoolBusy, pool.submit, "next")
+        future.result()
+        self.assertEqual(pool.predict("next").NER_token_labels[0]["text"], "next")
+
+    def test_predict_batch_in_one_worker(self):
+        pool = self.make_pool()
+        predictions = pool.predict_batch(["John", "Smith"])
+        self.assertEqual([p.NER_token_labels[0]["text"] for p in predictions], ["John", "Smith"])
+        self.assertEqual(len({p.to_json()["pid"] for p in predictions}), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,326 @@
+import flaskphiid
+import unittest
+import json
+import threading
+
+from flaskphiid import create_app
+from flaskphiid.compmed_client import CompMedThrottled
+from unittest.mock import patch, MagicMock
+
+
+class IdentifyPHIEndpointTests(unittest.TestCase):
+
+    def setUp(self):
+        patchers = [patch('HutchNERPredict.hutchner.HutchNER.load_model'),
+                    patch('HutchNERPredict.hutchner.HutchNER.load_clusters')]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        test_config = {'SECRET_KEY': 'dev',
+                       'TESTING': True,
+                       'HUTCHNER_MODEL': "test_resources/simple_crf_ner.pkl",
+                       'CLINIC_NOTE_CLUSTERS': "test_resources/clusters.pkl",
+                       'COMPMED_TIMEOUT': 5,
+                       'HUTCHNER_TIMEOUT': 5,
+        }
+        self.app = create_app(test_config).test_client()
+        self.app.testing = True
+
+        self.INPUT_TEXT = "Mr. John Smith is a 48 yo teacher"
+        self.compmed_phi = [{"BeginOffset": 4, "EndOffset": 14, "Score": 0.99,
+                             "Text": "John Smith", "Type": "NAME"}]
+        self.hutchner_phi = [{"start": 4, "stop": 8, "confidence": 0.9, "text": "John",
+                              "label": "PATIENT_OR_FAMILY_NAME"},
+                             {"start": 9, "stop": 14, "confidence": 0.9, "text": "Smith",
+                              "label": "PATIENT_OR_FAMILY_NAME"},
+                             {"start": 15, "stop": 17, "confidence": 0.9, "text": "is", "label": "O"}]
+
+    def make_json_post_to_endpoint(self, endpoint, dict_to_jsonify):
+        return self.app.post(endpoint,
+                             data=json.dumps(dict_to_jsonify),
+                             content_type='application/json')
+
+    def mock_prediction(self, tokens):
+        prediction = MagicMock()
+        prediction.NER_token_labels = tokens
+        return prediction
+
+    def test_annotate_empty_entity_text(self):
+        result = self.make_json_post_to_endpoint('/identifyphi/', dict(extract_text=""))
+        self.assertEqual(result.status_code, 400)
+
+    @patch('HutchNERPredict.hutchner.HutchNER.predict')
+    @patch('flaskphiid.compmed_client.CompMedClient.get_phi')
+    def test_identify_phi_happy_case(self, mock_get_phi, mock_predict):
+        mock_get_phi.return_value = self.compmed_phi
+        mock_predict.return_value = self.mock_prediction(self.hutchner_phi)
+
+        result = self.make_json_post_to_endpoint('/identifyphi/', dict(extract_text=self.INPUT_TEXT))
+
+        self.assertEqual(result.status_code, 200)
+        data = json.loads(result.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['text'], "John Smith")
+        self.assertEqual(set(data[0]['source_origins']), {'compmed', 'hutchner'})
+        mock_get_phi.assert_called_with(self.INPUT_TEXT)
+        mock_predict.assert_called_with(self.INPUT_TEXT)
+
+    @patch('HutchNERPredict.hutchner.HutchNER.predict')
+    @patch('flaskphiid.compmed_client.CompMedClient.get_phi')
+    def test_backends_run_concurrently(self, mock_get_phi, mock_predict):
+        # each backend waits for the other to start, which only succeeds if they overlap
+        both_started = threading.Barrier(2, timeout=2)
+
+        def get_phi(note_text):
+            both_started.wait()
+            return self.compmed_phi
+
+        def predict(note_text):
+            both_started.wait()
+            return self.mock_prediction(self.hutchner_phi)
+
+        mock_get_phi.side_effect = get_phi
+        mock_predict.side_effect = predict
+
+        result = self.make_json_post_to_endpoint('/identifyphi/', dict(extract_text=self.INPUT_TEXT))
+        self.assertEqual(result.status_code, 200)
+
+    @patch('HutchNERPredict.hutchner.HutchNER.predict')
+    @patch('flaskphiid.compmed_client.CompMedClient.get_phi')
+    def test_compmed_value_error(self, mock_get_phi, mock_predict):
+        mock_get_phi.side_effect = ValueError("bad input")
+        mock_predict.return_value = self.mock_prediction(self.hutchner_phi)
+
+        result = self.make_json_post_to_endpoint('/identifyphi/', dict(extract_text=self.INPUT_TEXT))
+
+        self.assertEqual(result.status_code, 400)
+        self.assertEqual(result.data, b"An error occurred while calling MedLP")
+
+    @patch('HutchNERPredict.hutchner.HutchNER.predict')
+    @patch('flaskphiid.compmed_client.CompMedClient.get_phi')
+    def test_hutchner_value_error(self, mock_get_phi, mock_predict):
+        mock_get_phi.return_value = self.compmed_phi
+        mock_predict.side_effect = ValueError("bad input")
+
+        result = self.make_json_post_to_endpoint('/identifyphi/', dict(extract_text=self.INPUT_TEXT))
+
+        self.assertEqual(result.status_code, 400)
+        self.assertEqual(result.data, b"An error occurred while calling HutchNER")
+
+    @patch('HutchNERPredict.hutchner.HutchNER.predict')
+    @patch('flaskphiid.compmed_client.CompMedClient.get_phi')
+    def test_compmed_throttled(self, mock_get_phi, mock_predict):
+        mock_get_phi.side_effect = CompMedThrottled("throttled")
+        mock_predict.return_value = self.mock_prediction(self.hutchner_phi)
+
+        result = self.make_json_post_to_endpoint('/identifyphi/', dict(extract_text=self.INPUT_TEXT))
+
+        self.assertEqual(result.status_code, 503)
+
+    @patch('HutchNERPredict.hutchner.HutchNER.predict')
+    @patch('flaskphiid.compmed_client.CompMedClient.get_phi')
+    def test_backend_timeout(self, mock_get_phi, mock_predict):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def slow_get_phi(note_text):
+            release.wait(5)
+            return self.compmed_phi
+
+        mock_get_phi.side_effect = slow_get_phi
+        mock_predict.return_value = self.mock_prediction(self.hutchner_phi)
+        self.app.application.config['COMPMED_TIMEOUT'] = 0.05
+
+        result = self.make_json_post_to_endpoint('/identifyphi/', dict(extract_text=self.INPUT_TEXT))
+
+        self.assertEqual(result.status_code, 504)
+
+    @patch('HutchNERPredict.hutchner.HutchNER.predict')
+    @patch('flaskphiid.compmed_client.CompMedClient.get_phi')
+    def test_batch_happy_case(self, mock_get_phi, mock_predict):
+        mock_get_phi.return_value = self.compmed_phi
+        mock_predict.return_value = self.mock_prediction(self.hutchner_phi)
+        notes = [{'id': 'a', 'extract_text': self.INPUT_TEXT},
+                 {'id': 'b', 'extract_text': self.INPUT_TEXT}]
+
+        result = self.make_json_post_to_endpoint('/identifyphi/batch',
+                                                 dict(notes=notes, annotation_by_source=True))
+
+        self.assertEqual(result.status_code, 200)
+        data = json.loads(result.data)
+        self.assertEqual(set(data['results']), {'a', 'b'})
+        self.assertEqual(data['errors'], {})
+        # the compmed entity and one HutchNER span for "John Smith"
+        self.assertEqual(len(data['results']['a'][0]['source_annotations']), 2)
+
+    @patch('HutchNERPredict.hutchner.HutchNER.predict')
+    @patch('flaskphiid.compmed_client.CompMedClient.get_phi')
+    def test_batch_per_note_errors(self, mock_get_phi, mock_predict):
+        def get_phi(note_text):
+            if note_text == "bad":
+                raise ValueError("bad input")
+            return self.compmed_phi
+
+        mock_get_phi.side_effect = get_phi
+        mock_predict.return_value = self.mock_prediction(self.hutchner_phi)
+        notes = [{'id': 'good', 'extract_text': self.INPUT_TEXT},
+                 {'id': 'bad', 'extract_text': "bad"},
+                 {'id': 'empty', 'extract_text': ""}]
+
+        result = self.make_json_post_to_endpoint('/identifyphi/batch', dict(notes=notes))
+
+        self.assertEqual(result.status_code, 200)
+        data = json.loads(result.data)
+        self.assertEqual(list(data['results']), ['good'])
+        self.assertNotIn('source_annotations', data['results']['good'][0])
+        self.assertEqual(data['errors']['bad'], {'status': 400,
+                                                 'message': "An error occurred while calling MedLP"})
+        self.assertEqual(data['errors']['empty']['status'], 400)
+
+    def test_batch_invalid_requests(self):
+        result = self.make_json_post_to_endpoint('/identifyphi/batch', dict(notes="not a list"))
+        self.assertEqual(result.status_code, 400)
+        result = self.make_json_post_to_endpoint('/identifyphi/batch',
+                                                 dict(notes=[{'extract_text': self.INPUT_TEXT}]))
+        self.assertEqual(result.status_code, 400)
+        result = self.make_json_post_to_endpoint('/identifyphi/batch',
+                                                 dict(notes=[{'id': 1, 'extract_text': "a"},
+                                                             {'id': 1, 'extract_text': "b"}]))
+        self.assertEqual(result.status_code, 400)
+
+    def test_batch_ids_must_be_strings_or_integers(self):
+        for note_id in ([1, 2], {'id': 1}, 1.5, True):
+            result = self.make_json_post_to_endpoint('/identifyphi/batch',
+                                                     dict(notes=[{'id': note_id, 'extract_text': "a"}]))
+            self.assertEqual(result.status_code, 400, note_id)
+
+    def test_batch_ids_that_collide_as_json_keys(self):
+        result = self.make_json_post_to_endpoint('/identifyphi/batch',
+                                                 dict(notes=[{'id': 1, 'extract_text': "a"},
+                                                             {'id': "1", 'extract_text': "b"}]))
+        self.assertEqual(result.status_code, 400)
+
+    def test_batch_extract_text_must_be_a_string(self):
+        notes = [{'id': 'number', 'extract_text': 42}, {'id': 'object', 'extract_text': {'a': 1}}]
+        result = self.make_json_post_to_endpoint('/identifyphi/batch', dict(notes=notes))
+        self.assertEqual(result.status_code, 200)
+        data = json.loads(result.data)
+        self.assertEqual(data['results'], {})
+        self.assertEqual(data['errors'], {note['id']: {'status': 400, 'message': "extract_text must be a string"}
+                                          for note in notes})
+
+    def test_extract_text_must_be_a_string(self):
+        for path in ('/identifyphi/', '/identifyphi/redact', '/compmed/phi', '/hutchner/phi'):
+            result = self.make_json_post_to_endpoint(path, dict(extract_text=42))
+            self.assertEqual(result.status_code, 400, path)
+            self.assertEqual(result.data, b"extract_text must be a string")
+
+    @patch('HutchNERPredict.hutchner.HutchNER.predict')
+    @patch('flaskphiid.compmed_client.CompMedClient.get_phi')
+    def test_stream_ordered(self, mock_get_phi, mock_predict):
+        mock_get_phi.return_value = self.compmed_phi
+        mock_predict.return_value = self.mock_prediction(self.hutchner_phi)
+        self.app.application.config['STREAM_MAX_IN_FLIGHT'] = 2
+        lines = [json.dumps({'id': i, 'extract_text': self.INPUT_TEXT}) for i in range(5)]
+        lines.insert(2, "not json")
+        lines.insert(4, "")
+
+        result = self.app.post('/identifyphi/stream?ordered=true',
+                               data="\n".join(lines) + "\n",
+                               content_type='application/x-ndjson')
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.mimetype, 'application/x-ndjson')
+        out = [json.loads(line) for line in result.data.decode().splitlines()]
+        self.assertEqual([line['id'] for line in out], [0, 1, None, 2, 3, 4])
+        self.assertEqual(out[2]['error']['status'], 400)
+        self.assertEqual(out[0]['annotations'][0]['text'], "John Smith")
+
+    @patch('HutchNERPredict.hutchner.HutchNER.predict')
+    @patch('flaskphiid.compmed_client.CompMedClient.get_phi')
+    def test_stream_completion_order_with_errors(self, mock_get_phi, mock_predict):
+        def get_phi(note_text):
+            if note_text == "bad":
+                raise ValueError("bad input")
+            return self.compmed_phi
+
+        mock_get_phi.side_effect = get_phi
+        mock_predict.return_value = self.mock_prediction(self.hutchner_phi)
+        lines = [json.dumps({'id': 'good', 'extract_text': self.INPUT_TEXT}),
+                 json.dumps({'id': 'bad', 'extract_text': "bad"}),
+                 json.dumps({'id': 'empty', 'extract_text': ""})]
+
+        result = self.app.post('/identifyphi/stream?annotation_by_source=true',
+                               data="\n".join(lines),
+                               content_type='application/x-ndjson')
+
+        out = {line['id']: line for line in map(json.loads, result.data.decode().splitlines())}
+        self.assertEqual(set(out), {'good', 'bad', 'empty'})
+        self.assertIn('source_annotations', out['good']['annotations'][0])
+        self.assertEqual(out['bad']['error']['message'], "An error occurred while calling MedLP")
+        self.assertEqual(out['empty']['error']['status'], 400)
+
+    def test_stream_extract_text_must_be_a_string(self):
+        lines = [json.dumps({'id': note_id, 'extract_text': text})
+                 for note_id, text in (('number', 42), ('object', {'a': 1}), ('list', ["a"]))]
+        result = self.app.post('/identifyphi/stream', data="\n".join(lines), content_type='application/x-ndjson')
+        self.assertEqual(result.status_code, 200)
+        out = {line['id']: line for line in map(json.loads, result.data.decode().splitlines())}
+        self.assertEqual(out, {note_id: {'id': note_id, 'error': {'status': 400,
+                                                                    'message': "extract_text must be a string"}}
+                               for note_id in ('number', 'object', 'list')})
+
+    @patch('HutchNERPredict.hutchner.HutchNER.predict')
+    @patch('flaskphiid.compmed_client.CompMedClient.get_phi')
+    def test_long_note_is_chunked(self, mock_get_phi, mock_predict):
+        def get_phi(chunk):
+            if "John Smith" not in chunk:
+                return []
+            begin = chunk.index("John Smith")
+            return [{"BeginOffset": begin, "EndOffset": begin + 10, "Score": 0.99,
+                     "Text": "John Smith", "Type": "NAME"}]
+
+        mock_get_phi.side_effect = get_phi
+        mock_predict.return_value = self.mock_prediction([])
+        self.app.application.config['COMPMED_MAX_CHARS'] = 20
+        self.app.application.config['COMPMED_CHUNK_OVERLAP'] = 10
+        note_text = "Seen today. " + self.INPUT_TEXT + " Follow up in two weeks."
+
+        result = self.make_json_post_to_endpoint('/identifyphi/', dict(extract_text=note_text))
+
+        self.assertEqual(result.status_code, 200)
+        self.assertGreater(mock_get_phi.call_count, 1)
+        data = json.loads(result.data)
+        self.assertEqual([(d['start'], d['end'], d['text']) for d in data],
+                         [(16, 26, "John Smith")])
+
+    @patch('HutchNERPredict.hutchner.HutchNER.predict')
+    @patch('flaskphiid.compmed_client.CompMedClient.get_phi')
+    def test_results_are_cached(self, mock_get_phi, mock_predict):
+        mock_get_phi.return_value = self.compmed_phi
+        mock_predict.return_value = self.mock_prediction(self.hutchner_phi)
+
+        first = self.make_json_post_to_endpoint('/identifyphi/', dict(extract_text=self.INPUT_TEXT))
+        second = self.make_json_post_to_endpoint('/identifyphi/', dict(extract_text=self.INPUT_TEXT))
+
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(mock_get_phi.call_count, 1)
+        stats = json.loads(self.app.get('/identifyphi/cache').data)
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+        invalidate = lambda: self.app.delete('/identifyphi/cache',
+                                             data=json.dumps(dict(extract_text=self.INPUT_TEXT)),
+                                             content_type='application/json')
+        # invalidation is off unless configured
+        self.assertEqual(invalidate().status_code, 404)
+        self.make_json_post_to_endpoint('/identifyphi/', dict(extract_text=self.INPUT_TEXT))
+        self.assertEqual(mock_get_phi.call_count, 1)
+
+        self.app.application.config['RESULT_CACHE_ALLOW_INVALIDATE'] = True
+        self.assertEqual(invalidate().status_code, 204)
+        self.make_json_post_to_endpoint('/identifyphi/', dict(extract_text=self.INPUT_TEXT))
+        self.assertEqual(mock_get_phi.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from contextlib import redirect_stderr, redirect_stdout
+from io import StringIO
+
+from werkzeug.serving import make_server
+
+from benchmarks import loadtest
+
+
+class PercentileTests(unittest.TestCase):
+
+    def test_nearest_rank(self):
+        ordered = list(range(1, 101))
+        self.assertEqual(loadtest.percentile(ordered, 0.50), 50)
+        self.assertEqual(loadtest.percentile(ordered, 0.99), 99)
+        self.assertEqual(loadtest.percentile([3], 0.95), 3)
+        self.assertIsNone(loadtest.percentile([], 0.5))
+
+    def test_summary_counts_errors(self):
+        recorder = loadtest.Recorder()
+        recorder.record('/identifyphi/', 0.1, status=200)
+        recorder.record('/identifyphi/', 0.2, status=503)
+        recorder.record('/identifyphi/', 0.3, error='ConnectionRefusedError')
+        summary = loadtest.summarize(recorder, 1.0)
+        self.assertEqual(summary['requests'], 3)
+        self.assertAlmostEqual(summary['error_rate'], 2 / 3)
+        endpoint = summary['endpoints']['/identifyphi/']
+        self.assertEqual(endpoint['statuses'], {'200': 1, '503': 1})
+        self.assertEqual(endpoint['errors'], {'status 503': 1, 'ConnectionRefusedError': 1})
+        self.assertEqual(endpoint['latency_s']['p99'], 0.3)
+
+
+class LoadTestRunTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def run_main(self, *args):
+        output = os.path.join(self.dir, 'summary.json')
+        with redirect_stdout(StringIO()), redirect_stderr(StringIO()):
+            self.assertEqual(loadtest.main(['--notes', '4', '--length', '300', '--output', output] + list(args)), 0)
+        with open(output) as f:
+            return json.load(f)
+
+    def test_in_process_closed_loop(self):
+        summary = self.run_main('--in-process', '--stub-backends', '--concurrency', '2', '--requests', '12',
+                                '--endpoint', '/identifyphi/', '--endpoint', '/compmed/phi')
+        self.assertEqual(summary['requests'], 12)
+        self.assertEqual(summary['error_rate'], 0.0)
+        for endpoint in ('/identifyphi/', '/compmed/phi'):
+            self.assertEqual(summary['endpoints'][endpoint]['statuses'], {'200': 6})
+
+    def test_server_open_loop(self):
+        target = loadtest.in_process_target([], stub_backends=True)
+        server = make_server('127.0.0.1', 0, target.app, threaded=True)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.shutdown)
+
+        corpus = os.path.join(self.dir, 'notes.ndjson')
+        with open(corpus, 'w') as f:
+            for text in ("Seen by Dr. Smith on 01/02/2020.", "MRN 1234567, phone 206-555-0100."):
+                f.write(json.dumps({'extract_text': text}) + '\n')
+        summary = self.run_main('--url', 'http://127.0.0.1:{}'.format(server.port), '--corpus', corpus,
+                                '--rate', '200', '--requests', '10', '--duration', '10')
+        self.assertEqual(summary['requests'], 10)
+        self.assertEqual(summary['endpoints']['/identifyphi/']['statuses'], {'200': 10})
+        self.assertEqual(summary['load']['notes'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
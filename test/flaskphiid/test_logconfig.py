@@ -0,0 +1,74 @@
+import json
+import logging
+import threading
+import unittest
+from io import StringIO
+
+from benchmarks.notes import generate_corpus, StubCompMed, StubHutchNER
+from flaskphiid import create_app, logconfig
+from flaskphiid.backends import get_backends
+from flaskphiid.logconfig import Event, JSONFormatter, log_payload
+
+
+class Spy(object):
+    """a message that remembers which thread formatted it"""
+
+    def __init__(self):
+        self.formatted_in = None
+
+    def __str__(self):
+        self.formatted_in = threading.current_thread()
+        return "spy"
+
+
+class LogConfigTests(unittest.TestCase):
+
+    def setUp(self):
+        self.stream = StringIO()
+        self.addCleanup(logconfig.shutdown)
+        self.logger = logging.getLogger('flaskphiid.test')
+
+    def test_event_renders_fields(self):
+        self.assertEqual(str(Event('compmed.entities', entities=3, seconds=0.123456)),
+                         'compmed.entities entities=3 seconds=0.1235')
+        record = logging.LogRecord('flaskphiid.test', logging.INFO, __file__, 1, Event('merge', merged=2), None, None)
+        data = json.loads(JSONFormatter().format(record))
+        self.assertEqual((data['event'], data['merged'], data['level']), ('merge', 2, 'INFO'))
+
+    def test_formatted_by_listener(self):
+        logconfig.configure(stream=self.stream)
+        spy = Spy()
+        self.logger.info(spy)
+        self.logger.debug(Spy())  # below the level, never formatted
+        logconfig.shutdown()
+        self.assertIn("spy", self.stream.getvalue())
+        self.assertEqual(self.stream.getvalue().count("spy"), 1)
+        self.assertIsNotNone(spy.formatted_in)
+        self.assertIsNot(spy.formatted_in, threading.current_thread())
+
+    def test_payloads_are_sampled(self):
+        logconfig.configure(level=logging.DEBUG, stream=self.stream, use_queue=False)
+        log_payload(self.logger, "entities", ["John Smith"])
+        self.assertNotIn("John Smith", self.stream.getvalue())
+        logconfig.configure(level=logging.DEBUG, stream=self.stream, use_queue=False, payload_sample_rate=1.0)
+        log_payload(self.logger, "entities", ["John Smith"])
+        self.assertIn("John Smith", self.stream.getvalue())
+
+    def test_requests_do_not_log_phi(self):
+        corpus = generate_corpus(1, length=300, phi_density=0.3)
+        app = create_app({'SECRET_KEY': 'dev', 'TESTING': True, 'RESULT_CACHE_ENABLED': False,
+                          'LOG_LEVEL': 'DEBUG', 'LOG_FORMAT': 'json'})
+        get_backends(app).use(compmed=StubCompMed(corpus), hutchner=StubHutchNER(corpus))
+        with self.assertLogs('flaskphiid', logging.DEBUG) as logs:
+            for endpoint in ('/hutchner/phi', '/compmed/phi', '/identifyphi/'):
+                response = app.test_client().post(endpoint, json={'extract_text': corpus[0].text})
+                self.assertEqual(response.status_code, 200)
+        events = [record.msg.event for record in logs.records if isinstance(record.msg, Event)]
+        self.assertEqual(events, ['hutchner.entities', 'compmed.entities', 'identifyphi.entities'])
+        phi = [entity['Text'] for entity in corpus[0].compmed]
+        for line in logs.output:
+            self.assertFalse([text for text in phi if text in line], line)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import json
+import unittest
+from unittest.mock import patch, MagicMock
+
+from flaskphiid import create_app
+from flaskphiid.metrics import Counter, Gauge, Histogram, REGISTRY, reset, timed_backend, BACKEND_ERRORS
+
+
+class MetricTypeTests(unittest.TestCase):
+
+    def setUp(self):
+        registered = len(REGISTRY)
+        self.addCleanup(REGISTRY.__delitem__, slice(registered, None))
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram('test_seconds', "test", ['stage'], buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value, stage='merge')
+        self.assertEqual(histogram.render(), [
+            '# HELP test_seconds test',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{stage="merge",le="0.1"} 2',
+            'test_seconds_bucket{stage="merge",le="1"} 3',
+            'test_seconds_bucket{stage="merge",le="+Inf"} 4',
+            'test_seconds_sum{stage="merge"} 2.65',
+            'test_seconds_count{stage="merge"} 4',
+        ])
+
+    def test_counter_labels_are_escaped(self):
+        counter = Counter('test_total', "test", ['error'])
+        counter.inc(error='say "hi"\n')
+        counter.inc(2, error='say "hi"\n')
+        self.assertEqual(counter.render()[-1], r'test_total{error="say \"hi\"\n"} 3')
+        self.assertRaises(ValueError, counter.inc, backend='compmed')
+
+    def test_gauge_tracks_in_progress(self):
+        gauge = Gauge('test_in_flight', "test", ['backend'])
+        with gauge.track_in_progress(backend='compmed'):
+            self.assertEqual(gauge.value(backend='compmed'), 1)
+        self.assertEqual(gauge.value(backend='compmed'), 0)
+
+    def test_timed_backend_counts_errors(self):
+        reset()
+        failing = MagicMock(side_effect=ValueError("bad input"))
+        self.assertRaises(ValueError, timed_backend('compmed', failing), "note")
+        self.assertEqual(BACKEND_ERRORS.value(backend='compmed', error='ValueError'), 1)
+
+
+class MetricsEndpointTests(unittest.TestCase):
+
+    def setUp(self):
+        patchers = [patch('HutchNERPredict.hutchner.HutchNER.load_model'),
+                    patch('HutchNERPredict.hutchner.HutchNER.load_clusters')]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        reset()
+        self.app = create_app({'SECRET_KEY': 'dev',
+                               'TESTING': True,
+                               'HUTCHNER_MODEL': "test_resources/simple_crf_ner.pkl",
+                               'CLINIC_NOTE_CLUSTERS': "test_resources/clusters.pkl",
+                               'RESULT_CACHE_ENABLED': False}).test_client()
+
+    @patch('HutchNERPredict.hutchner.HutchNER.predict')
+    @patch('flaskphiid.compmed_client.CompMedClient.get_phi')
+    def test_identify_phi_stages_are_recorded(self, mock_get_phi, mock_predict):
+        mock_get_phi.return_value = [{"BeginOffset": 4, "EndOffset": 14, "Score": 0.99,
+                                      "Text": "John Smith", "Type": "NAME"}]
+        mock_predict.return_value = MagicMock(NER_token_labels=[])
+        result = self.app.post('/identifyphi/', data=json.dumps({'extract_text': "Mr. John Smith"}),
+                               content_type='application/json')
+        self.assertEqual(result.status_code, 200)
+
+        result = self.app.get('/metrics')
+        self.assertEqual(result.status_code, 200)
+        lines = result.get_data(as_text=True).splitlines()
+        for stage in ('backends', 'merge', 'serialize'):
+            self.assertIn('flaskphiid_stage_seconds_count{{stage="{}"}} 1'.format(stage), lines)
+        for backend in ('compmed', 'hutchner'):
+            self.assertIn('flaskphiid_backend_seconds_count{{backend="{}"}} 1'.format(backend), lines)
+        self.assertIn('flaskphiid_entities_bucket{source="merged",le="1"} 1', lines)
+        self.assertIn('flaskphiid_note_chars_sum 14.0', lines)
+        self.assertIn('flaskphiid_request_seconds_count{endpoint="identifyphi.annotate",status="200"} 1', lines)
+        # the scrape itself is in flight while the page is rendered
+        self.assertIn('flaskphiid_requests_in_flight{endpoint="metrics.metrics"} 1', lines)
+
+    def test_metrics_can_be_disabled(self):
+        app = create_app({'TESTING': True, 'METRICS_ENABLED': False}).test_client()
+        self.assertEqual(app.get('/metrics').status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
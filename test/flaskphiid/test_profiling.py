@@ -0,0 +1,87 @@
+import json
+import pstats
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch, MagicMock
+
+from flaskphiid import create_app
+
+
+class ProfilingTests(unittest.TestCase):
+
+    def setUp(self):
+        patchers = [patch('HutchNERPredict.hutchner.HutchNER.load_model'),
+                    patch('HutchNERPredict.hutchner.HutchNER.load_clusters'),
+                    patch('flaskphiid.compmed_client.CompMedClient.get_phi'),
+                    patch('HutchNERPredict.hutchner.HutchNER.predict')]
+        mocks = []
+        for patcher in patchers:
+            mocks.append(patcher.start())
+            self.addCleanup(patcher.stop)
+        _, _, self.mock_get_phi, self.mock_predict = mocks
+        self.mock_get_phi.return_value = [{"BeginOffset": 4, "EndOffset": 14, "Score": 0.99,
+                                           "Text": "John Smith", "Type": "NAME"}]
+        self.mock_predict.return_value = MagicMock(NER_token_labels=[])
+        self.profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.profile_dir)
+        self.app = self.make_app(PROFILING_ENABLED=True, PROFILE_KEEP=2)
+
+    def make_app(self, **config):
+        return create_app(dict({'SECRET_KEY': 'dev',
+                                'TESTING': True,
+                                'HUTCHNER_MODEL': "test_resources/simple_crf_ner.pkl",
+                                'CLINIC_NOTE_CLUSTERS': "test_resources/clusters.pkl",
+                                'RESULT_CACHE_ENABLED': False,
+                                'PROFILE_DIR': self.profile_dir}, **config)).test_client()
+
+    def post(self, app, body, **headers):
+        return app.post('/identifyphi/', data=json.dumps(body), content_type='application/json', headers=headers)
+
+    def test_header_profiles_whole_request(self):
+        threads = set()
+        self.mock_get_phi.side_effect = lambda note: threads.add(threading.get_ident()) or self.mock_get_phi.return_value
+        result = self.post(self.app, {'extract_text': "Mr. John Smith"}, **{'X-Profile': '1'})
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(json.loads(result.data)[0]['text'], "John Smith")
+        # backend calls ran in the profiled request thread
+        self.assertEqual(threads, {threading.get_ident()})
+
+        profile_id = result.headers['X-Profile-Id']
+        self.assertTrue(result.headers['X-Profile-Top'])
+        download = self.app.get(result.headers['X-Profile-Url'])
+        self.assertEqual(download.status_code, 200)
+        path = "{}/{}.prof".format(self.profile_dir, profile_id)
+        functions = {function for _, _, function in pstats.Stats(path).stats}
+        self.assertIn('identify_phi', functions)
+        self.assertIn('merge_phi', functions)
+        self.assertIn('unionize_annotations', functions)
+        self.assertEqual(self.app.get('/profiles/').get_json(), [profile_id])
+
+    def test_profiled_requests_skip_the_cache(self):
+        app = self.make_app(PROFILING_ENABLED=True, RESULT_CACHE_ENABLED=True)
+        self.post(app, {'extract_text': "Mr. John Smith"})
+        self.post(app, {'extract_text': "Mr. John Smith", 'profile': True})
+        self.assertEqual(self.mock_get_phi.call_count, 2)
+
+    def test_json_field_and_retention(self):
+        ids = [self.post(self.app, {'extract_text': "Mr. John Smith", 'profile': True}).headers['X-Profile-Id']
+               for _ in range(3)]
+        self.assertEqual(sorted(self.app.get('/profiles/').get_json()), sorted(ids[1:]))
+
+    def test_not_profiled_unless_asked(self):
+        result = self.post(self.app, {'extract_text': "Mr. John Smith"})
+        self.assertNotIn('X-Profile-Id', result.headers)
+        self.assertEqual(self.app.get('/profiles/not-a-profile').status_code, 404)
+
+    def test_disabled_by_default(self):
+        app = self.make_app()
+        result = self.post(app, {'extract_text': "Mr. John Smith"}, **{'X-Profile': '1'})
+        self.assertEqual(result.status_code, 200)
+        self.assertNotIn('X-Profile-Id', result.headers)
+        self.assertEqual(app.get('/profiles/').status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
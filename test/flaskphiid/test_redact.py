@@ -0,0 +1,76 @@
+import json
+import unittest
+from unittest.mock import patch, MagicMock
+
+from flaskphiid import create_app
+from flaskphiid.redact import redact
+
+
+class RedactTests(unittest.TestCase):
+
+    NOTE = "John Smith saw Dr Jones; Smith returns May 5"
+    ANNOTATIONS = [{'start': 39, 'end': 44, 'type': 'DATE'},
+                   {'start': 0, 'end': 10, 'type': 'NAME'},
+                   {'start': 18, 'end': 23, 'type': 'NAME'},
+                   {'start': 25, 'end': 30, 'type': 'NAME'}]
+
+    def test_tags(self):
+        text, spans = redact(self.NOTE, self.ANNOTATIONS)
+        self.assertEqual(text, "[NAME] saw Dr [NAME]; [NAME] returns [DATE]")
+        for span in spans:
+            self.assertEqual(text[span['start']:span['end']], span['replacement'])
+
+    def test_surrogates_are_consistent(self):
+        text, spans = redact("Smith and Jones; Smith", [{'start': 0, 'end': 5, 'type': 'NAME'},
+                                                        {'start': 10, 'end': 15, 'type': 'NAME'},
+                                                        {'start': 17, 'end': 22, 'type': 'NAME'}], 'surrogate')
+        self.assertEqual(text, "[NAME-1] and [NAME-2]; [NAME-1]")
+        # a span inside the previous one has nothing left to replace
+        text, _ = redact(self.NOTE, self.ANNOTATIONS + [{'start': 20, 'end': 23, 'type': 'NAME'}], 'surrogate')
+        self.assertEqual(text, "[NAME-1] saw Dr [NAME-2]; [NAME-3] returns [DATE-1]")
+
+    def test_no_annotations_and_bad_mode(self):
+        self.assertEqual(redact(self.NOTE, []), (self.NOTE, []))
+        self.assertRaises(ValueError, redact, self.NOTE, [], 'blackout')
+
+
+class RedactEndpointTests(unittest.TestCase):
+
+    def setUp(self):
+        patchers = [patch('HutchNERPredict.hutchner.HutchNER.load_model'),
+                    patch('HutchNERPredict.hutchner.HutchNER.load_clusters')]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.app = create_app({'SECRET_KEY': 'dev',
+                               'TESTING': True,
+                               'HUTCHNER_MODEL': "test_resources/simple_crf_ner.pkl",
+                               'CLINIC_NOTE_CLUSTERS': "test_resources/clusters.pkl",
+                               'RESULT_CACHE_ENABLED': False}).test_client()
+
+    def post(self, body):
+        return self.app.post('/identifyphi/redact', data=json.dumps(body), content_type='application/json')
+
+    @patch('HutchNERPredict.hutchner.HutchNER.predict')
+    @patch('flaskphiid.compmed_client.CompMedClient.get_phi')
+    def test_redact(self, mock_get_phi, mock_predict):
+        mock_get_phi.return_value = [{"BeginOffset": 4, "EndOffset": 14, "Score": 0.99,
+                                      "Text": "John Smith", "Type": "NAME"}]
+        mock_predict.return_value = MagicMock(NER_token_labels=[])
+
+        result = self.post({'extract_text': "Mr. John Smith is a 48 yo teacher", 'include_spans': True})
+        self.assertEqual(result.status_code, 200)
+        body = json.loads(result.data)
+        self.assertEqual(body['redacted_text'], "Mr. [NAME] is a 48 yo teacher")
+        self.assertEqual(body['spans'], [{'start': 4, 'end': 10, 'type': 'NAME', 'replacement': '[NAME]'}])
+
+        result = self.post({'extract_text': "Mr. John Smith is a 48 yo teacher", 'mode': 'surrogate'})
+        self.assertEqual(json.loads(result.data), {'redacted_text': "Mr. [NAME-1] is a 48 yo teacher"})
+
+    def test_bad_requests(self):
+        self.assertEqual(self.post({'extract_text': ""}).status_code, 400)
+        self.assertEqual(self.post({'extract_text': "note", 'mode': 'blackout'}).status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()